@@ -0,0 +1,3697 @@
+"""Nucleo di AutomaticTelReader senza Qt: archivi, thread di scrittura, conservazione e acquisizione Telegram.
+
+Lo usano sia la GUI (main.py) sia il demone senza interfaccia (daemon.py).
+"""
+try:
+    from telethon import TelegramClient, events
+    from telethon.tl.types import User, Channel, Chat
+except ImportError:
+    # Archivi, scrittura e regole funzionano anche senza telethon (es. nei test):
+    # serve solo a TelegramIngestor per collegarsi a Telegram
+    TelegramClient = events = None
+    User = Channel = Chat = ()
+import os
+import json
+import datetime
+import base64
+import uuid
+import socket
+import threading
+import time
+import sqlite3
+import hashlib
+import tempfile
+import gzip
+import queue
+import io
+import asyncio
+import itertools
+import random
+import re
+from collections import deque
+from collections import OrderedDict
+try:
+    import orjson
+except ImportError:
+    # Facoltativo: senza orjson i messaggi vengono serializzati con json compatto
+    orjson = None
+try:
+    from PIL import Image
+except ImportError:
+    # Facoltativo: senza Pillow il demone salva le foto senza miniatura, che la GUI genera poi in background
+    Image = None
+IMAGES_FILE = 'images.json'
+
+API_ID = ''
+API_HASH = ''
+SESSION_FILE = 'session.session'
+# Nome dell'account di config.json (api_id, api_hash, phone); gli altri sono in 'accounts'
+DEFAULT_ACCOUNT = 'default'
+MESSAGES_FILE = 'messages.json'
+MESSAGES_JOURNAL_FILE = 'messages.jsonl'
+CONFIG_FILE = 'config.json'
+CONTACTS_FILE = 'contacts.json'
+SETTINGS_FILE = 'settings.json'
+DATABASE_FILE = 'telreader.db'
+JSON_BACKEND_FILE = 'messages_store.json'
+JSONL_BACKEND_FILE = 'messages_store.jsonl'
+MEDIA_DIR = 'media'
+ARCHIVE_DIR = 'archive'
+IMAGE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+THUMBNAIL_SIZE = 50
+# Anteprima degli album nella riga di un messaggio: le prime ALBUM_PREVIEW_COUNT foto, di ALBUM_PREVIEW_SIZE pixel
+ALBUM_PREVIEW_COUNT = 3
+ALBUM_PREVIEW_SIZE = 40
+
+# Delimitatori dei termini trovati nei frammenti restituiti da MessageStore.search()
+SEARCH_MATCH_START = '\x02'
+SEARCH_MATCH_END = '\x03'
+SEARCH_PAGE_SIZE = 50
+
+# Group commit del thread di scrittura: una transazione ogni WRITER_FLUSH_INTERVAL
+# secondi oppure ogni WRITER_MAX_BATCH modifiche accodate
+WRITER_FLUSH_INTERVAL = 0.2
+WRITER_MAX_BATCH = 500
+# Attese (secondi) tra i tentativi di una scrittura fallita (es. "database is locked")
+WRITER_RETRY_DELAYS = (0.1, 0.5, 2)
+
+# Il motore di conservazione gira in background ogni RETENTION_INTERVAL secondi;
+# le immagini appena ricevute sono escluse dalla pulizia per RETENTION_IMAGE_GRACE secondi
+# Cache di mittenti e chat del listener: le voci più vecchie di ENTITY_CACHE_TTL
+# secondi vengono aggiornate in background, ENTITY_REFRESH_BATCH ogni ENTITY_REFRESH_INTERVAL secondi
+ENTITY_CACHE_MAX_ENTRIES = 5000
+ENTITY_CACHE_TTL = 6 * 3600
+ENTITY_REFRESH_INTERVAL = 60
+ENTITY_REFRESH_BATCH = 20
+
+# Chiavi (account, chat, id Telegram) dei messaggi acquisiti tenute in memoria per
+# riconoscere ripetizioni, modifiche ed eliminazioni senza interrogare l'archivio
+MESSAGE_INDEX_MAX_ENTRIES = 100000
+
+# Capacità di ciascuna coda della pipeline di acquisizione (oltre, chi produce attende)
+INGEST_QUEUE_SIZE = 1000
+# All'arresto i messaggi ancora in pipeline hanno al massimo SHUTDOWN_DRAIN_TIMEOUT
+# secondi per arrivare al thread di scrittura (la GUI attende il listener 5 secondi)
+SHUTDOWN_DRAIN_TIMEOUT = 3
+
+# Recupero dei messaggi persi mentre il listener era fermo: BACKFILL_CONCURRENCY
+# chat in parallelo, con BACKFILL_PAGE_WAIT secondi di pausa tra una pagina e l'altra
+BACKFILL_CONCURRENCY = 3
+BACKFILL_PAGE_WAIT = 1
+
+# Riconnessione automatica: attesa RECONNECT_BASE_DELAY * 2^tentativo (con jitter),
+# al massimo RECONNECT_MAX_DELAY secondi
+RECONNECT_BASE_DELAY = 1
+RECONNECT_MAX_DELAY = 300
+
+# I messaggi salvati arrivano alla GUI (o ai client del demone) in lotti,
+# al massimo uno ogni DELIVERY_BATCH_INTERVAL secondi
+DELIVERY_BATCH_INTERVAL = 0.033
+
+# Demone senza interfaccia (daemon.py): il file di lock indica porta e token del
+# server locale a cui la GUI si collega; lo stato viene inviato ogni DAEMON_STATUS_INTERVAL secondi
+DAEMON_LOCK_FILE = 'daemon.lock'
+DAEMON_HOST = '127.0.0.1'
+DAEMON_STATUS_INTERVAL = 2
+
+RETENTION_INITIAL_DELAY = 30
+RETENTION_INTERVAL = 600
+RETENTION_IMAGE_GRACE = 600
+
+DEFAULT_SETTINGS = {
+    'sound_notifications': False,
+    'desktop_notifications': True,
+    'minimize_to_tray': False,
+    'max_messages': 1000,
+    'max_message_age_days': 0,
+    'retention_scope': 'global',
+    'archive_after_days': 30,
+    'storage_backend': 'sqlite',
+    'ingest_resolve_workers': 4,
+    'ingest_download_workers': 2,
+    'media_per_chat_limit': 1,
+    'media_order': 'smallest_first',
+    'media_chat_priority': {},
+    'media_max_file_bytes': 20 * 1024 * 1024,
+    'media_skip_chats': [],
+    'filter_allow_chats': [],
+    'filter_deny_chats': [],
+    'filter_keep_patterns': [],
+    'filter_keep_keywords': [],
+    'filter_drop_patterns': [],
+    'filter_drop_keywords': [],
+    'filter_drop_media': [],
+    'filter_chat_sample': {},
+    'filter_chat_rate': {},
+    'backfill_enabled': True,
+    'backfill_max_per_chat': 5000,
+    'auto_scroll': True,
+    'auto_save_images': True,
+    'debug_mode': False
+}
+
+def load_settings():
+    """Impostazioni di settings.json completate con i valori predefiniti"""
+    settings = dict(DEFAULT_SETTINGS)
+    if os.path.exists(SETTINGS_FILE):
+        try:
+            with open(SETTINGS_FILE, 'r', encoding='utf-8') as f:
+                settings.update(json.load(f))
+        except Exception as e:
+            print(f"Errore nel caricamento di {SETTINGS_FILE}: {e}")
+    return settings
+
+_json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+def encode_json(obj):
+    """JSON compatto come stringa (con orjson, se installato)"""
+    if orjson is not None:
+        return orjson.dumps(obj).decode('utf-8')
+    return _json_encoder.encode(obj)
+
+def decode_json(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+class MessageRecord:
+    """Messaggio ricevuto, con i campi costruiti dall'handler del listener.
+
+    Usa __slots__ invece di un dizionario per occupare meno memoria, ma in
+    lettura si comporta come il dizionario di prima (msg.get('text'),
+    msg['sender'], 'image_id' in msg). Mittente e chat sono salvati solo come
+    id: msg['sender'] e msg['chat'] vengono risolti al momento dal registro
+    contatti, quindi un contatto rinominato appare aggiornato ovunque.
+    message_id è l'id del messaggio su Telegram (univoco all'interno della chat),
+    account il nome dell'account che lo ha ricevuto (vedi load_accounts).
+    Un album è un solo messaggio: image_ids elenca tutte le sue foto e image_id
+    è la prima (la copertina), così chi conosce una sola foto continua a funzionare.
+    from_dict() accetta anche il vecchio formato con i dizionari incorporati.
+    I campi sconosciuti letti da file finiscono in extra e vengono riscritti
+    così come sono.
+    """
+
+    FIELDS = ('sender_id', 'chat_id', 'text', 'date', 'received_at', 'image_id', 'message_id', 'account',
+              'image_ids')
+    __slots__ = FIELDS + ('id', 'extra')
+
+    def __init__(self, sender_id=None, chat_id=None, text=None, date=None, received_at=None,
+                 image_id=None, message_id=None, account=None, image_ids=None, id=None, extra=None):
+        self.sender_id = sender_id
+        self.chat_id = chat_id
+        self.text = text
+        self.date = date
+        self.received_at = received_at
+        self.image_id = image_id
+        self.message_id = message_id
+        self.account = account
+        self.image_ids = image_ids
+        self.id = id
+        self.extra = extra
+
+    @classmethod
+    def from_dict(cls, data):
+        record = cls.__new__(cls)
+        get = data.get
+        sender = get('sender')
+        chat = get('chat')
+        record.sender_id = get('sender_id') or (sender.get('id') if sender else None) or get('from_id')
+        record.chat_id = get('chat_id') or (chat.get('id') if chat else None)
+        record.text = get('text')
+        record.date = get('date')
+        record.received_at = get('received_at')
+        record.image_id = get('image_id')
+        record.message_id = get('message_id')
+        record.account = get('account')
+        record.image_ids = get('image_ids')
+        record.id = get('id')
+        unknown = data.keys() - _DECODED_MESSAGE_KEYS
+        record.extra = {key: data[key] for key in unknown} if unknown else None
+        return record
+
+    @property
+    def sender(self):
+        return resolve_contact(self.sender_id)
+
+    @property
+    def chat(self):
+        return resolve_contact(self.chat_id)
+
+    def to_dict(self, with_id=True):
+        data = {'sender_id': self.sender_id, 'chat_id': self.chat_id, 'text': self.text,
+                'date': self.date, 'received_at': self.received_at, 'image_id': self.image_id,
+                'message_id': self.message_id, 'account': self.account}
+        if self.image_ids:
+            # Solo per gli album: gli altri messaggi non pagano il campo vuoto
+            data['image_ids'] = self.image_ids
+        if with_id and self.id is not None:
+            data['id'] = self.id
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def get(self, key, default=None):
+        """Come dict.get, ma un campo a None restituisce default"""
+        if key in _MESSAGE_ATTRIBUTES:
+            value = getattr(self, key)
+        else:
+            value = self.extra.get(key) if self.extra else None
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        if key in _MESSAGE_ATTRIBUTES:
+            return getattr(self, key)
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in _MESSAGE_KEYS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def pop(self, key, default=None):
+        """Rimuove un campo aggiuntivo (in extra)"""
+        if not self.extra:
+            return default
+        value = self.extra.pop(key, default)
+        if not self.extra:
+            self.extra = None
+        return value
+
+    def __repr__(self):
+        return f'MessageRecord({self.to_dict()!r})'
+
+_MESSAGE_KEYS = frozenset(MessageRecord.FIELDS + ('id',))
+# Chiavi del vecchio formato, convertite da from_dict()
+_LEGACY_MESSAGE_KEYS = frozenset(('sender', 'chat', 'from_id'))
+_DECODED_MESSAGE_KEYS = _MESSAGE_KEYS | _LEGACY_MESSAGE_KEYS
+_MESSAGE_ATTRIBUTES = _MESSAGE_KEYS | {'sender', 'chat'}
+
+def message_image_ids(msg):
+    """Tutte le foto di un messaggio: quelle dell'album oppure l'unica in image_id"""
+    image_ids = msg.get('image_ids')
+    if image_ids:
+        return list(image_ids)
+    image_id = msg.get('image_id')
+    return [image_id] if image_id else []
+
+def is_legacy_message(data):
+    """True per un messaggio (dizionario) salvato con sender/chat incorporati"""
+    return not _LEGACY_MESSAGE_KEYS.isdisjoint(data.keys())
+
+def legacy_message_contacts(data):
+    """Contatti incorporati in un messaggio nel vecchio formato"""
+    return [contact for contact in (data.get('sender'), data.get('chat'))
+            if isinstance(contact, dict) and contact.get('id')]
+
+def encode_message(msg, with_id=False):
+    """Serializza un messaggio (MessageRecord o dizionario) in JSON compatto"""
+    if not isinstance(msg, MessageRecord):
+        msg = MessageRecord.from_dict(msg)
+    return encode_json(msg.to_dict(with_id))
+
+def decode_message(data, message_id=None):
+    record = MessageRecord.from_dict(decode_json(data))
+    if message_id is not None:
+        record.id = message_id
+    return record
+
+# Politica di fsync del journal: 'always' (ogni scrittura), 'interval' (al massimo
+# una volta ogni JOURNAL_FSYNC_INTERVAL secondi) oppure 'never' (lascia fare al SO)
+JOURNAL_FSYNC_POLICY = 'interval'
+JOURNAL_FSYNC_INTERVAL = 1.0
+
+class MessageJournal:
+    """Journal append-only dei messaggi in formato JSON Lines (un record per riga)"""
+
+    def __init__(self, path=MESSAGES_JOURNAL_FILE, fsync_policy=JOURNAL_FSYNC_POLICY,
+                 fsync_interval=JOURNAL_FSYNC_INTERVAL):
+        self.path = path
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self._file = None
+        self._last_fsync = 0.0
+        self._lock = threading.Lock()
+
+    def append(self, msg):
+        """Aggiunge un messaggio in coda al journal"""
+        self.append_many([msg])
+
+    def append_many(self, messages):
+        """Aggiunge più messaggi con una sola scrittura"""
+        data = ''.join(encode_message(msg, with_id=True) + '\n' for msg in messages)
+        if not data:
+            return
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a', encoding='utf-8')
+                if self._has_torn_tail():
+                    # Chiude l'ultima riga rimasta a metà così da non corrompere la prossima
+                    self._file.write('\n')
+            self._file.write(data)
+            self._file.flush()
+            if self.fsync_policy == 'always':
+                self._fsync()
+            elif self.fsync_policy == 'interval' and time.monotonic() - self._last_fsync >= self.fsync_interval:
+                self._fsync()
+
+    def _has_torn_tail(self):
+        if os.path.getsize(self.path) == 0:
+            return False
+        with open(self.path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) != b'\n'
+
+    def _fsync(self):
+        os.fsync(self._file.fileno())
+        self._last_fsync = time.monotonic()
+
+    def sync(self):
+        """Forza su disco le scritture ancora in cache"""
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                self._fsync()
+
+    def truncate(self):
+        """Svuota il journal (usato da 'Elimina Cronologia')"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            with open(self.path, 'w', encoding='utf-8'):
+                pass
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
+
+    def __iter__(self):
+        return iter_journal(self.path)
+
+def iter_journal(path=MESSAGES_JOURNAL_FILE):
+    """Legge il journal in streaming, un messaggio alla volta"""
+    if not os.path.exists(path):
+        return
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield decode_json(line)
+            except json.JSONDecodeError:
+                # Riga troncata da una chiusura improvvisa: la salta senza perdere il resto
+                print(f"Riga {line_no} di {path} non valida, ignorata")
+
+def migrate_messages_json(json_path=MESSAGES_FILE, journal_path=MESSAGES_JOURNAL_FILE):
+    """Converte una sola volta il vecchio messages.json nel journal JSONL.
+
+    I messaggi del vecchio file vengono messi prima di quelli già presenti nel
+    journal; a migrazione completata messages.json viene rinominato in
+    messages.json.migrated. Restituisce il numero di messaggi convertiti.
+    Se il file non è leggibile solleva ValueError e lo lascia al suo posto,
+    così la migrazione viene ritentata dopo averlo corretto.
+    """
+    if not os.path.exists(json_path):
+        return 0
+    try:
+        with open(json_path, 'r', encoding='utf-8') as f:
+            content = f.read().strip()
+        messages = json.loads(content) if content else []
+    except (OSError, ValueError) as e:
+        raise ValueError(f"{json_path} non leggibile: {e}") from e
+    if not isinstance(messages, list):
+        raise ValueError(f"{json_path}: formato non valido, attesa una lista di messaggi")
+
+    tmp_path = journal_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as out:
+        for msg in messages:
+            out.write(json.dumps(msg, ensure_ascii=False) + '\n')
+        if os.path.exists(journal_path):
+            with open(journal_path, 'r', encoding='utf-8') as existing:
+                for line in existing:
+                    out.write(line if line.endswith('\n') else line + '\n')
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp_path, journal_path)
+    os.replace(json_path, json_path + '.migrated')
+    return len(messages)
+
+def message_chat_id(msg):
+    """ID della conversazione di un messaggio (gruppo/canale, altrimenti mittente)"""
+    if not isinstance(msg, MessageRecord):
+        msg = MessageRecord.from_dict(msg)
+    return msg.chat_id or msg.sender_id
+
+class MessageBackend:
+    """Interfaccia comune degli archivi dei messaggi.
+
+    Il backend in uso si sceglie con 'storage_backend' in settings.json (vedi
+    STORAGE_BACKENDS). Le sottoclassi implementano append_many, get, __iter__,
+    delete_messages e clear; gli altri metodi hanno una versione generica basata
+    sull'iterazione, che i backend indicizzati sostituiscono con query dirette.
+    append_many assegna a ogni messaggio la chiave 'id', presente anche in tutti
+    i messaggi restituiti.
+    """
+
+    def append(self, msg):
+        """Salva un messaggio e ne restituisce l'id"""
+        return self.append_many([msg])[0]
+
+    def append_many(self, messages):
+        """Salva più messaggi e restituisce i loro id"""
+        raise NotImplementedError
+
+    def get(self, message_id):
+        raise NotImplementedError
+
+    def __iter__(self):
+        """Tutti i messaggi, in ordine di arrivo"""
+        raise NotImplementedError
+
+    def update_messages(self, messages):
+        """Riscrive messaggi già salvati (stesso id), es. quando arriva la foto"""
+        raise NotImplementedError
+
+    def delete_messages(self, ids):
+        raise NotImplementedError
+
+    def clear(self):
+        """Elimina tutti i messaggi"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def range_by_time(self, start=None, end=None):
+        """Messaggi con start <= received_at < end, in ordine di arrivo"""
+        for msg in self:
+            received_at = msg.get('received_at') or ''
+            if (start is None or received_at >= start) and (end is None or received_at < end):
+                yield msg
+
+    def range_by_chat(self, chat_id, start=None, end=None):
+        """Messaggi di una singola chat, in ordine di arrivo"""
+        for msg in self.range_by_time(start, end):
+            if message_chat_id(msg) == chat_id:
+                yield msg
+
+    def range_by_account(self, account, start=None, end=None):
+        """Messaggi ricevuti da un solo account, in ordine di arrivo"""
+        for msg in self.range_by_time(start, end):
+            if (msg.get('account') or DEFAULT_ACCOUNT) == account:
+                yield msg
+
+    def accounts(self):
+        """Nomi degli account che hanno ricevuto almeno un messaggio"""
+        return sorted({msg.get('account') or DEFAULT_ACCOUNT for msg in self})
+
+    def find_messages(self, account, message_id, chat_id=None):
+        """Messaggi salvati con questo id Telegram, nella chat indicata oppure, con chat_id
+        None, in tutte le chat che non sono canali (dove gli id sono propri dell'account)"""
+        return [msg for msg in self if _matches_telegram_id(msg, account, message_id, chat_id)]
+
+    def count(self):
+        return sum(1 for _ in self)
+
+    def chats(self):
+        """Restituisce [(chat_id, info chat)] in ordine di primo messaggio"""
+        chat_ids = {}
+        for msg in self:
+            chat_id = message_chat_id(msg)
+            if chat_id is not None:
+                chat_ids.setdefault(chat_id, None)
+        return [(chat_id, resolve_contact(chat_id)) for chat_id in chat_ids]
+
+    def normalize_messages(self, store):
+        """Migrazione allo schema normalizzato; restituisce i messaggi convertiti"""
+        return 0
+
+    def clear_media_pending(self):
+        """Toglie media_pending ai messaggi rimasti in attesa di foto che non arriveranno più
+        (chiusura o arresto durante il download); restituisce i messaggi corretti"""
+        stale = [msg for msg in self if msg.get('media_pending')]
+        for msg in stale:
+            msg.pop('media_pending')
+        if stale:
+            self.update_messages(stale)
+        return len(stale)
+
+    def image_ids(self):
+        """ID delle immagini usate dai messaggi (comprese le foto degli album)"""
+        return {image_id for msg in self for image_id in message_image_ids(msg)}
+
+    def search(self, query, limit=50, offset=0):
+        """Messaggi che contengono tutte le parole cercate, i più recenti per primi"""
+        terms = [term.casefold() for term in query.split()]
+        if not terms:
+            return 0, []
+        matches = [msg for msg in self if all(term in (msg.get('text') or '').casefold() for term in terms)]
+        matches.reverse()
+        return len(matches), [(msg, msg.get('text') or '') for msg in matches[offset:offset + limit]]
+
+    def expired_message_ids(self, max_count=None, per_chat=False, older_than=None):
+        """ID dei messaggi oltre i limiti di conservazione (numero e/o età)"""
+        rows = [(msg['id'], msg.get('received_at') or '', message_chat_id(msg)) for msg in self]
+        ids = set()
+        if older_than:
+            ids.update(message_id for message_id, received_at, _ in rows if received_at < older_than)
+        if max_count:
+            kept = {}
+            for message_id, _, chat_id in sorted(rows, key=lambda row: (row[1], row[0]), reverse=True):
+                key = chat_id if per_chat else None
+                kept[key] = kept.get(key, 0) + 1
+                if kept[key] > max_count:
+                    ids.add(message_id)
+        return sorted(ids)
+
+def _matches_telegram_id(msg, account, message_id, chat_id):
+    if msg.get('message_id') != message_id or (msg.get('account') or DEFAULT_ACCOUNT) != account:
+        return False
+    if chat_id is not None:
+        return message_chat_id(msg) == chat_id
+    return (resolve_contact(message_chat_id(msg)) or {}).get('type') != 'channel'
+
+class _MemoryIndexedBackend(MessageBackend):
+    """Base dei backend su file: tutti i messaggi restano in memoria, indicizzati per id.
+
+    Come AUTOINCREMENT in SQLite, un id non viene mai riassegnato: il prossimo
+    id è salvato in <file>.seq prima di ogni riscrittura che può togliere i
+    messaggi più recenti, così dopo un riavvio gli aggiornamenti aggiunti in
+    coda al journal non finiscono su un messaggio diverso.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.seq_path = path + '.seq'
+        self._lock = threading.Lock()
+        self._messages = []
+        # Messaggi nel vecchio formato: normalize_messages() riscrive il file
+        self._legacy_count = 0
+        self._legacy_contacts = {}
+        positions = {}
+        for data in self._read_all():
+            if is_legacy_message(data):
+                self._legacy_count += 1
+                for contact in legacy_message_contacts(data):
+                    self._legacy_contacts[str(contact['id'])] = contact
+            msg = MessageRecord.from_dict(data)
+            if msg.id is not None and msg.id in positions:
+                # Versione aggiornata di un messaggio già letto: vale l'ultima
+                self._messages[positions[msg.id]] = msg
+                continue
+            if msg.id is not None:
+                positions[msg.id] = len(self._messages)
+            self._messages.append(msg)
+        self._index = {msg['id']: msg for msg in self._messages if 'id' in msg}
+        self._next_id = max(max(self._index, default=0) + 1, self._read_next_id())
+        for msg in self._messages:
+            if 'id' not in msg:
+                msg['id'] = self._next_id
+                self._index[msg['id']] = msg
+                self._next_id += 1
+
+    def _read_all(self):
+        """I messaggi salvati, come dizionari"""
+        raise NotImplementedError
+
+    def _read_next_id(self):
+        try:
+            with open(self.seq_path, 'r', encoding='utf-8') as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _write_next_id(self):
+        tmp_path = self.seq_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(str(self._next_id))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.seq_path)
+
+    def _persist_append(self, messages):
+        raise NotImplementedError
+
+    def _persist_update(self, messages):
+        self._rewrite()
+
+    def _rewrite(self):
+        """Riscrive il file con i messaggi in memoria (scrittura atomica)"""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            self._dump(self._messages, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def append_many(self, messages):
+        messages = [msg if isinstance(msg, MessageRecord) else MessageRecord.from_dict(msg) for msg in messages]
+        with self._lock:
+            for msg in messages:
+                msg['id'] = self._next_id
+                self._next_id += 1
+                self._messages.append(msg)
+                self._index[msg['id']] = msg
+            self._persist_append(messages)
+        return [msg['id'] for msg in messages]
+
+    def get(self, message_id):
+        return self._index.get(message_id)
+
+    def update_messages(self, messages):
+        with self._lock:
+            updated = []
+            for msg in messages:
+                current = self._index.get(msg.id)
+                if current is None:
+                    continue
+                if current is not msg:
+                    self._messages[self._messages.index(current)] = msg
+                    self._index[msg.id] = msg
+                updated.append(msg)
+            if updated:
+                self._persist_update(updated)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._messages))
+
+    def count(self):
+        return len(self._messages)
+
+    def delete_messages(self, ids):
+        ids = set(ids)
+        if not ids:
+            return
+        with self._lock:
+            self._messages = [msg for msg in self._messages if msg['id'] not in ids]
+            for message_id in ids:
+                self._index.pop(message_id, None)
+            self._write_next_id()
+            self._rewrite()
+
+    def clear(self):
+        with self._lock:
+            self._messages = []
+            self._index = {}
+            self._write_next_id()
+            self._rewrite()
+
+    def normalize_messages(self, store):
+        if not self._legacy_count:
+            return 0
+        store.add_missing_contacts(self._legacy_contacts.values())
+        with self._lock:
+            self._rewrite()
+        converted = self._legacy_count
+        self._legacy_count = 0
+        self._legacy_contacts = {}
+        return converted
+
+class JsonMessageBackend(_MemoryIndexedBackend):
+    """Un'unica lista JSON, riscritta per intero a ogni salvataggio (il formato originale)"""
+
+    def __init__(self, path=JSON_BACKEND_FILE):
+        super().__init__(path)
+
+    def _read_all(self):
+        if not os.path.exists(self.path):
+            return []
+        try:
+            with open(self.path, 'rb') as f:
+                content = f.read().strip()
+            return decode_json(content) if content else []
+        except Exception as e:
+            print(f"Errore nel caricamento di {self.path}: {e}")
+            return []
+
+    def _dump(self, messages, f):
+        f.write('[' + ','.join(encode_message(msg, with_id=True) for msg in messages) + ']')
+
+    def _persist_append(self, messages):
+        self._rewrite()
+
+class JsonlMessageBackend(_MemoryIndexedBackend):
+    """Journal JSONL: i nuovi messaggi vengono solo aggiunti in coda al file"""
+
+    def __init__(self, path=JSONL_BACKEND_FILE):
+        self.journal = MessageJournal(path)
+        super().__init__(path)
+
+    def _read_all(self):
+        return iter_journal(self.path)
+
+    def _dump(self, messages, f):
+        f.write(''.join(encode_message(msg, with_id=True) + '\n' for msg in messages))
+
+    def _persist_append(self, messages):
+        self.journal.append_many(messages)
+
+    def _persist_update(self, messages):
+        # Journal append-only: la nuova versione viene aggiunta in coda e alla
+        # lettura sostituisce quella precedente con lo stesso id
+        self.journal.append_many(messages)
+
+    def _rewrite(self):
+        self.journal.close()
+        super()._rewrite()
+
+    def close(self):
+        self.journal.close()
+
+class MessageStore(MessageBackend):
+    """Archivio SQLite (in modalità WAL) per messaggi, contatti e immagini.
+
+    Ogni thread usa la propria connessione; le query di lettura sfruttano gli
+    indici su chat, mittente e received_at invece di scorrere tutto lo storico.
+    Le foto degli album sono collegate al loro messaggio in message_images
+    (la colonna image_id contiene solo la copertina).
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id TEXT,
+            sender_id TEXT,
+            received_at TEXT,
+            date TEXT,
+            image_id TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages(chat_id, received_at);
+        CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages(sender_id, received_at);
+        CREATE INDEX IF NOT EXISTS idx_messages_received ON messages(received_at);
+        CREATE INDEX IF NOT EXISTS idx_messages_image ON messages(image_id) WHERE image_id IS NOT NULL;
+        CREATE TABLE IF NOT EXISTS contacts (
+            id TEXT PRIMARY KEY,
+            type TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS images (
+            id TEXT PRIMARY KEY,
+            date TEXT,
+            sender_id TEXT,
+            chat_id TEXT,
+            sha256 TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_images_chat ON images(chat_id);
+        CREATE TABLE IF NOT EXISTS archive_refs (
+            image_id TEXT PRIMARY KEY,
+            segment TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_archive_refs_segment ON archive_refs(segment);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS message_images (
+            image_id TEXT PRIMARY KEY,
+            message_id INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_message_images_message ON message_images(message_id);
+        CREATE TRIGGER IF NOT EXISTS messages_images_delete AFTER DELETE ON messages BEGIN
+            DELETE FROM message_images WHERE message_id = old.id;
+        END;
+        CREATE TABLE IF NOT EXISTS chat_cursors (
+            account TEXT NOT NULL,
+            chat_id TEXT NOT NULL,
+            last_message_id INTEGER NOT NULL,
+            updated_at TEXT,
+            PRIMARY KEY (account, chat_id)
+        );
+    """
+
+    def __init__(self, path=DATABASE_FILE):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            self._migrate_chat_cursors(conn)
+            conn.executescript(self.SCHEMA)
+            self._ensure_column(conn, 'images', 'sha256', 'TEXT')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_images_sha256 ON images(sha256)')
+            self._ensure_column(conn, 'messages', 'message_id', 'INTEGER')
+            # Per (message_id, chat_id): serve anche le eliminazioni senza chat (vedi find_messages)
+            conn.execute('DROP INDEX IF EXISTS idx_messages_telegram')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_telegram_id ON messages(message_id, chat_id) '
+                         'WHERE message_id IS NOT NULL')
+            self._ensure_column(conn, 'messages', 'account', 'TEXT')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_account ON messages(account, received_at)')
+        self.has_fts = self._setup_fts()
+
+    # Indice FTS5 external-content: il testo sta solo in messages.data (letto tramite
+    # la vista messages_text), l'indice conserva soltanto i token
+    FTS_SCHEMA = """
+        CREATE VIEW IF NOT EXISTS messages_text AS
+            SELECT id, json_extract(data, '$.text') AS text FROM messages;
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            text, content = 'messages_text', content_rowid = 'id',
+            tokenize = 'unicode61 remove_diacritics 2'
+        );
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, text) VALUES (new.id, json_extract(new.data, '$.text'));
+        END;
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text)
+                VALUES ('delete', old.id, json_extract(old.data, '$.text'));
+        END;
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF data ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text)
+                VALUES ('delete', old.id, json_extract(old.data, '$.text'));
+            INSERT INTO messages_fts (rowid, text) VALUES (new.id, json_extract(new.data, '$.text'));
+        END;
+    """
+
+    def _setup_fts(self):
+        """Indice full-text (FTS5) sul testo, aggiornato dai trigger a ogni inserimento"""
+        conn = self._conn()
+        row = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'messages_fts'").fetchone()
+        if row and 'content' not in row[0]:
+            # Indice creato da versioni precedenti con una seconda copia del testo: va ricreato
+            with conn:
+                for trigger in ('messages_fts_insert', 'messages_fts_delete', 'messages_fts_update'):
+                    conn.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+                conn.execute('DROP TABLE messages_fts')
+                conn.execute("DELETE FROM meta WHERE key = 'fts_built'")
+        try:
+            conn.executescript(self.FTS_SCHEMA)
+        except sqlite3.OperationalError as e:
+            print(f"Ricerca full-text non disponibile (FTS5/JSON1 mancanti): {e}")
+            return False
+        if not conn.execute("SELECT 1 FROM meta WHERE key = 'fts_built'").fetchone():
+            # Indicizza una sola volta i messaggi salvati prima dell'indice
+            with conn:
+                conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('fts_built', '1')")
+        return True
+
+    def _migrate_chat_cursors(self, conn):
+        """I cursori senza account (una sola sessione) diventano quelli di DEFAULT_ACCOUNT"""
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(chat_cursors)')]
+        if columns and 'account' not in columns:
+            conn.execute('ALTER TABLE chat_cursors RENAME TO chat_cursors_old')
+            conn.executescript(self.SCHEMA)
+            conn.execute('INSERT INTO chat_cursors (account, chat_id, last_message_id, updated_at) '
+                         'SELECT ?, chat_id, last_message_id, updated_at FROM chat_cursors_old', (DEFAULT_ACCOUNT,))
+            conn.execute('DROP TABLE chat_cursors_old')
+
+    def _ensure_column(self, conn, table, column, declaration):
+        """Aggiunge una colonna ai database creati da versioni precedenti"""
+        columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+        if column not in columns:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {declaration}')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        """Chiude la connessione del thread corrente"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    # --- Messaggi ---
+
+    def _message_row(self, msg):
+        if not isinstance(msg, MessageRecord):
+            msg = MessageRecord.from_dict(msg)
+        return (message_chat_id(msg), msg.sender_id, msg.received_at, msg.date, msg.image_id,
+                msg.message_id, msg.account, encode_message(msg))
+
+    def append_many(self, messages):
+        self.apply_batch(messages=messages)
+        return [msg['id'] for msg in messages]
+
+    def update_messages(self, messages):
+        self.apply_batch(updates=messages)
+
+    def clear_media_pending(self):
+        conn = self._conn()
+        with conn:
+            return conn.execute("UPDATE messages SET data = json_remove(data, '$.media_pending') "
+                                "WHERE json_extract(data, '$.media_pending') IS NOT NULL").rowcount
+
+    def apply_batch(self, messages=(), contacts=(), images=(), updates=(), cursors=None):
+        """Scrive messaggi, contatti e immagini in un'unica transazione (group commit).
+
+        updates sono messaggi già salvati da riscrivere, applicati dopo gli inserimenti.
+        L'ultimo id Telegram visto per account e chat avanza con i messaggi inseriti, oppure
+        con cursors quando i messaggi sono salvati in un altro archivio.
+        """
+        conn = self._conn()
+        with conn:
+            if messages:
+                conn.executemany(
+                    'INSERT INTO messages (chat_id, sender_id, received_at, date, image_id, message_id, '
+                    'account, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (self._message_row(msg) for msg in messages))
+                # Nella stessa transazione gli id AUTOINCREMENT sono consecutivi
+                last_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+                for message_id, msg in enumerate(messages, last_id - len(messages) + 1):
+                    msg['id'] = message_id
+                self._link_images(conn, messages)
+            if messages or cursors:
+                self._advance_cursors(conn, messages if cursors is None else cursors)
+            if contacts:
+                self._merge_contacts(conn, contacts)
+            if images:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO images (id, date, sender_id, chat_id, sha256, data) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (self._image_row(image_id, image) for image_id, image in images))
+            if updates:
+                conn.executemany(
+                    'UPDATE messages SET chat_id = ?, sender_id = ?, received_at = ?, date = ?, '
+                    'image_id = ?, message_id = ?, account = ?, data = ? WHERE id = ?',
+                    (self._message_row(msg) + (msg['id'],) for msg in updates if msg.get('id') is not None))
+                self._link_images(conn, [msg for msg in updates if msg.get('id') is not None])
+
+    def _link_images(self, conn, messages):
+        rows = [(image_id, msg['id']) for msg in messages if msg.get('image_ids') for image_id in msg['image_ids']]
+        if rows:
+            conn.executemany('INSERT OR REPLACE INTO message_images (image_id, message_id) VALUES (?, ?)', rows)
+
+    def _advance_cursors(self, conn, messages):
+        latest = {}
+        for msg in messages:
+            message_id = max(msg.get('album_message_ids') or [], default=msg.get('message_id'))
+            key = (msg.get('account') or DEFAULT_ACCOUNT, message_chat_id(msg))
+            if message_id is not None and key[1] and message_id > latest.get(key, 0):
+                latest[key] = message_id
+        if latest:
+            now = datetime.datetime.utcnow().isoformat()
+            conn.executemany(
+                'INSERT INTO chat_cursors (account, chat_id, last_message_id, updated_at) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(account, chat_id) DO UPDATE SET '
+                'last_message_id = MAX(last_message_id, excluded.last_message_id), updated_at = excluded.updated_at',
+                [(account, chat_id, message_id, now) for (account, chat_id), message_id in latest.items()])
+
+    def chat_cursors(self, account=DEFAULT_ACCOUNT):
+        """{chat_id: ultimo id Telegram salvato} di un account, il punto da cui riprendere dopo un'interruzione"""
+        return dict(self._conn().execute(
+            'SELECT chat_id, last_message_id FROM chat_cursors WHERE account = ?', (account,)))
+
+    def _merge_contacts(self, conn, contacts):
+        # Più aggiornamenti dello stesso contatto nel batch diventano una sola scrittura
+        updates = {}
+        for info in contacts:
+            cid = str(info.get('id', ''))
+            if cid:
+                updates.setdefault(cid, {}).update(info)
+        if not updates:
+            return
+        placeholders = ','.join('?' * len(updates))
+        existing = {cid: json.loads(data) for cid, data in conn.execute(
+            f'SELECT id, data FROM contacts WHERE id IN ({placeholders})', list(updates))}
+        rows = []
+        for cid, info in updates.items():
+            contact = existing.get(cid, {})
+            contact.update(info)
+            rows.append((cid, contact.get('type'), json.dumps(contact, ensure_ascii=False)))
+        conn.executemany('INSERT OR REPLACE INTO contacts (id, type, data) VALUES (?, ?, ?)', rows)
+
+    def _load(self, message_id, data):
+        return decode_message(data, message_id)
+
+    def _iter_data(self, query, params=()):
+        for message_id, data in self._conn().execute(query, params):
+            yield self._load(message_id, data)
+
+    def _time_filter(self, start, end):
+        conditions, params = [], []
+        if start is not None:
+            conditions.append('received_at >= ?')
+            params.append(start)
+        if end is not None:
+            conditions.append('received_at < ?')
+            params.append(end)
+        return conditions, params
+
+    def get(self, message_id):
+        row = self._conn().execute('SELECT id, data FROM messages WHERE id = ?', (message_id,)).fetchone()
+        return self._load(*row) if row else None
+
+    def __iter__(self):
+        return self._iter_data('SELECT id, data FROM messages ORDER BY received_at, id')
+
+    def range_by_time(self, start=None, end=None):
+        conditions, params = self._time_filter(start, end)
+        where = f'WHERE {" AND ".join(conditions)} ' if conditions else ''
+        return self._iter_data(f'SELECT id, data FROM messages {where}ORDER BY received_at, id', params)
+
+    def range_by_chat(self, chat_id, start=None, end=None):
+        conditions, params = self._time_filter(start, end)
+        where = ''.join(f' AND {condition}' for condition in conditions)
+        return self._iter_data(
+            f'SELECT id, data FROM messages WHERE chat_id = ?{where} ORDER BY received_at, id',
+            [chat_id] + params)
+
+    def range_by_account(self, account, start=None, end=None):
+        conditions, params = self._time_filter(start, end)
+        where = ''.join(f' AND {condition}' for condition in conditions)
+        # I messaggi salvati prima degli account multipli appartengono all'account principale
+        account_filter = 'account = ?' if account != DEFAULT_ACCOUNT else '(account = ? OR account IS NULL)'
+        return self._iter_data(
+            f'SELECT id, data FROM messages WHERE {account_filter}{where} ORDER BY received_at, id',
+            [account] + params)
+
+    def accounts(self):
+        return sorted({row[0] or DEFAULT_ACCOUNT for row in self._conn().execute(
+            'SELECT DISTINCT account FROM messages')})
+
+    def find_messages(self, account, message_id, chat_id=None):
+        if chat_id is None:
+            rows = self._iter_data('SELECT id, data FROM messages WHERE message_id = ?', (message_id,))
+        else:
+            rows = self._iter_data('SELECT id, data FROM messages WHERE message_id = ? AND chat_id = ?',
+                                   (message_id, chat_id))
+        return [msg for msg in rows if _matches_telegram_id(msg, account, message_id, chat_id)]
+
+    def messages_from_sender(self, sender_id):
+        return self._iter_data(
+            'SELECT id, data FROM messages WHERE sender_id = ? ORDER BY received_at, id', (sender_id,))
+
+    def image_ids(self):
+        return {row[0] for row in self._conn().execute(
+            'SELECT image_id FROM messages WHERE image_id IS NOT NULL UNION SELECT image_id FROM message_images')}
+
+    def chats(self):
+        """Restituisce [(chat_id, info chat del primo messaggio)] senza leggere tutto lo storico"""
+        rows = self._conn().execute(
+            'SELECT chat_id, MIN(id) AS first_id FROM messages WHERE chat_id IS NOT NULL '
+            'GROUP BY chat_id ORDER BY first_id')
+        return [(chat_id, resolve_contact(chat_id)) for chat_id, _ in rows]
+
+    def search(self, query, limit=50, offset=0):
+        """Ricerca nel testo dei messaggi, ordinata per pertinenza.
+
+        Restituisce (totale, [(messaggio, frammento)]): nel frammento i termini
+        trovati sono racchiusi tra SEARCH_MATCH_START e SEARCH_MATCH_END.
+        """
+        terms = query.split()
+        if not terms:
+            return 0, []
+        conn = self._conn()
+        if not self.has_fts:
+            # Ripiego senza FTS5: scansione LIKE, senza ordinamento per pertinenza
+            where = ' AND '.join("json_extract(data, '$.text') LIKE ?" for _ in terms)
+            params = [f'%{term}%' for term in terms]
+            total = conn.execute(f'SELECT COUNT(*) FROM messages WHERE {where}', params).fetchone()[0]
+            rows = conn.execute(f'SELECT id, data FROM messages WHERE {where} ORDER BY id DESC LIMIT ? OFFSET ?',
+                                params + [limit, offset])
+            results = []
+            for message_id, data in rows:
+                msg = self._load(message_id, data)
+                results.append((msg, msg.get('text') or ''))
+            return total, results
+        # Ogni parola è una frase tra virgolette; l'ultima vale anche come prefisso (ricerca mentre si digita)
+        match = ' '.join('"' + term.replace('"', '""') + '"' for term in terms) + '*'
+        total = conn.execute('SELECT COUNT(*) FROM messages_fts WHERE messages_fts MATCH ?', (match,)).fetchone()[0]
+        rows = conn.execute(
+            'SELECT m.id, m.data, snippet(messages_fts, 0, ?, ?, \'…\', 32) FROM messages_fts '
+            'JOIN messages m ON m.id = messages_fts.rowid '
+            'WHERE messages_fts MATCH ? ORDER BY rank LIMIT ? OFFSET ?',
+            (SEARCH_MATCH_START, SEARCH_MATCH_END, match, limit, offset))
+        return total, [(self._load(message_id, data), fragment or '') for message_id, data, fragment in rows]
+
+    def count(self):
+        return self._conn().execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+
+    # --- Contatti ---
+
+    def upsert_contact(self, info):
+        """Aggiunge o aggiorna un contatto (i campi nuovi sovrascrivono quelli esistenti)"""
+        self.apply_batch(contacts=[info])
+
+    def add_missing_contacts(self, contacts):
+        """Aggiunge i contatti non ancora presenti, senza modificare quelli esistenti"""
+        with self._conn() as conn:
+            self._insert_missing_contacts(conn, contacts)
+
+    def _insert_missing_contacts(self, conn, contacts):
+        conn.executemany('INSERT OR IGNORE INTO contacts (id, type, data) VALUES (?, ?, ?)',
+                         ((str(contact['id']), contact.get('type'), json.dumps(contact, ensure_ascii=False))
+                          for contact in contacts))
+
+    def get_contact(self, contact_id):
+        row = self._conn().execute('SELECT data FROM contacts WHERE id = ?', (str(contact_id),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def contacts(self):
+        """Tutti i contatti come dizionario {id: info}"""
+        rows = self._conn().execute('SELECT id, data FROM contacts ORDER BY rowid')
+        return {cid: json.loads(data) for cid, data in rows}
+
+    # --- Immagini ---
+
+    def add_image(self, image_id, image):
+        """Salva i metadati di un'immagine (i byte stanno nel MediaStore, chiave sha256)"""
+        self.apply_batch(images=[(image_id, image)])
+
+    def _image_row(self, image_id, image):
+        sender = image.get('sender') or {}
+        chat = image.get('chat') or {}
+        return (image_id, image.get('date'), sender.get('id'), chat.get('id'),
+                image.get('sha256'), json.dumps(image, ensure_ascii=False))
+
+    def get_image(self, image_id):
+        row = self._conn().execute('SELECT data FROM images WHERE id = ?', (image_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_images(self, image_ids):
+        """Metadati di più immagini con poche query: {image_id: metadati}"""
+        image_ids = list(image_ids)
+        result = {}
+        for start in range(0, len(image_ids), 500):
+            chunk = image_ids[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self._conn().execute(f'SELECT id, data FROM images WHERE id IN ({placeholders})', chunk)
+            for image_id, data in rows:
+                result[image_id] = json.loads(data)
+        return result
+
+    # --- Conservazione ---
+
+    def expired_message_ids(self, max_count=None, per_chat=False, older_than=None):
+        """ID dei messaggi oltre i limiti di conservazione (numero e/o età)"""
+        conn = self._conn()
+        ids = set()
+        if older_than:
+            ids.update(row[0] for row in conn.execute(
+                'SELECT id FROM messages WHERE received_at < ?', (older_than,)))
+        if max_count:
+            if per_chat:
+                rows = conn.execute(
+                    'SELECT id FROM (SELECT id, ROW_NUMBER() OVER '
+                    '(PARTITION BY chat_id ORDER BY received_at DESC, id DESC) AS position '
+                    'FROM messages) WHERE position > ?', (max_count,))
+            else:
+                rows = conn.execute(
+                    'SELECT id FROM messages ORDER BY received_at DESC, id DESC LIMIT -1 OFFSET ?',
+                    (max_count,))
+            ids.update(row[0] for row in rows)
+        return sorted(ids)
+
+    def delete_messages(self, ids, chunk_size=1000):
+        """Elimina i messaggi a blocchi, con transazioni brevi che non bloccano le scritture"""
+        conn = self._conn()
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            with conn:
+                conn.execute(f'DELETE FROM messages WHERE id IN ({",".join("?" * len(chunk))})', chunk)
+
+    def unreferenced_images(self, older_than):
+        """[(image_id, sha256)] delle immagini non più usate da nessun messaggio"""
+        return self._conn().execute(
+            'SELECT id, sha256 FROM images WHERE date < ? '
+            'AND NOT EXISTS (SELECT 1 FROM messages WHERE messages.image_id = images.id) '
+            'AND NOT EXISTS (SELECT 1 FROM message_images WHERE message_images.image_id = images.id) '
+            'AND NOT EXISTS (SELECT 1 FROM archive_refs WHERE archive_refs.image_id = images.id)',
+            (older_than,)).fetchall()
+
+    def delete_images(self, image_ids, chunk_size=1000):
+        conn = self._conn()
+        for start in range(0, len(image_ids), chunk_size):
+            chunk = image_ids[start:start + chunk_size]
+            with conn:
+                conn.execute(f'DELETE FROM images WHERE id IN ({",".join("?" * len(chunk))})', chunk)
+
+    def sha256_in_use(self, sha256):
+        return self._conn().execute('SELECT 1 FROM images WHERE sha256 = ? LIMIT 1', (sha256,)).fetchone() is not None
+
+    def clear(self):
+        with self._conn() as conn:
+            conn.execute('DELETE FROM messages')
+
+    def clear_history(self):
+        """Elimina tutti i messaggi e le immagini (i contatti restano)"""
+        with self._conn() as conn:
+            conn.execute('DELETE FROM messages')
+            conn.execute('DELETE FROM images')
+            conn.execute('DELETE FROM archive_refs')
+
+    # --- Archivio ---
+
+    def message_rows_before(self, received_before, after=None, limit=1000):
+        """Una pagina di (id, received_at, chat_id, image_id, data) ricevuti prima di received_before.
+
+        after è la chiave (received_at, id) dell'ultima riga della pagina precedente.
+        """
+        if after is None:
+            return self._conn().execute(
+                'SELECT id, received_at, chat_id, image_id, data FROM messages WHERE received_at < ? '
+                'ORDER BY received_at, id LIMIT ?', (received_before, limit)).fetchall()
+        return self._conn().execute(
+            'SELECT id, received_at, chat_id, image_id, data FROM messages WHERE received_at < ? '
+            'AND (received_at, id) > (?, ?) ORDER BY received_at, id LIMIT ?',
+            (received_before, after[0], after[1], limit)).fetchall()
+
+    def move_to_archive(self, segment, message_ids, image_ids, chunk_size=1000):
+        """In un'unica transazione: registra le immagini del segmento, elimina i messaggi archiviati
+        e segna il segmento come in sospeso finché il file non è al suo posto"""
+        conn = self._conn()
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO archive_refs (image_id, segment) VALUES (?, ?)',
+                             ((image_id, segment) for image_id in image_ids))
+            for start in range(0, len(message_ids), chunk_size):
+                chunk = message_ids[start:start + chunk_size]
+                placeholders = ",".join("?" * len(chunk))
+                # Anche le foto degli album oltre la copertina restano legate al segmento
+                conn.execute('INSERT OR REPLACE INTO archive_refs (image_id, segment) '
+                             f'SELECT image_id, ? FROM message_images WHERE message_id IN ({placeholders})',
+                             [segment] + chunk)
+                conn.execute(f'DELETE FROM messages WHERE id IN ({placeholders})', chunk)
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('archive_pending', ?)", (segment,))
+
+    def drop_archive_refs(self, segments):
+        with self._conn() as conn:
+            conn.executemany('DELETE FROM archive_refs WHERE segment = ?', ((segment,) for segment in segments))
+
+    def get_meta(self, key):
+        row = self._conn().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def delete_meta(self, key):
+        with self._conn() as conn:
+            conn.execute('DELETE FROM meta WHERE key = ?', (key,))
+
+    # --- Importazione dei vecchi file JSON ---
+
+    def import_legacy_files(self, journal_path=MESSAGES_JOURNAL_FILE,
+                            contacts_path=CONTACTS_FILE, images_path=IMAGES_FILE):
+        """Importa una sola volta journal, contacts.json e images.json nel database.
+
+        Il segno 'legacy_imported' viene scritto solo quando ogni file è stato
+        importato o non esiste: se uno non è leggibile resta al suo posto, gli
+        altri vengono comunque importati e viene sollevato ValueError, così
+        l'importazione viene ritentata al prossimo avvio. Il journal, che non si
+        può reimportare senza duplicare i messaggi, ha un segno proprio.
+        """
+        conn = self._conn()
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_imported'").fetchone():
+            return False
+        if not self.get_meta('legacy_journal_imported'):
+            batch = []
+            for msg in iter_journal(journal_path):
+                batch.append(msg)
+                if len(batch) >= 1000:
+                    self._import_messages(batch)
+                    batch = []
+            if batch:
+                self._import_messages(batch)
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('legacy_journal_imported', ?)",
+                             (datetime.datetime.utcnow().isoformat(),))
+        errors = []
+        for path, loader in ((contacts_path, self._import_contacts), (images_path, self._import_images)):
+            if os.path.exists(path):
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        loader(json.load(f))
+                except Exception as e:
+                    errors.append(f"{path}: {e}")
+        if errors:
+            raise ValueError('; '.join(errors))
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('legacy_imported', ?)",
+                         (datetime.datetime.utcnow().isoformat(),))
+        return True
+
+    def _import_messages(self, messages):
+        # I contatti incorporati servono se contacts.json non li contiene
+        contacts = {}
+        for msg in messages:
+            for contact in legacy_message_contacts(msg):
+                contacts[str(contact['id'])] = contact
+        self.add_missing_contacts(contacts.values())
+        self.append_many(messages)
+
+    def normalize_messages(self, store=None, batch_size=1000):
+        """Migrazione allo schema normalizzato (una sola volta).
+
+        I messaggi salvati con i dizionari sender/chat incorporati vengono
+        riscritti con i soli sender_id e chat_id; i contatti che mancano nella
+        tabella vengono ricavati da quei dizionari. Restituisce il numero di
+        messaggi convertiti.
+        """
+        conn = self._conn()
+        if self.get_meta('messages_normalized'):
+            return 0
+        converted = 0
+        last_id = 0
+        while True:
+            rows = conn.execute('SELECT id, data FROM messages WHERE id > ? ORDER BY id LIMIT ?',
+                                (last_id, batch_size)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            updates, contacts = [], {}
+            for message_id, data in rows:
+                raw = decode_json(data)
+                if not is_legacy_message(raw):
+                    continue
+                for contact in legacy_message_contacts(raw):
+                    contacts[str(contact['id'])] = contact
+                record = MessageRecord.from_dict(raw)
+                updates.append((encode_message(record), record.sender_id, message_id))
+            if updates:
+                with conn:
+                    self._insert_missing_contacts(conn, contacts.values())
+                    conn.executemany('UPDATE messages SET data = ?, sender_id = ? WHERE id = ?', updates)
+                converted += len(updates)
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('messages_normalized', ?)",
+                         (datetime.datetime.utcnow().isoformat(),))
+        if converted:
+            # Recupera subito lo spazio occupato dai dizionari duplicati
+            conn.execute('VACUUM')
+        return converted
+
+    def _import_contacts(self, contacts):
+        for info in contacts.values():
+            self.upsert_contact(info)
+
+    def _import_images(self, images):
+        for image_id, image in images.items():
+            self.add_image(image_id, image)
+
+    def migrate_images_to_media(self, media):
+        """Sposta nel MediaStore le immagini ancora salvate in base64 nel database"""
+        conn = self._conn()
+        rows = conn.execute('SELECT id, data FROM images WHERE sha256 IS NULL').fetchall()
+        migrated = 0
+        for image_id, data in rows:
+            image = json.loads(data)
+            encoded = image.pop('base64', None)
+            if not encoded:
+                continue
+            img_bytes = base64.b64decode(encoded)
+            image['sha256'] = media.put(img_bytes)
+            image['size'] = len(img_bytes)
+            self.add_image(image_id, image)
+            migrated += 1
+        return migrated
+
+class MediaStore:
+    """Archivio su disco delle immagini, indirizzato per contenuto (SHA-256).
+
+    Ogni file si trova in media/<primi 2 caratteri dell'hash>/<hash>: la stessa
+    foto inoltrata in più chat viene quindi salvata una sola volta.
+    """
+
+    def __init__(self, root=MEDIA_DIR):
+        self.root = root
+
+    def path_for(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def exists(self, sha256):
+        return os.path.exists(self.path_for(sha256))
+
+    def put(self, data):
+        """Salva i byte (se non già presenti) e restituisce il loro SHA-256"""
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = self.path_for(sha256)
+        if not os.path.exists(path):
+            self._write_atomic(path, data)
+        return sha256
+
+    def thumbnail_path_for(self, sha256):
+        """La miniatura sta accanto all'originale: media/<xx>/<hash>.thumb"""
+        return self.path_for(sha256) + '.thumb'
+
+    def _write_atomic(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Scrittura atomica: un lettore non vede mai un file a metà
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def stage(self):
+        """Nuovo file temporaneo in cui scrivere un'immagine a pezzi (vedi StagedMedia)"""
+        return StagedMedia(self)
+
+    def remove_partial(self):
+        """Elimina i download interrotti rimasti nella radice; restituisce quanti ne ha rimossi"""
+        removed = 0
+        try:
+            filenames = os.listdir(self.root)
+        except FileNotFoundError:
+            return 0
+        for filename in filenames:
+            if filename.endswith(StagedMedia.SUFFIX):
+                try:
+                    os.remove(os.path.join(self.root, filename))
+                    removed += 1
+                except OSError:
+                    pass
+        return removed
+
+    def put_thumbnail(self, sha256, data):
+        self._write_atomic(self.thumbnail_path_for(sha256), data)
+
+    def has_thumbnail(self, sha256):
+        return os.path.exists(self.thumbnail_path_for(sha256))
+
+    def read(self, sha256):
+        return self._read(self.path_for(sha256))
+
+    def read_thumbnail(self, sha256):
+        return self._read(self.thumbnail_path_for(sha256))
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, sha256):
+        for path in (self.path_for(sha256), self.thumbnail_path_for(sha256)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+class StagedMedia:
+    """Immagine in arrivo, scritta a pezzi in un file temporaneo dell'archivio.
+
+    Si comporta come un file aperto in scrittura (download_media può scriverci
+    direttamente) e calcola lo SHA-256 mentre i pezzi arrivano, così l'immagine
+    non viene mai tenuta tutta in memoria. commit() la sposta atomicamente nella
+    posizione definitiva, o la scarta se lo stesso contenuto esiste già.
+    """
+
+    SUFFIX = '.part'
+
+    def __init__(self, media):
+        self.media = media
+        os.makedirs(media.root, exist_ok=True)
+        # Nella stessa radice dell'archivio: os.replace resta sullo stesso filesystem
+        fd, self.tmp_path = tempfile.mkstemp(dir=media.root, suffix=self.SUFFIX)
+        self._file = os.fdopen(fd, 'wb')
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, chunk):
+        self._file.write(chunk)
+        self._hash.update(chunk)
+        self.size += len(chunk)
+        return len(chunk)
+
+    def flush(self):
+        self._file.flush()
+
+    def commit(self):
+        """Chiude il file e lo sposta nell'archivio; restituisce lo SHA-256 (None se vuoto)"""
+        self._file.close()
+        if not self.size:
+            self.discard()
+            return None
+        sha256 = self._hash.hexdigest()
+        path = self.media.path_for(sha256)
+        try:
+            if os.path.exists(path):
+                os.remove(self.tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(self.tmp_path, path)
+        except Exception:
+            self.discard()
+            raise
+        return sha256
+
+    def discard(self):
+        """Chiude ed elimina il file temporaneo (download fallito)"""
+        self._file.close()
+        try:
+            os.remove(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+class LRUCache:
+    """Cache LRU thread-safe limitata dalla dimensione totale in byte, con contatori hit/miss"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()  # chiave -> (valore, dimensione)
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            if size > self.max_bytes:
+                # Un singolo elemento più grande dell'intera cache non viene memorizzato
+                return
+            self._items[key] = (value, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self._size -= evicted_size
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._items.pop(key, None)
+            if entry is not None:
+                self._size -= entry[1]
+                return entry[0]
+            return None
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._items),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / total if total else 0.0,
+            }
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+def marked_peer_id(info):
+    """Peer id nel formato di Telethon (event.sender_id/chat_id) a partire da un contatto salvato"""
+    try:
+        raw_id = int(info.get('id'))
+    except (TypeError, ValueError):
+        return None
+    contact_type = info.get('type')
+    if contact_type == 'channel':
+        return -(1000000000000 + raw_id)
+    if contact_type == 'group':
+        return -raw_id
+    if contact_type == 'user':
+        return raw_id
+    return None
+
+def peer_chat_id(peer_id):
+    """ID salvato (come nei contatti) di un peer id di Telethon; l'inverso di marked_peer_id"""
+    if peer_id is None:
+        return None
+    if peer_id <= -1000000000000:
+        return str(-peer_id - 1000000000000)
+    return str(abs(peer_id))
+
+def rule_chat_id(chat_id):
+    """Id salvato di una chat indicata nelle impostazioni (id salvato o peer id di Telethon).
+
+    Le regole e le impostazioni per chat confrontano sempre questa forma, come
+    message_chat_id() per i messaggi salvati; '*' e i valori non numerici
+    restano invariati.
+    """
+    try:
+        return peer_chat_id(int(chat_id))
+    except (TypeError, ValueError):
+        return str(chat_id)
+
+def is_channel_peer(peer_id):
+    return peer_id is not None and peer_id <= -1000000000000
+
+class MessageIndex:
+    """Indice in memoria dei messaggi acquisiti per (account, chat_id, message_id).
+
+    Rende idempotente l'acquisizione (un messaggio ripetuto dopo una riconnessione
+    o dal recupero non viene salvato due volte) e trova senza query il messaggio
+    a cui si riferiscono modifiche ed eliminazioni. Per ogni chiave conserva
+    PENDING finché il messaggio è in pipeline, poi il MessageRecord finché è in
+    scrittura (o attende la foto) e infine solo il suo id nell'archivio.
+    Oltre max_entries dimentica le chiavi usate meno di recente; l'archivio
+    (find_messages) viene interrogato solo per gli id non più recenti di
+    quelli che potrebbero mancare dalla memoria: gli ultimi salvati all'avvio
+    (chat_cursors) o quelli dimenticati. Va usato dal loop asyncio del listener.
+    """
+
+    PENDING = 'pending'
+
+    def __init__(self, backend, max_entries=MESSAGE_INDEX_MAX_ENTRIES):
+        self.backend = backend
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # chiave -> PENDING, MessageRecord o id nell'archivio
+        self._mailbox = {}  # (account, message_id) -> chiave, per le chat che non sono canali
+        self._in_flight = {}  # id(MessageRecord) -> chiave
+        self._thresholds = {}  # (account, chat_id) -> id oltre il quale un messaggio non in memoria è nuovo
+        self.duplicates = 0
+        self.lookups = 0
+
+    def load_cursors(self, account, cursors):
+        """Ultimi id salvati per chat (MessageStore.chat_cursors), letti all'avvio"""
+        for chat_id, last_id in cursors.items():
+            self._raise_threshold((account, chat_id), last_id)
+
+    def _raise_threshold(self, chat_key, message_id):
+        if message_id > self._thresholds.get(chat_key, 0):
+            self._thresholds[chat_key] = message_id
+
+    def get(self, key):
+        """PENDING, MessageRecord o id nell'archivio del messaggio, None se non è mai stato acquisito"""
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+            return value
+        account, chat_id, message_id = key
+        if message_id > self._thresholds.get((account, chat_id), 0):
+            # Più recente di tutto ciò che potrebbe mancare dalla memoria: è nuovo
+            return None
+        self.lookups += 1
+        for msg in self.backend.find_messages(account, message_id, chat_id):
+            self._remember(key, msg['id'])
+            return msg['id']
+        return None
+
+    def find_mailbox(self, account, message_id):
+        """Chiavi dei messaggi con questo id fuori dai canali (eliminazioni senza chat)"""
+        key = self._mailbox.get((account, message_id))
+        if key is not None:
+            return [key]
+        self.lookups += 1
+        keys = []
+        for msg in self.backend.find_messages(account, message_id):
+            key = (account, message_chat_id(msg), message_id)
+            self._remember(key, msg['id'], mailbox=True)
+            keys.append(key)
+        return keys
+
+    def reserve(self, key, mailbox=False):
+        """Segna un messaggio come acquisito appena entra nella pipeline"""
+        self._remember(key, self.PENDING, mailbox)
+
+    def release(self, key):
+        """Annulla la prenotazione di un messaggio uscito dalla pipeline senza essere creato.
+
+        Toglie solo le chiavi ancora PENDING: così una ripetizione o il recupero
+        possono acquisire di nuovo il messaggio.
+        """
+        if self._entries.get(key) != self.PENDING:
+            return
+        del self._entries[key]
+        if self._mailbox.get((key[0], key[2])) == key:
+            del self._mailbox[(key[0], key[2])]
+
+    def bind(self, key, msg):
+        """Collega alla chiave il MessageRecord appena creato"""
+        if key in self._entries:
+            self._entries[key] = msg
+            self._in_flight[id(msg)] = key
+
+    def settle(self, messages):
+        """Dopo il salvataggio (e l'eventuale foto) resta in memoria solo l'id del messaggio"""
+        for msg in messages:
+            if msg.get('media_pending') or msg.get('id') is None:
+                continue
+            key = self._in_flight.pop(id(msg), None)
+            if key is not None and self._entries.get(key) is msg:
+                self._entries[key] = msg['id']
+
+    def _remember(self, key, value, mailbox=False):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if mailbox:
+            self._mailbox[(key[0], key[2])] = key
+        while len(self._entries) > self.max_entries:
+            old_key, old_value = self._entries.popitem(last=False)
+            if isinstance(old_value, MessageRecord):
+                self._in_flight.pop(id(old_value), None)
+            if self._mailbox.get((old_key[0], old_key[2])) == old_key:
+                del self._mailbox[(old_key[0], old_key[2])]
+            # Da qui in giù la chiave potrebbe essere solo nell'archivio
+            self._raise_threshold((old_key[0], old_key[1]), old_key[2])
+
+    def stats(self):
+        return {'entries': len(self._entries), 'duplicates': self.duplicates, 'lookups': self.lookups}
+
+class EntityCache:
+    """Cache TTL/LRU delle informazioni su mittenti e chat, indicizzata per peer id.
+
+    get() risponde solo dalla memoria: una voce più vecchia di ttl viene
+    restituita lo stesso, ma finisce tra quelle da aggiornare che il listener
+    preleva con take_stale() e rinfresca in background. Oltre max_entries viene
+    scartata la voce usata meno di recente.
+    """
+
+    def __init__(self, max_entries=ENTITY_CACHE_MAX_ENTRIES, ttl=ENTITY_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._items = OrderedDict()  # peer id -> (info, istante dell'ultimo aggiornamento)
+        self._stale = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.refreshes = 0
+
+    def get(self, peer_id):
+        with self._lock:
+            entry = self._items.get(peer_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(peer_id)
+            self.hits += 1
+            if time.monotonic() - entry[1] > self.ttl:
+                self._stale[peer_id] = None
+            return entry[0]
+
+    def put(self, peer_id, info, fetched_at=None):
+        with self._lock:
+            self._items[peer_id] = (info, time.monotonic() if fetched_at is None else fetched_at)
+            self._items.move_to_end(peer_id)
+            self._stale.pop(peer_id, None)
+            while len(self._items) > self.max_entries:
+                evicted, _ = self._items.popitem(last=False)
+                self._stale.pop(evicted, None)
+                self.evictions += 1
+
+    def prewarm(self, contacts):
+        """Carica i contatti salvati, considerati da aggiornare al primo utilizzo"""
+        loaded = 0
+        for info in contacts:
+            peer_id = marked_peer_id(info)
+            if peer_id is not None:
+                self.put(peer_id, info, fetched_at=float('-inf'))
+                loaded += 1
+        return loaded
+
+    def take_stale(self, limit):
+        """Preleva fino a limit peer id da aggiornare"""
+        with self._lock:
+            peer_ids = []
+            while self._stale and len(peer_ids) < limit:
+                peer_id, _ = self._stale.popitem(last=False)
+                if peer_id in self._items:
+                    peer_ids.append(peer_id)
+            return peer_ids
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._items),
+                'stale': len(self._stale),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'refreshes': self.refreshes,
+                'hit_rate': self.hits / total if total else 0.0,
+            }
+
+    def __len__(self):
+        return len(self._items)
+
+def photo_size(photo):
+    """Dimensione in byte della versione più grande di una foto Telegram (0 se non nota)"""
+    size = 0
+    for variant in getattr(photo, 'sizes', None) or []:
+        # PhotoSize ha size, PhotoSizeProgressive la lista sizes, PhotoCachedSize i bytes
+        candidates = [getattr(variant, 'size', 0) or 0, len(getattr(variant, 'bytes', b'') or b'')]
+        candidates.extend(getattr(variant, 'sizes', None) or [])
+        size = max(size, *candidates)
+    return size
+
+class MediaScheduler:
+    """Coda dei download delle foto con limiti di concorrenza, priorità e regole di esclusione.
+
+    Partono al massimo 'ingest_download_workers' download alla volta e
+    'media_per_chat_limit' per chat; tra quelli in attesa viene scelto il più
+    piccolo (media_order 'smallest_first'), quello della chat con priorità più
+    alta in 'media_chat_priority' ('chat_priority') o il più vecchio ('fifo').
+    skip_reason() applica auto_save_images, 'media_skip_chats' e
+    'media_max_file_bytes'. Va usato dal loop asyncio del listener.
+    """
+
+    ORDERS = ('smallest_first', 'chat_priority', 'fifo')
+
+    def __init__(self, download, settings, max_pending=INGEST_QUEUE_SIZE, rate_window=60):
+        self.download = download  # coroutine(job) -> byte scaricati
+        self.configure(settings)
+        self._pending = []  # (chat_id, size, seq, accodato_alle, job)
+        self._running = 0
+        self._running_per_chat = {}
+        self._seq = itertools.count()
+        self._slots = asyncio.Semaphore(max_pending)
+        self._tasks = set()
+        self.rate_window = rate_window
+        self._recent = deque()  # (istante di fine, byte) per il calcolo dei byte/s
+        self.completed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.bytes = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def configure(self, settings):
+        """Applica le impostazioni (limiti, ordinamento, esclusioni) ai download successivi"""
+        self.enabled = bool(settings.get('auto_save_images', True))
+        self.max_concurrent = max(1, int(settings.get('ingest_download_workers') or 1))
+        self.per_chat_limit = max(1, int(settings.get('media_per_chat_limit') or 1))
+        order = settings.get('media_order') or 'smallest_first'
+        self.order = order if order in self.ORDERS else 'smallest_first'
+        # Le chat possono essere indicate anche con il peer id di Telethon (es. -100... per i canali)
+        self.chat_priority = {rule_chat_id(chat_id): priority
+                              for chat_id, priority in (settings.get('media_chat_priority') or {}).items()}
+        self.max_file_bytes = int(settings.get('media_max_file_bytes') or 0)
+        self.skip_chats = {rule_chat_id(chat_id) for chat_id in settings.get('media_skip_chats') or []}
+
+    def skip_reason(self, chat_id, size):
+        """Motivo per non scaricare una foto, oppure None"""
+        if not self.enabled:
+            return 'salvataggio immagini disattivato'
+        if chat_id in self.skip_chats:
+            return 'chat esclusa'
+        if self.max_file_bytes and size > self.max_file_bytes:
+            return f'oltre {self.max_file_bytes} byte'
+        return None
+
+    async def submit(self, chat_id, size, job):
+        """Accoda un download (attende se la coda è piena)"""
+        await self._slots.acquire()
+        self._pending.append((chat_id, size or 0, next(self._seq), time.monotonic(), job))
+        self._dispatch()
+
+    def _key(self, entry):
+        chat_id, size, seq, _, _ = entry
+        if self.order == 'smallest_first':
+            return (size, seq)
+        if self.order == 'chat_priority':
+            return (-self.chat_priority.get(chat_id, 0), seq)
+        return (seq,)
+
+    def _dispatch(self):
+        """Avvia i download in attesa finché i limiti lo consentono"""
+        while self._running < self.max_concurrent and self._pending:
+            eligible = [entry for entry in self._pending
+                        if self._running_per_chat.get(entry[0], 0) < self.per_chat_limit]
+            if not eligible:
+                return
+            entry = min(eligible, key=self._key)
+            self._pending.remove(entry)
+            self._slots.release()
+            chat_id = entry[0]
+            self._running += 1
+            self._running_per_chat[chat_id] = self._running_per_chat.get(chat_id, 0) + 1
+            wait = time.monotonic() - entry[3]
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            task = asyncio.ensure_future(self._run(chat_id, entry[4]))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, chat_id, job):
+        try:
+            downloaded = await self.download(job)
+            self.completed += 1
+            self.bytes += downloaded or 0
+            self._recent.append((time.monotonic(), downloaded or 0))
+        except Exception as e:
+            self.failed += 1
+            print(f"Errore nel download della foto: {e}")
+        finally:
+            self._running -= 1
+            if self._running_per_chat.get(chat_id, 0) <= 1:
+                self._running_per_chat.pop(chat_id, None)
+            else:
+                self._running_per_chat[chat_id] -= 1
+            self._dispatch()
+
+    async def join(self):
+        """Attende la fine dei download in attesa e in corso"""
+        while self._tasks:
+            # Un download che termina avvia i successivi prima di uscire da _tasks
+            await asyncio.wait(list(self._tasks))
+
+    def cancel(self):
+        for task in list(self._tasks):
+            task.cancel()
+
+    def stats(self):
+        now = time.monotonic()
+        while self._recent and now - self._recent[0][0] > self.rate_window:
+            self._recent.popleft()
+        started = self.completed + self.failed + self._running
+        return {
+            'pending': len(self._pending),
+            'running': self._running,
+            'completed': self.completed,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'bytes': self.bytes,
+            'bytes_per_sec': sum(size for _, size in self._recent) / self.rate_window,
+            'avg_wait': self.wait_total / started if started else 0.0,
+            'max_wait': self.wait_max,
+        }
+
+class IngestRules:
+    """Regole di acquisizione valutate su ogni messaggio prima di qualunque chiamata di rete.
+
+    Le impostazioni 'filter_*' di settings.json vengono compilate una sola volta
+    da configure(): le liste di chat diventano set, parole chiave ed espressioni
+    regolari un'unica regex (senza distinzione tra maiuscole e minuscole), così
+    check() costa pochi microsecondi e un messaggio scartato non arriva mai a
+    get_sender() né a download_media(). Nell'ordine:
+    - 'filter_allow_chats' (se non vuota, solo queste chat) e 'filter_deny_chats';
+    - 'filter_drop_media': tipi di media (MEDIA_TYPES) da scartare, es. 'sticker';
+    - 'filter_keep_*' (se presenti, il testo deve corrispondere) e 'filter_drop_*';
+    - 'filter_chat_sample': {chat: frazione da tenere}, con scelta deterministica per id;
+    - 'filter_chat_rate': {chat: messaggi al minuto}, solo per i messaggi in diretta.
+    Le chat si indicano con l'id salvato o con il peer id di Telethon: entrambi
+    vengono ricondotti all'id salvato (rule_chat_id), la stessa forma usata da
+    MediaScheduler. '*' nei dizionari vale per tutte le chat non elencate.
+    """
+
+    MEDIA_TYPES = ('photo', 'video', 'document', 'sticker', 'voice', 'audio', 'gif', 'video_note',
+                   'poll', 'geo', 'contact', 'dice', 'web_preview')
+
+    def __init__(self, settings):
+        self.dropped = {}
+        self._buckets = {}
+        self.configure(settings)
+
+    def configure(self, settings):
+        """Compila le regole; quelle non valide vengono ignorate con un avviso"""
+        self.allow_chats = {rule_chat_id(chat_id) for chat_id in settings.get('filter_allow_chats') or []}
+        self.deny_chats = {rule_chat_id(chat_id) for chat_id in settings.get('filter_deny_chats') or []}
+        self.drop_media = []
+        for media_type in settings.get('filter_drop_media') or []:
+            if media_type in self.MEDIA_TYPES:
+                self.drop_media.append(media_type)
+            else:
+                print(f"Tipo di media sconosciuto nelle regole: {media_type}")
+        self.keep_text = self._compile(settings.get('filter_keep_patterns'), settings.get('filter_keep_keywords'))
+        self.drop_text = self._compile(settings.get('filter_drop_patterns'), settings.get('filter_drop_keywords'))
+        self.sample = self._chat_numbers(settings.get('filter_chat_sample'))
+        self.rate = self._chat_numbers(settings.get('filter_chat_rate'))
+        self._buckets.clear()
+        self.active = bool(self.allow_chats or self.deny_chats or self.drop_media or self.keep_text
+                           or self.drop_text or self.sample or self.rate)
+
+    @staticmethod
+    def _compile(patterns, keywords):
+        parts = []
+        for pattern in patterns or []:
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                print(f"Espressione non valida nelle regole ({pattern!r}): {e}")
+                continue
+            parts.append(f'(?:{pattern})')
+        parts.extend(re.escape(keyword) for keyword in keywords or [] if keyword)
+        return re.compile('|'.join(parts), re.IGNORECASE) if parts else None
+
+    @staticmethod
+    def _chat_numbers(values):
+        numbers = {}
+        for chat_id, value in (values or {}).items():
+            try:
+                numbers[rule_chat_id(chat_id)] = float(value)
+            except (TypeError, ValueError):
+                print(f"Valore non valido nelle regole per la chat {chat_id}: {value}")
+        return numbers
+
+    @staticmethod
+    def _chat_value(values, chat_key):
+        value = values.get(chat_key)
+        return value if value is not None else values.get('*')
+
+    def check(self, message, live=True):
+        """Motivo per cui il messaggio va scartato ('chat', 'media', 'testo', ...), None se va acquisito"""
+        if not self.active:
+            return None
+        reason = self._reason(message, live)
+        if reason is not None:
+            self.dropped[reason] = self.dropped.get(reason, 0) + 1
+        return reason
+
+    def _reason(self, message, live):
+        chat_key = peer_chat_id(message.chat_id)
+        if chat_key in self.deny_chats:
+            return 'chat'
+        if self.allow_chats and chat_key not in self.allow_chats:
+            return 'chat'
+        for media_type in self.drop_media:
+            if getattr(message, media_type, None):
+                return 'media'
+        if self.keep_text is not None or self.drop_text is not None:
+            text = message.raw_text or ''
+            if self.keep_text is not None and not self.keep_text.search(text):
+                return 'testo'
+            if self.drop_text is not None and self.drop_text.search(text):
+                return 'testo'
+        if self.sample:
+            fraction = self._chat_value(self.sample, chat_key)
+            # Hash moltiplicativo dell'id: un nuovo recupero sceglie gli stessi messaggi
+            if fraction is not None and (message.id * 2654435761) % 4294967296 >= fraction * 4294967296:
+                return 'campionamento'
+        if self.rate and live:
+            per_minute = self._chat_value(self.rate, chat_key)
+            if per_minute is not None and not self._take(chat_key, per_minute):
+                return 'limite'
+        return None
+
+    def _take(self, chat_key, per_minute):
+        """Token bucket per chat: al massimo per_minute messaggi al minuto, con raffiche fino a per_minute"""
+        now = time.monotonic()
+        tokens, last = self._buckets.get(chat_key, (per_minute, now))
+        tokens = min(per_minute, tokens + (now - last) * per_minute / 60)
+        if tokens < 1:
+            self._buckets[chat_key] = (tokens, now)
+            return False
+        self._buckets[chat_key] = (tokens - 1, now)
+        return True
+
+    def stats(self):
+        return {'dropped': sum(self.dropped.values()), 'by_reason': dict(self.dropped)}
+
+class StorageWriter(threading.Thread):
+    """Thread di scrittura write-behind con group commit.
+
+    Il listener accoda messaggi, contatti e immagini senza mai toccare il disco;
+    il thread raccoglie tutto ciò che arriva in WRITER_FLUSH_INTERVAL secondi
+    (o al massimo WRITER_MAX_BATCH record) e lo scrive con un'unica transazione.
+    on_commit(messaggi) viene chiamato dopo ogni commit riuscito, on_update(messaggi)
+    per i messaggi già salvati a cui è stata agganciata una foto o che sono stati
+    modificati. Se backend è un
+    archivio diverso da store, i messaggi vanno lì e contatti e immagini restano
+    nel database.
+
+    Una scrittura fallita viene ritentata dopo le attese di WRITER_RETRY_DELAYS;
+    se fallisce ancora il gruppo resta in memoria (pending) e viene ritentato,
+    prima di tutto il resto per non invertire l'ordine, al commit successivo.
+    flush() e stop() restituiscono False finché ci sono modifiche non scritte.
+    """
+
+    _STOP = ('stop',)
+
+    def __init__(self, store, media, thumbnailer=None, on_commit=None, backend=None, on_update=None,
+                 flush_interval=WRITER_FLUSH_INTERVAL, max_batch=WRITER_MAX_BATCH):
+        super().__init__(name='StorageWriter', daemon=True)
+        self.store = store
+        self.backend = backend if backend is not None else store
+        self.media = media
+        self.thumbnailer = thumbnailer
+        self.on_commit = on_commit
+        self.on_update = on_update
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._pending = []
+        self.batches = 0
+        self.records = 0
+        self.failures = 0
+        self.last_error = None
+
+    def add_message(self, msg):
+        self._queue.put(('message', msg))
+
+    def add_contact(self, info):
+        self._queue.put(('contact', info))
+
+    def add_image(self, image_id, img_bytes, image):
+        """Accoda un'immagine: byte e miniatura vengono scritti dal thread di scrittura"""
+        self._queue.put(('image', image_id, img_bytes, image))
+
+    def update_message(self, msg):
+        """Accoda la riscrittura di un messaggio già accodato o salvato (es. testo modificato)"""
+        self._queue.put(('update', msg))
+
+    def attach_images(self, msg, media, image):
+        """Accoda le foto di un messaggio già accodato e lo aggiorna con una sola scrittura.
+
+        media è una lista di (image_id, sha256, size), più voci per un album.
+        I file sono già nell'archivio media (vedi StagedMedia): qui si registrano
+        solo metadati e miniature. Le voci con sha256 None (download fallito)
+        vengono saltate; senza foto il messaggio viene solo segnato come non
+        più in attesa.
+        """
+        self._queue.put(('attach', msg, media, image))
+
+    def queue_depth(self):
+        """Numero di modifiche in attesa di essere scritte"""
+        return self._queue.qsize() + sum(len(write['ops']) for write in self._pending)
+
+    def flush(self, timeout=None):
+        """Attende che tutto ciò che è stato accodato finora sia su disco.
+
+        Restituisce False se il tempo scade o se qualche scrittura è fallita
+        (le modifiche restano in attesa, vedi last_error).
+        """
+        if not self.is_alive():
+            return not self._pending
+        done = threading.Event()
+        result = []
+        self._queue.put(('flush', done, result))
+        return done.wait(timeout) and result == [True]
+
+    def stop(self, timeout=10):
+        """Scrive le modifiche in sospeso e termina il thread.
+
+        Restituisce False se alcune modifiche non sono state scritte.
+        """
+        if self.is_alive():
+            self._queue.put(self._STOP)
+            self.join(timeout)
+        if self.is_alive() or self.queue_depth():
+            lost = self.queue_depth()
+            print(f"Errore: {lost} modifiche non salvate alla chiusura ({self.last_error})")
+            return False
+        return True
+
+    def run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while batch[-1][0] not in ('flush', 'stop') and len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            if batch[-1] is self._STOP:
+                # Ciò che è stato accodato dopo lo stop viene scritto con l'ultimo gruppo
+                while True:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                self._commit(batch)
+                return
+            self._commit(batch)
+
+    def _commit(self, batch):
+        waiters = [op[1:] for op in batch if op[0] == 'flush']
+        ops = [op for op in batch if op[0] not in ('flush', 'stop')]
+        if ops:
+            self._pending.append(self._prepare(ops))
+        # Prima i gruppi falliti in precedenza: ci si ferma al primo che fallisce ancora
+        while self._pending and self._write(self._pending[0]):
+            self._pending.pop(0)
+        for done, result in waiters:
+            result.append(not self._pending)
+            done.set()
+
+    def _prepare(self, ops):
+        """Raggruppa le operazioni accodate nei passi di scrittura di un'unica transazione"""
+        messages, contacts, images, updates = [], [], [], []
+        for op in ops:
+            kind = op[0]
+            if kind == 'message':
+                messages.append(op[1])
+            elif kind == 'contact':
+                contacts.append(op[1])
+            elif kind == 'image':
+                image = self._store_image_bytes(*op[1:])
+                if image:
+                    images.append(image)
+            elif kind == 'attach':
+                msg, media, image = op[1:]
+                image_ids = []
+                for image_id, sha256, size in media:
+                    registered = self._register_image(image_id, sha256, size, image) if sha256 else None
+                    if registered:
+                        images.append(registered)
+                        image_ids.append(image_id)
+                msg.image_id = image_ids[0] if image_ids else None
+                msg.image_ids = image_ids if len(image_ids) > 1 else None
+                msg.pop('media_pending')
+                updates.append(msg)
+            elif kind == 'update':
+                updates.append(op[1])
+        steps = []
+        if self.backend is not self.store:
+            # Prima contatti e immagini, così un messaggio non punta mai a un'immagine mancante
+            if contacts or images:
+                steps.append(lambda: self.store.apply_batch(contacts=contacts, images=images))
+            if messages:
+                steps.append(lambda: self.backend.append_many(messages))
+                # Gli ultimi id visti avanzano solo con i messaggi già nell'archivio: se la
+                # scrittura fallisce il recupero all'avvio riparte da quelli salvati davvero
+                steps.append(lambda: self.store.apply_batch(cursors=messages))
+            if updates:
+                steps.append(lambda: self.backend.update_messages(updates))
+        elif messages or contacts or images or updates:
+            steps.append(lambda: self.store.apply_batch(messages=messages, contacts=contacts,
+                                                        images=images, updates=updates))
+        return {'ops': ops, 'steps': steps, 'messages': messages, 'updates': updates,
+                'records': len(messages) + len(contacts) + len(images) + len(updates)}
+
+    def _write(self, write):
+        """Esegue i passi di un gruppo ritentando con attese crescenti; True se è su disco.
+
+        I passi riusciti vengono tolti dal gruppo, così un nuovo tentativo non
+        riscrive ciò che è già stato salvato in un altro archivio.
+        """
+        for delay in WRITER_RETRY_DELAYS + (None,):
+            try:
+                while write['steps']:
+                    write['steps'][0]()
+                    write['steps'].pop(0)
+                break
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                print(f"Errore nel salvataggio di {len(write['ops'])} modifiche: {e}")
+                if delay is None:
+                    return False
+                time.sleep(delay)
+        if write['records']:
+            self.batches += 1
+            self.records += write['records']
+            try:
+                if self.on_commit and write['messages']:
+                    self.on_commit(write['messages'])
+                if self.on_update and write['updates']:
+                    self.on_update(write['updates'])
+            except Exception as e:
+                print(f"Errore nella notifica delle modifiche salvate: {e}")
+        return True
+
+    def _store_image_bytes(self, image_id, img_bytes, image):
+        try:
+            sha256 = self.media.put(img_bytes)
+        except Exception as e:
+            print(f"Errore nel salvataggio dell'immagine {image_id}: {e}")
+            return None
+        return self._register_image(image_id, sha256, len(img_bytes), image)
+
+    def _register_image(self, image_id, sha256, size, image):
+        """Metadati di un'immagine già nell'archivio media, generando la miniatura se manca"""
+        try:
+            if self.thumbnailer and not self.media.has_thumbnail(sha256):
+                # Miniatura generata una sola volta (leggendo il file), così le righe non decodificano l'originale
+                thumbnail = self.thumbnailer(self.media.path_for(sha256))
+                if thumbnail:
+                    self.media.put_thumbnail(sha256, thumbnail)
+        except Exception as e:
+            print(f"Errore nella miniatura dell'immagine {image_id}: {e}")
+        return (image_id, dict(image, sha256=sha256, size=size))
+
+class ContactRegistry:
+    """Mappa autorevole dei contatti in memoria, caricata una sola volta dall'archivio.
+
+    update() confronta i dati estratti con quelli già noti e restituisce il
+    contatto aggiornato solo se qualcosa è cambiato: i contatti invariati non
+    generano scritture.
+    """
+
+    def __init__(self, store):
+        self._lock = threading.Lock()
+        self._contacts = store.contacts()
+
+    def update(self, info):
+        """Unisce info al contatto esistente; restituisce il contatto se è cambiato, altrimenti None"""
+        cid = str(info.get('id', ''))
+        if not cid:
+            return None
+        with self._lock:
+            current = self._contacts.get(cid)
+            if current is not None and all(current.get(k) == v for k, v in info.items()):
+                return None
+            merged = dict(current or {})
+            merged.update(info)
+            self._contacts[cid] = merged
+            return dict(merged)
+
+    def get(self, contact_id):
+        with self._lock:
+            contact = self._contacts.get(str(contact_id))
+            return dict(contact) if contact is not None else None
+
+    def all(self):
+        """Copia di tutti i contatti come dizionario {id: info}"""
+        with self._lock:
+            return {cid: dict(info) for cid, info in self._contacts.items()}
+
+    def __len__(self):
+        return len(self._contacts)
+
+class MessageArchive:
+    """Cronologia fredda in segmenti settimanali compressi (JSON Lines + gzip).
+
+    Un segmento contiene i messaggi di una settimana ISO conclusa e non viene più
+    modificato. archive/manifest.json riporta per ogni segmento l'intervallo di
+    received_at, le chat presenti e il numero di messaggi, così le letture per
+    chat o per periodo aprono solo i segmenti pertinenti.
+    """
+
+    def __init__(self, root=ARCHIVE_DIR):
+        self.root = root
+        self.manifest_path = os.path.join(root, 'manifest.json')
+        self._lock = threading.Lock()
+        self._manifest = None
+
+    # --- Manifest ---
+
+    def manifest(self):
+        """Copia del manifest {nome segmento: info}"""
+        with self._lock:
+            return dict(self._load_manifest())
+
+    def _load_manifest(self):
+        if self._manifest is None:
+            self._manifest = {}
+            if os.path.exists(self.manifest_path):
+                try:
+                    with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                        self._manifest = json.load(f)
+                except Exception as e:
+                    print(f"Errore nel caricamento di {self.manifest_path}: {e}")
+        return self._manifest
+
+    def _save_manifest(self):
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    @staticmethod
+    def week_of(received_at):
+        """Settimana ISO ('2025-W31') di un timestamp received_at"""
+        year, week, _ = datetime.datetime.fromisoformat(received_at[:19]).isocalendar()
+        return f'{year}-W{week:02d}'
+
+    def _segment_path(self, name):
+        return os.path.join(self.root, name + '.jsonl.gz')
+
+    def _new_segment_name(self, week):
+        name = f'messages-{week}'
+        suffix = 1
+        while name in self._load_manifest() or os.path.exists(self._segment_path(name)):
+            suffix += 1
+            name = f'messages-{week}-{suffix}'
+        return name
+
+    # --- Scrittura ---
+
+    def archive_from(self, store, before):
+        """Sposta nei segmenti i messaggi delle settimane concluse prima di 'before' (datetime)"""
+        with self._lock:
+            self._recover(store)
+            week_start = (before - datetime.timedelta(days=before.weekday())).date()
+            cutoff = datetime.datetime.combine(week_start, datetime.time()).isoformat()
+            segment = None
+            archived = 0
+            after = None
+            while True:
+                rows = store.message_rows_before(cutoff, after=after)
+                if not rows:
+                    break
+                for row_id, received_at, chat_id, image_id, data in rows:
+                    week = self.week_of(received_at)
+                    if segment is not None and segment['week'] != week:
+                        archived += self._close_segment(store, segment)
+                        segment = None
+                    if segment is None:
+                        segment = self._open_segment(week)
+                    segment['file'].write(data + '\n')
+                    segment['ids'].append(row_id)
+                    if image_id:
+                        segment['image_ids'].append(image_id)
+                    if chat_id:
+                        segment['chat_ids'].add(chat_id)
+                    segment['start'] = segment['start'] or received_at
+                    segment['end'] = received_at
+                after = (rows[-1][1], rows[-1][0])
+            if segment is not None:
+                archived += self._close_segment(store, segment)
+            return archived
+
+    def _open_segment(self, week):
+        os.makedirs(self.root, exist_ok=True)
+        name = self._new_segment_name(week)
+        tmp_path = self._segment_path(name) + '.tmp'
+        return {'name': name, 'week': week, 'tmp_path': tmp_path,
+                'file': gzip.open(tmp_path, 'wt', encoding='utf-8'),
+                'ids': [], 'image_ids': [], 'chat_ids': set(), 'start': None, 'end': None}
+
+    def _close_segment(self, store, segment):
+        segment['file'].close()
+        with open(segment['tmp_path'], 'rb') as f:
+            os.fsync(f.fileno())
+        # Prima i messaggi escono dal database (segmento 'in sospeso'), poi il file
+        # diventa definitivo: un'interruzione a metà viene completata da _recover()
+        store.move_to_archive(segment['name'], segment['ids'], segment['image_ids'])
+        os.replace(segment['tmp_path'], self._segment_path(segment['name']))
+        self._load_manifest()[segment['name']] = {
+            'start': segment['start'],
+            'end': segment['end'],
+            'chat_ids': sorted(segment['chat_ids']),
+            'count': len(segment['ids'])
+        }
+        self._save_manifest()
+        store.delete_meta('archive_pending')
+        return len(segment['ids'])
+
+    def _recover(self, store):
+        """Completa un'archiviazione interrotta e rimuove i file temporanei orfani"""
+        manifest = self._load_manifest()
+        pending = store.get_meta('archive_pending')
+        if pending:
+            path = self._segment_path(pending)
+            if os.path.exists(path + '.tmp'):
+                os.replace(path + '.tmp', path)
+            if os.path.exists(path) and pending not in manifest:
+                manifest[pending] = self._scan_segment(path)
+                self._save_manifest()
+            store.delete_meta('archive_pending')
+        if os.path.isdir(self.root):
+            for filename in os.listdir(self.root):
+                if filename.endswith('.jsonl.gz.tmp'):
+                    # I messaggi di questo file sono ancora nel database
+                    os.remove(os.path.join(self.root, filename))
+
+    def _scan_segment(self, path):
+        info = {'start': None, 'end': None, 'chat_ids': set(), 'count': 0}
+        for msg in self._iter_segment(path):
+            received_at = msg.get('received_at')
+            info['start'] = info['start'] or received_at
+            info['end'] = received_at or info['end']
+            if message_chat_id(msg):
+                info['chat_ids'].add(message_chat_id(msg))
+            info['count'] += 1
+        info['chat_ids'] = sorted(info['chat_ids'])
+        return info
+
+    def drop_older_than(self, store, older_than):
+        """Elimina i segmenti interamente precedenti a older_than; restituisce quanti"""
+        with self._lock:
+            manifest = self._load_manifest()
+            expired = [name for name, info in manifest.items() if info.get('end') and info['end'] < older_than]
+            for name in expired:
+                try:
+                    os.remove(self._segment_path(name))
+                except FileNotFoundError:
+                    pass
+                del manifest[name]
+            if expired:
+                self._save_manifest()
+                store.drop_archive_refs(expired)
+            return len(expired)
+
+    def clear(self):
+        """Elimina tutti i segmenti (usato da 'Elimina Cronologia')"""
+        with self._lock:
+            for name in list(self._load_manifest()):
+                try:
+                    os.remove(self._segment_path(name))
+                except FileNotFoundError:
+                    pass
+            self._manifest = {}
+            self._save_manifest()
+
+    # --- Lettura ---
+
+    def segments(self, chat_id=None, start=None, end=None):
+        """Nomi dei segmenti che possono contenere messaggi della chat e del periodo indicati"""
+        result = []
+        for name, info in sorted(self.manifest().items(), key=lambda item: item[1].get('start') or ''):
+            if chat_id is not None and chat_id not in info.get('chat_ids', []):
+                continue
+            if start is not None and (info.get('end') or '') < start:
+                continue
+            if end is not None and (info.get('start') or '') > end:
+                continue
+            result.append(name)
+        return result
+
+    def iter_messages(self, chat_id=None, start=None, end=None):
+        """Messaggi archiviati in ordine di arrivo, aprendo solo i segmenti pertinenti"""
+        for name in self.segments(chat_id, start, end):
+            for msg in self._iter_segment(self._segment_path(name)):
+                if chat_id is not None and message_chat_id(msg) != chat_id:
+                    continue
+                received_at = msg.get('received_at') or ''
+                if (start is not None and received_at < start) or (end is not None and received_at > end):
+                    continue
+                yield msg
+
+    def chat_ids(self):
+        ids = set()
+        for info in self.manifest().values():
+            ids.update(info.get('chat_ids', []))
+        return ids
+
+    def _iter_segment(self, path):
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        yield decode_message(line)
+        except (OSError, EOFError) as e:
+            print(f"Errore nella lettura del segmento {path}: {e}")
+
+class RetentionEngine(threading.Thread):
+    """Applica in background i limiti di conservazione di settings.json.
+
+    Per prima cosa i messaggi più vecchi di archive_after_days vengono spostati
+    nei segmenti compressi di MessageArchive. Poi max_messages limita il numero
+    di messaggi nel database (globalmente o per chat, secondo retention_scope) e
+    max_message_age_days la loro età, anche nell'archivio. Le immagini non più
+    referenziate vengono eliminate insieme ai file in media/. Le eliminazioni
+    avvengono a blocchi, quindi l'acquisizione non si ferma.
+    """
+
+    def __init__(self, store, media, archive=None, interval=RETENTION_INTERVAL,
+                 initial_delay=RETENTION_INITIAL_DELAY, on_done=None, backend=None):
+        super().__init__(name='RetentionEngine', daemon=True)
+        self.store = store
+        self.backend = backend if backend is not None else store
+        self.media = media
+        self.archive = archive
+        self.interval = interval
+        self.initial_delay = initial_delay
+        self.on_done = on_done
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self.last_result = None
+
+    def trigger(self):
+        """Esegue subito un passaggio (es. dopo il salvataggio delle impostazioni)"""
+        self._wake.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+
+    def run(self):
+        delay = self.initial_delay
+        while True:
+            self._wake.wait(delay)
+            self._wake.clear()
+            if self._stopped.is_set():
+                break
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Errore nella pulizia della cronologia: {e}")
+            delay = self.interval
+        self.store.close()
+
+    def run_once(self, settings=None):
+        settings = settings or load_settings()
+        now = datetime.datetime.utcnow()
+        archived = 0
+        archive_after_days = settings.get('archive_after_days') or 0
+        # L'archivio sposta le righe con transazioni SQLite: solo con il backend del database
+        if self.archive is not None and archive_after_days > 0 and self.backend is self.store:
+            archived = self.archive.archive_from(self.store, now - datetime.timedelta(days=archive_after_days))
+
+        max_age_days = settings.get('max_message_age_days') or 0
+        older_than = (now - datetime.timedelta(days=max_age_days)).isoformat() if max_age_days > 0 else None
+        expired = self.backend.expired_message_ids(
+            max_count=settings.get('max_messages') or None,
+            per_chat=settings.get('retention_scope') == 'per_chat',
+            older_than=older_than)
+        self.backend.delete_messages(expired)
+        dropped_segments = 0
+        if self.archive is not None and older_than:
+            dropped_segments = self.archive.drop_older_than(self.store, older_than)
+
+        # Le immagini appena salvate potrebbero non avere ancora il loro messaggio su disco
+        grace = (now - datetime.timedelta(seconds=RETENTION_IMAGE_GRACE)).isoformat()
+        orphans = self.store.unreferenced_images(grace)
+        if self.backend is not self.store:
+            # I messaggi non sono nel database: escludi le immagini ancora usate nel backend
+            in_use = self.backend.image_ids()
+            orphans = [(image_id, sha256) for image_id, sha256 in orphans if image_id not in in_use]
+        self.store.delete_images([image_id for image_id, _ in orphans])
+        removed_files = 0
+        for sha256 in {sha256 for _, sha256 in orphans if sha256}:
+            if not self.store.sha256_in_use(sha256):
+                self.media.delete(sha256)
+                removed_files += 1
+
+        self.last_result = {'archived': archived, 'messages': len(expired), 'segments': dropped_segments,
+                            'images': len(orphans), 'files': removed_files,
+                            'finished_at': datetime.datetime.utcnow().isoformat()}
+        if archived:
+            print(f"Archivio: {archived} messaggi spostati in {ARCHIVE_DIR}/")
+        if expired or dropped_segments or orphans:
+            print(f"Conservazione: eliminati {len(expired)} messaggi, {dropped_segments} segmenti, "
+                  f"{len(orphans)} immagini, {removed_files} file")
+        if self.on_done:
+            self.on_done(self.last_result)
+        return self.last_result
+
+# Backend selezionabili con 'storage_backend' in settings.json
+STORAGE_BACKENDS = {
+    'sqlite': MessageStore,
+    'jsonl': JsonlMessageBackend,
+    'json': JsonMessageBackend,
+}
+
+def benchmark_storage_backends(count=20000, batch_size=WRITER_MAX_BATCH, chats=50):
+    """Confronta i backend su messaggi sintetici in una cartella temporanea.
+
+    Misura scrittura a blocchi (come il thread di scrittura), riapertura,
+    lettura completa, letture per chat e per intervallo di tempo, accesso per id
+    e dimensione su disco. Restituisce {backend: {misura: valore}}.
+    """
+    rng = random.Random(0)
+    start = datetime.datetime(2024, 1, 1)
+    words = ['ciao', 'prezzo', 'offerta', 'euro', 'dollaro', 'segnale', 'buy', 'sell', 'stop', 'target']
+    messages = []
+    for i in range(count):
+        chat_id = str(1000 + i % chats)
+        sender_id = str(5000 + rng.randrange(200))
+        received_at = (start + datetime.timedelta(seconds=i)).isoformat()
+        messages.append(MessageRecord(sender_id=sender_id, chat_id=chat_id,
+                                      text=' '.join(rng.choice(words) for _ in range(12)),
+                                      date=received_at, received_at=received_at, message_id=i + 1))
+    recent = (start + datetime.timedelta(seconds=count * 9 // 10)).isoformat()
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, backend_class in STORAGE_BACKENDS.items():
+            directory = os.path.join(tmp, name)
+            os.makedirs(directory)
+            path = os.path.join(directory, 'messages')
+            timings = {}
+            backend = backend_class(path)
+            began = time.perf_counter()
+            for offset in range(0, count, batch_size):
+                backend.append_many([MessageRecord.from_dict(msg.to_dict()) for msg in messages[offset:offset + batch_size]])
+            timings['append_s'] = time.perf_counter() - began
+            backend.close()
+
+            began = time.perf_counter()
+            backend = backend_class(path)
+            timings['open_s'] = time.perf_counter() - began
+            began = time.perf_counter()
+            total = sum(1 for _ in backend)
+            timings['iterate_s'] = time.perf_counter() - began
+            began = time.perf_counter()
+            for _ in backend.range_by_chat('1000'):
+                pass
+            timings['range_by_chat_s'] = time.perf_counter() - began
+            began = time.perf_counter()
+            for _ in backend.range_by_time(recent):
+                pass
+            timings['range_by_time_s'] = time.perf_counter() - began
+            began = time.perf_counter()
+            for message_id in rng.sample(range(1, total + 1), min(1000, total)):
+                backend.get(message_id)
+            timings['get_1000_s'] = time.perf_counter() - began
+            backend.close()
+            timings['size_bytes'] = sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory))
+            results[name] = timings
+    return results
+
+def print_storage_benchmark(results):
+    columns = ['append_s', 'open_s', 'iterate_s', 'range_by_chat_s', 'range_by_time_s', 'get_1000_s', 'size_bytes']
+    print('backend  ' + ''.join(f'{column:>16}' for column in columns))
+    for name, timings in results.items():
+        cells = ''.join(f'{timings[column]:>16.4f}' if column != 'size_bytes' else f'{timings[column]:>16,}'
+                        for column in columns)
+        print(f'{name:<9}{cells}')
+
+def pillow_thumbnail(source, size=THUMBNAIL_SIZE):
+    """Miniatura JPEG (lato massimo 'size' pixel) generata con Pillow, senza Qt.
+
+    È il thumbnailer del demone; come make_thumbnail della GUI accetta il
+    percorso del file o i suoi byte. Restituisce None se Pillow non è
+    installato o se l'immagine non è decodificabile.
+    """
+    if Image is None:
+        return None
+    try:
+        with Image.open(source if isinstance(source, str) else io.BytesIO(source)) as image:
+            # Con i JPEG decodifica direttamente a risoluzione ridotta
+            image.draft('RGB', (size, size))
+            image.thumbnail((size, size))
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            output = io.BytesIO()
+            image.save(output, 'JPEG', quality=85)
+            return output.getvalue()
+    except Exception:
+        return None
+
+def read_image_bytes(image):
+    """Byte originali di un'immagine a partire dai suoi metadati"""
+    if not image:
+        return None
+    if image.get('sha256'):
+        return get_media_store().read(image['sha256'])
+    if image.get('base64'):
+        # Record non ancora migrato nel MediaStore
+        return base64.b64decode(image['base64'])
+    return None
+
+_store = None
+_message_backend = None
+_media_store = None
+_contact_registry = None
+_archive = None
+_store_lock = threading.Lock()
+
+def get_store():
+    """Istanza condivisa di MessageStore (aperta al primo utilizzo)"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = MessageStore()
+        return _store
+
+def get_message_backend():
+    """Archivio dei messaggi scelto con 'storage_backend' in settings.json (il database se non indicato)"""
+    global _message_backend
+    store = get_store()
+    with _store_lock:
+        if _message_backend is None:
+            name = load_settings().get('storage_backend') or 'sqlite'
+            if name not in STORAGE_BACKENDS:
+                print(f"Backend di archiviazione '{name}' sconosciuto, uso sqlite")
+                name = 'sqlite'
+            _message_backend = store if name == 'sqlite' else STORAGE_BACKENDS[name]()
+        return _message_backend
+
+def resolve_contact(contact_id):
+    """Contatto dal registro in memoria ({'id': contact_id} se non ancora noto)"""
+    if not contact_id:
+        return None
+    return get_contact_registry().get(contact_id) or {'id': contact_id}
+
+def get_media_store():
+    """Istanza condivisa di MediaStore"""
+    global _media_store
+    with _store_lock:
+        if _media_store is None:
+            _media_store = MediaStore()
+        return _media_store
+
+def get_archive():
+    """Istanza condivisa di MessageArchive"""
+    global _archive
+    with _store_lock:
+        if _archive is None:
+            _archive = MessageArchive()
+        return _archive
+
+def get_contact_registry():
+    """Registro contatti condiviso da listener e finestre (caricato al primo utilizzo)"""
+    global _contact_registry
+    store = get_store()
+    with _store_lock:
+        if _contact_registry is None:
+            _contact_registry = ContactRegistry(store)
+        return _contact_registry
+
+def make_account(api_id, api_hash, phone, name=DEFAULT_ACCOUNT, session=None):
+    """Descrizione di un account da acquisire; ogni account ha il proprio file di sessione"""
+    if not session:
+        safe_name = ''.join(c if c.isalnum() or c in '+-_' else '_' for c in name)
+        session = SESSION_FILE if name == DEFAULT_ACCOUNT else f'session_{safe_name}.session'
+    return {'name': name, 'api_id': str(api_id), 'api_hash': api_hash, 'phone': phone, 'session': session}
+
+def load_accounts(primary=None):
+    """Account di config.json: quello principale (api_id, api_hash, phone) e gli altri di 'accounts'.
+
+    Ogni voce di 'accounts' ha phone e, facoltativi, name, session, api_id e
+    api_hash (se mancano valgono quelli principali). primary sostituisce
+    l'account principale, es. con le credenziali appena inserite nella GUI.
+    Le voci incomplete o con un nome già usato vengono ignorate.
+    """
+    try:
+        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+            content = f.read().strip()
+        data = json.loads(content) if content else {}
+    except FileNotFoundError:
+        data = {}
+    except Exception as e:
+        print(f"Errore nel caricamento di {CONFIG_FILE}: {e}")
+        data = {}
+    if primary is None and data.get('api_id') and data.get('api_hash') and data.get('phone'):
+        primary = make_account(data['api_id'], data['api_hash'], data['phone'])
+    accounts = [primary] if primary else []
+    for extra in data.get('accounts') or []:
+        name = extra.get('name') or extra.get('phone')
+        api_id = extra.get('api_id') or data.get('api_id')
+        api_hash = extra.get('api_hash') or data.get('api_hash')
+        if not (name and api_id and api_hash and extra.get('phone')):
+            print(f"Account incompleto in {CONFIG_FILE} ignorato: {name or extra}")
+            continue
+        if any(account['name'] == name for account in accounts):
+            print(f"Account '{name}' ripetuto in {CONFIG_FILE} ignorato")
+            continue
+        accounts.append(make_account(api_id, api_hash, extra['phone'], name, extra.get('session')))
+    return accounts
+
+def prepare_storage():
+    """Migrazioni una tantum eseguite all'avvio, sia dalla GUI sia dal demone.
+
+    Restituisce la lista degli errori (vuota se tutto è andato a buon fine),
+    che il chiamante deve mostrare: i file che non è stato possibile importare
+    restano al loro posto e vengono ritentati al prossimo avvio.
+    """
+    errors = []
+    # Converte una sola volta la vecchia cronologia nel journal JSONL
+    try:
+        migrated = migrate_messages_json()
+        if migrated:
+            print(f"Migrati {migrated} messaggi da {MESSAGES_FILE} a {MESSAGES_JOURNAL_FILE}")
+    except ValueError as e:
+        errors.append(f"Errore nella migrazione della cronologia: {e}")
+    # Al primo avvio importa journal, contatti e immagini nel database SQLite;
+    # con la cronologia non ancora migrata il journal sarebbe incompleto
+    if not errors:
+        try:
+            get_store().import_legacy_files()
+        except Exception as e:
+            errors.append(f"Errore nell'importazione dei vecchi file in {DATABASE_FILE}: {e}")
+    try:
+        # Messaggi con mittente e chat incorporati -> solo gli id
+        normalized = get_store().normalize_messages()
+        backend = get_message_backend()
+        if backend is not get_store():
+            normalized += backend.normalize_messages(get_store())
+        if normalized:
+            print(f"Convertiti {normalized} messaggi allo schema normalizzato")
+        # Download interrotti da una chiusura precedente: file parziali e messaggi ancora in attesa
+        get_media_store().remove_partial()
+        cleared = backend.clear_media_pending()
+        if cleared:
+            print(f"{cleared} messaggi non attendono più foto interrotte dalla chiusura")
+        migrated = get_store().migrate_images_to_media(get_media_store())
+        if migrated:
+            print(f"Spostate {migrated} immagini da base64 a {MEDIA_DIR}/")
+    except Exception as e:
+        errors.append(f"Errore nell'importazione dei dati in {DATABASE_FILE}: {e}")
+    for error in errors:
+        print(error)
+    return errors
+
+def read_daemon_lock(path=DAEMON_LOCK_FILE):
+    """Dati del demone in esecuzione (pid, port, token) dal file di lock.
+
+    Restituisce None se il file manca o se nessuno risponde sulla porta
+    indicata (lock rimasto da un demone terminato male).
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            info = json.load(f)
+        with socket.create_connection((DAEMON_HOST, int(info['port'])), timeout=1):
+            pass
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return info
+
+def write_daemon_lock(info, path=DAEMON_LOCK_FILE):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(info, f)
+    os.replace(tmp_path, path)
+
+def remove_daemon_lock(path=DAEMON_LOCK_FILE):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+class AccountSession:
+    """Un account acquisito da TelegramIngestor: client, sessione e stato della sua connessione"""
+
+    def __init__(self, account):
+        self.name = account['name']
+        self.account = account
+        self.client = None
+        self.state = TelegramIngestor.CONNECTING
+        self.reconnect_attempts = 0
+        self.reconnects = 0
+        self.downtime_total = 0.0
+        self.error = None
+        # Primo id ricevuto in diretta per chat (peer id Telethon): il recupero si ferma lì
+        self.live_first_ids = {}
+        self._disconnected_at = None
+
+    def set_state(self, state):
+        """Aggiorna lo stato; restituisce False se non è cambiato"""
+        if state == self.state:
+            return False
+        if state == TelegramIngestor.RECONNECTING:
+            self._disconnected_at = time.monotonic()
+        elif self._disconnected_at is not None:
+            self.downtime_total += time.monotonic() - self._disconnected_at
+            self._disconnected_at = None
+        self.state = state
+        return True
+
+    def downtime(self):
+        current = time.monotonic() - self._disconnected_at if self._disconnected_at is not None else 0
+        return self.downtime_total + current
+
+    def status(self):
+        return {'connection_state': self.state, 'reconnect_attempts': self.reconnect_attempts,
+                'reconnects': self.reconnects, 'downtime': self.downtime(), 'error': self.error}
+
+class TelegramIngestor:
+    """Ascolta i nuovi messaggi Telegram e li acquisisce con una pipeline a fasi.
+
+    È il nucleo senza Qt usato sia dalla GUI (MessageListener, in un QThread)
+    sia dal demone (daemon.py, su un normale loop asyncio): i lotti di messaggi
+    salvati arrivano ai callback on_messages/on_updated, i cambi di stato
+    della connessione a on_state.
+
+    accounts è la lista di load_accounts(): ogni account ha il proprio client e
+    la propria sessione (AccountSession), tutti sullo stesso loop, mentre
+    pipeline, thread di scrittura e cache dei contatti sono condivisi. Ogni
+    messaggio porta il nome dell'account che lo ha ricevuto (campo account).
+
+    L'handler si limita ad accodare il messaggio; le fasi (risoluzione mittente/chat,
+    salvataggio del testo, download della foto, aggancio della foto) sono
+    collegate da asyncio.Queue limitate e girano con worker indipendenti, così un
+    download lento non ritarda i messaggi successivi: il testo arriva subito
+    (on_messages) e la foto lo raggiunge dopo (on_updated).
+    All'avvio i messaggi arrivati mentre il listener era fermo vengono
+    recuperati chat per chat (vedi _backfill) ed entrano nella stessa pipeline.
+    Se la connessione di un account cade, quell'account si riconnette da solo con
+    lo stesso client (backoff esponenziale con jitter) e recupera i messaggi
+    persi; run() termina con stop()/shutdown() o quando nessun account può più
+    essere acquisito.
+    """
+
+    # Stati della connessione (connection_state)
+    CONNECTING = 'connecting'
+    CONNECTED = 'connected'
+    RECONNECTING = 'reconnecting'
+    STOPPED = 'stopped'
+
+    def __init__(self, accounts, on_messages=None, on_updated=None, on_state=None, thumbnailer=None):
+        self.sessions = [AccountSession(account) for account in accounts]
+        # Callback con una lista di messaggi (vedi _deliver) e con il nuovo stato della connessione
+        self.on_messages = on_messages
+        self.on_updated = on_updated
+        self.on_state = on_state
+        self.loop = None
+        self.start_time = datetime.datetime.utcnow().isoformat()
+        # Le scritture su disco avvengono nel thread dedicato; i callback ricevono
+        # i messaggi appena sono stati salvati. Senza thumbnailer (demone senza Qt)
+        # le miniature vengono create dalla GUI alla prima visualizzazione
+        self.writer = StorageWriter(get_store(), get_media_store(), thumbnailer=thumbnailer,
+                                    on_commit=self._emit_committed, backend=get_message_backend(),
+                                    on_update=self._emit_updated)
+        # Mittenti e chat già noti vengono risolti senza chiamate di rete
+        self.entities = EntityCache()
+        self.entities.prewarm(get_contact_registry().all().values())
+        # Regole di acquisizione ('filter_*' in settings.json), valutate nell'handler
+        self.rules = IngestRules(load_settings())
+        # Messaggi già acquisiti: ripetizioni scartate, modifiche ed eliminazioni applicate sul posto
+        self.index = MessageIndex(self.writer.backend)
+        for session in self.sessions:
+            self.index.load_cursors(session.name, self.writer.store.chat_cursors(session.name))
+        # Modifiche arrivate prima che il messaggio fosse creato (ancora in coda di risoluzione)
+        self._early_changes = {}
+        self.edits = 0
+        self.deletions = 0
+        self.resolve_queue = None
+        self.persist_queue = None
+        self.attach_queue = None
+        self.media_scheduler = None
+        self.backfilled = 0
+        self.connection_state = self.CONNECTING
+        self.fatal_error = None
+        self._stop_event = None
+        self._pending_delivery = {'new': [], 'updated': []}
+        self._delivery_handle = None
+        self._last_delivery = 0.0
+
+    async def run(self):
+        """Esegue l'acquisizione fino a stop()/shutdown() o a un errore non recuperabile"""
+        try:
+            await self._main()
+        except Exception as e:
+            self.fatal_error = str(e)
+            raise
+        finally:
+            for session in self.sessions:
+                session.set_state(self.STOPPED)
+            self._update_state()
+
+    def shutdown(self):
+        """Chiede l'arresto da qualunque thread.
+
+        run() termina dopo aver portato al thread di scrittura i messaggi ancora
+        in pipeline e averlo fermato (vedi _main).
+        """
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.stop)
+
+    def stop(self):
+        """Chiede l'arresto; da chiamare nel thread del loop (es. da un gestore di segnale)"""
+        if self._stop_event is None:
+            return
+        # Interrompe anche l'eventuale attesa tra due tentativi di riconnessione
+        self._stop_event.set()
+        for session in self.sessions:
+            if session.client is not None:
+                self.loop.create_task(session.client.disconnect())
+
+    def status(self):
+        """Istantanea serializzabile in JSON: connessione, scritture e download in sospeso.
+
+        I valori della connessione riassumono tutti gli account; il dettaglio per
+        account è in 'accounts'.
+        """
+        return {
+            'connection_state': self.connection_state,
+            'reconnect_attempts': max((session.reconnect_attempts for session in self.sessions), default=0),
+            'reconnects': sum(session.reconnects for session in self.sessions),
+            'downtime': self.downtime(),
+            'backfilled': self.backfilled,
+            'writer_queue': self.writer.queue_depth(),
+            'media': self.media_scheduler.stats() if self.media_scheduler is not None else None,
+            'filtered': self.rules.stats(),
+            'index': dict(self.index.stats(), edits=self.edits, deletions=self.deletions),
+            'accounts': {session.name: session.status() for session in self.sessions},
+        }
+
+    def _set_state(self, session, state):
+        if session.set_state(state):
+            self._update_state()
+
+    def _update_state(self):
+        """Stato complessivo: basta un account in riconnessione perché lo sia l'acquisizione"""
+        states = {session.state for session in self.sessions}
+        for state in (self.RECONNECTING, self.CONNECTING, self.CONNECTED, self.STOPPED):
+            if state in states:
+                break
+        if state == self.connection_state:
+            return
+        self.connection_state = state
+        if self.on_state:
+            self.on_state(state)
+
+    def downtime(self):
+        """Secondi senza connessione dell'account rimasto scollegato più a lungo"""
+        return max((session.downtime() for session in self.sessions), default=0.0)
+
+    def _emit_committed(self, messages):
+        self._deliver('new', messages)
+
+    def _emit_updated(self, messages):
+        self._deliver('updated', messages)
+
+    def _deliver(self, kind, messages):
+        """Chiamato dal thread di scrittura: i messaggi passano dal loop, che li consegna in lotti.
+
+        Una raffica di messaggi diventa così una sola chiamata dei callback ogni
+        DELIVERY_BATCH_INTERVAL secondi invece di una per messaggio.
+        """
+        messages = list(messages)
+        loop = self.loop
+        try:
+            if loop is not None and not loop.is_closed():
+                loop.call_soon_threadsafe(self._queue_delivery, kind, messages)
+                return
+        except RuntimeError:
+            # Loop chiuso nel frattempo
+            pass
+        self._emit_batch({kind: messages})
+
+    def _queue_delivery(self, kind, messages):
+        self.index.settle(messages)
+        self._pending_delivery[kind].extend(messages)
+        if self._delivery_handle is None:
+            delay = max(0.0, self._last_delivery + DELIVERY_BATCH_INTERVAL - self.loop.time())
+            self._delivery_handle = self.loop.call_later(delay, self._flush_delivery)
+
+    def _flush_delivery(self):
+        self._delivery_handle = None
+        self._last_delivery = self.loop.time()
+        pending, self._pending_delivery = self._pending_delivery, {'new': [], 'updated': []}
+        self._emit_batch(pending)
+
+    def _emit_batch(self, pending):
+        # Prima i nuovi messaggi: un aggiornamento si riferisce sempre a una riga già inviata
+        if pending.get('new') and self.on_messages:
+            self.on_messages(pending['new'])
+        if pending.get('updated') and self.on_updated:
+            self.on_updated(pending['updated'])
+
+    async def _main(self):
+        self.loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        self.writer.start()
+        workers = []
+        try:
+            if not self.sessions:
+                raise RuntimeError('Nessun account da acquisire')
+            if TelegramClient is None:
+                raise RuntimeError('telethon non è installato: pip install telethon')
+            workers = self._start_pipeline()
+            workers.append(asyncio.create_task(self._refresh_entities()))
+            await asyncio.gather(*(self._run_account(session) for session in self.sessions))
+            failed = [session for session in self.sessions if session.error]
+            if len(failed) == len(self.sessions):
+                if len(failed) == 1:
+                    raise RuntimeError(failed[0].error)
+                raise RuntimeError('; '.join(f"{session.name}: {session.error}" for session in failed))
+        except Exception as e:
+            print(f"Errore in _main(): {e}")
+            raise
+        finally:
+            if workers:
+                await self._drain_pipeline()
+            for task in workers:
+                task.cancel()
+            if self.media_scheduler is not None:
+                self.media_scheduler.cancel()
+            # Solo ora: tutto ciò che la pipeline ha accodato arriva prima dello stop
+            self.writer.stop()
+
+    async def _run_account(self, session):
+        """Connessione di un account: avvio, ascolto e riconnessioni fino all'arresto.
+
+        Un errore non recuperabile (es. sessione non più autorizzata) ferma solo
+        questo account e resta in session.error.
+        """
+        backfill_task = None
+        try:
+            account = session.account
+            session.client = TelegramClient(account['session'], account['api_id'], account['api_hash'])
+            await session.client.start(phone=account['phone'])
+            
+            @session.client.on(events.NewMessage)
+            async def handler(event):
+                if getattr(event.message, 'grouped_id', None):
+                    # Parte di un album: arriva anche, insieme alle altre, ad album_handler
+                    return
+                # Solo l'accodamento: tutto il resto avviene nelle fasi della pipeline
+                session.live_first_ids.setdefault(event.chat_id, event.message.id)
+                # Il traffico escluso dalle regole si ferma qui, prima di qualunque chiamata di rete
+                if self.rules.check(event.message) is not None or not self._claim(session, event.message):
+                    return
+                await self.resolve_queue.put((event.message, datetime.datetime.utcnow().isoformat(), session))
+            
+            @session.client.on(events.Album)
+            async def album_handler(event):
+                # Un album diventa un solo messaggio con tutte le sue foto
+                parts = sorted(event.messages, key=lambda part: part.id)
+                session.live_first_ids.setdefault(event.chat_id, parts[0].id)
+                message = self._album_cover(parts)
+                if self.rules.check(message) is not None or not self._claim(session, message):
+                    return
+                await self.resolve_queue.put((message, datetime.datetime.utcnow().isoformat(), session, parts))
+            
+            @session.client.on(events.MessageEdited)
+            async def edit_handler(event):
+                message = event.message
+                edit_date = getattr(message, 'edit_date', None) or datetime.datetime.utcnow()
+                if self._apply_change(self._message_key(session, message),
+                                      {'text': message.raw_text, 'edit_date': str(edit_date)}):
+                    self.edits += 1
+            
+            @session.client.on(events.MessageDeleted)
+            async def delete_handler(event):
+                # Il messaggio resta in archivio, segnato come eliminato
+                deleted_at = datetime.datetime.utcnow().isoformat()
+                for message_id in event.deleted_ids:
+                    if event.chat_id is not None:
+                        keys = [(session.name, peer_chat_id(event.chat_id), message_id)]
+                    else:
+                        # Chat private e gruppi base: Telegram non indica la chat
+                        keys = self.index.find_mailbox(session.name, message_id)
+                    for key in keys:
+                        if self._apply_change(key, {'deleted_at': deleted_at}):
+                            self.deletions += 1
+            
+            backfill = load_settings().get('backfill_enabled', True)
+            while not self._stop_event.is_set():
+                self._set_state(session, self.CONNECTED)
+                if backfill:
+                    if backfill_task is not None:
+                        backfill_task.cancel()
+                    backfill_task = asyncio.create_task(self._backfill(session))
+                try:
+                    await session.client.run_until_disconnected()
+                except Exception as e:
+                    print(f"Connessione a Telegram interrotta ({session.name}): {e}")
+                if self._stop_event.is_set():
+                    break
+                self._set_state(session, self.RECONNECTING)
+                # Il recupero successivo si fermerà ai primi messaggi ricevuti dopo la riconnessione
+                session.live_first_ids.clear()
+                if not await self._reconnect(session):
+                    break
+                session.reconnects += 1
+        except Exception as e:
+            print(f"Errore nell'account {session.name}: {e}")
+            session.error = str(e)
+        finally:
+            if backfill_task is not None:
+                backfill_task.cancel()
+            self._set_state(session, self.STOPPED)
+
+    def _start_pipeline(self):
+        """Crea le code e avvia i worker delle fasi; il numero di worker viene da settings.json"""
+        settings = load_settings()
+        self.resolve_queue = asyncio.Queue(INGEST_QUEUE_SIZE)
+        self.persist_queue = asyncio.Queue(INGEST_QUEUE_SIZE)
+        self.attach_queue = asyncio.Queue(INGEST_QUEUE_SIZE)
+        # La fase di download è gestita dallo scheduler (limiti, priorità, esclusioni)
+        self.media_scheduler = MediaScheduler(self._download, settings)
+        stages = [
+            ('risoluzione', self.resolve_queue, self._resolve, max(1, settings.get('ingest_resolve_workers') or 1)),
+            # Un solo worker: il testo viene salvato nell'ordine in cui è stato risolto
+            ('salvataggio', self.persist_queue, self._persist, 1),
+            ('aggancio', self.attach_queue, self._attach, 1),
+        ]
+        return [asyncio.create_task(self._stage_worker(name, source, handle))
+                for name, source, handle, count in stages for _ in range(count)]
+
+    async def _drain_pipeline(self):
+        """Attende (al massimo SHUTDOWN_DRAIN_TIMEOUT secondi) che le fasi smaltiscano le code"""
+        async def drain():
+            await self.resolve_queue.join()
+            await self.persist_queue.join()
+            await self.media_scheduler.join()
+            await self.attach_queue.join()
+
+        try:
+            await asyncio.wait_for(drain(), SHUTDOWN_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            pending = self.resolve_queue.qsize() + self.persist_queue.qsize() + self.attach_queue.qsize()
+            print(f"Errore: pipeline non svuotata entro {SHUTDOWN_DRAIN_TIMEOUT} secondi "
+                  f"({pending} messaggi in coda, {self.media_scheduler.stats()['running']} download in corso)")
+
+    async def _stage_worker(self, name, source, handle):
+        while True:
+            item = await source.get()
+            try:
+                await handle(*item)
+            except Exception as e:
+                print(f"Errore nella fase di {name}: {e}")
+            finally:
+                source.task_done()
+
+    @staticmethod
+    def _message_key(session, message):
+        return (session.name, peer_chat_id(message.chat_id), message.id)
+
+    def _claim(self, session, message):
+        """Prenota un messaggio in arrivo; False se era già stato acquisito (ripetizione o recupero)"""
+        key = self._message_key(session, message)
+        if self.index.get(key) is not None:
+            self.index.duplicates += 1
+            return False
+        self.index.reserve(key, mailbox=not is_channel_peer(message.chat_id))
+        return True
+
+    def _apply_change(self, key, changes):
+        """Applica una modifica (campi del messaggio) al messaggio con questa chiave, ovunque si trovi.
+
+        Un messaggio ancora in pipeline la riceve quando viene creato; uno già
+        creato viene aggiornato e riscritto da solo, senza toccare il resto
+        dello storico. Restituisce False per i messaggi mai acquisiti.
+        """
+        target = self.index.get(key)
+        if target is None:
+            return False
+        if target == MessageIndex.PENDING:
+            self._early_changes.setdefault(key, {}).update(changes)
+            return True
+        if isinstance(target, MessageRecord):
+            msg = target
+        else:
+            msg = self.writer.backend.get(target)
+            if msg is None:
+                return False
+            # Finché la riscrittura non è su disco le modifiche successive usano questo stesso oggetto
+            self.index.bind(key, msg)
+        for field, value in changes.items():
+            msg[field] = value
+        self.writer.update_message(msg)
+        return True
+
+    @staticmethod
+    def _album_cover(parts):
+        """La parte di un album che rappresenta il messaggio: quella con la didascalia"""
+        return next((part for part in parts if part.raw_text), parts[0])
+
+    async def _resolve(self, message, received_at, session, album=None):
+        """Fase 1: mittente e chat, poi il messaggio (solo testo) passa al salvataggio.
+
+        album sono tutte le parti di un album (message è quella con la didascalia).
+        Se mittente o chat non si possono leggere la prenotazione viene annullata
+        (con le modifiche arrivate nel frattempo), così il messaggio verrà
+        acquisito alla prossima ripetizione o dal recupero.
+        """
+        key = self._message_key(session, message)
+        try:
+            sender_info = await self._entity_info(message.sender_id, message.get_sender)
+            # Salva info gruppo se presente
+            chat_info = None
+            if message.chat_id is not None:
+                chat_info = await self._entity_info(message.chat_id, message.get_chat)
+                if chat_info.get('type') == 'unknown':
+                    chat_info = None
+        except Exception:
+            self.index.release(key)
+            self._early_changes.pop(key, None)
+            raise
+        # Prima i contatti: il messaggio conserva solo gli id e la GUI
+        # risolve i nomi dal registro
+        self.save_contact(sender_info)
+        if chat_info:
+            self.save_contact(chat_info)
+        msg = MessageRecord(
+            # Senza mittente risolto resta l'id del peer (come nei contatti), None se Telegram non lo indica
+            sender_id=sender_info.get('id') or peer_chat_id(message.sender_id),
+            chat_id=chat_info.get('id') if chat_info else None,
+            text=message.raw_text,
+            date=str(message.date),
+            received_at=received_at,
+            message_id=message.id,
+            account=session.name
+        )
+        self.index.bind(key, msg)
+        for field, value in (self._early_changes.pop(key, None) or {}).items():
+            msg[field] = value
+        if album:
+            photos = [part.photo for part in album if getattr(part, 'photo', None)]
+            # Tutti gli id dell'album: il recupero riprende dopo l'ultimo
+            msg['album_message_ids'] = [part.id for part in album]
+        else:
+            photo = getattr(message, 'photo', None)
+            photos = [photo] if photo else []
+        if photos:
+            msg['media_pending'] = True
+        await self.persist_queue.put((msg, photos, sender_info, chat_info, session))
+
+    async def _reconnect(self, session):
+        """Riconnette il client dell'account (stessa sessione) con backoff esponenziale e jitter.
+
+        Restituisce False se nel frattempo è stato chiesto l'arresto; una sessione
+        non più autorizzata è un errore non recuperabile.
+        """
+        attempt = 0
+        while not self._stop_event.is_set():
+            delay = min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** attempt)
+            # Jitter: più client disconnessi insieme non ritentano tutti nello stesso istante
+            delay = random.uniform(delay / 2, delay)
+            session.reconnect_attempts = attempt + 1
+            try:
+                await asyncio.wait_for(self._stop_event.wait(), delay)
+                return False
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await session.client.connect()
+            except Exception as e:
+                print(f"Riconnessione fallita ({session.name}, tentativo {attempt + 1}): {e}")
+                attempt += 1
+                continue
+            if not await session.client.is_user_authorized():
+                raise RuntimeError('La sessione Telegram non è più autorizzata')
+            session.reconnect_attempts = 0
+            return True
+        return False
+
+    async def _backfill(self, session):
+        """Recupera i messaggi arrivati all'account mentre il listener era fermo.
+
+        Per ogni chat con un ultimo id salvato (MessageStore.chat_cursors) legge
+        i messaggi successivi con iter_messages, dal più vecchio, e li mette
+        nella coda di risoluzione: la coda limitata fa da freno, quindi le pagine
+        non vengono mai accumulate in memoria. Le chat sono elaborate in
+        parallelo da BACKFILL_CONCURRENCY worker.
+        """
+        # Prima vengono salvati i messaggi già in pipeline, così gli ultimi id sono aggiornati
+        await self.resolve_queue.join()
+        await self.persist_queue.join()
+        if not await self.loop.run_in_executor(None, self.writer.flush):
+            print(f"Recupero di {session.name} con ultimi id non aggiornati: {self.writer.last_error}")
+        cursors = iter(list(self.writer.store.chat_cursors(session.name).items()))
+        limit = load_settings().get('backfill_max_per_chat') or None
+        before = self.backfilled
+
+        async def worker():
+            # L'iteratore è condiviso: ogni chat viene presa da un solo worker
+            for chat_id, last_id in cursors:
+                await self._backfill_chat(session, chat_id, last_id, limit)
+
+        await asyncio.gather(*(worker() for _ in range(BACKFILL_CONCURRENCY)))
+        if self.backfilled > before:
+            print(f"Recuperati {self.backfilled - before} messaggi arrivati a {session.name} durante l'interruzione")
+
+    async def _backfill_chat(self, session, chat_id, last_id, limit):
+        peer_id = marked_peer_id(resolve_contact(chat_id))
+        if peer_id is None:
+            return
+        fetched = 0
+        # Parti consecutive dello stesso album, accodate insieme come un solo messaggio
+        album = []
+        while limit is None or fetched < limit:
+            try:
+                async for message in session.client.iter_messages(
+                        peer_id, min_id=last_id, reverse=True, wait_time=BACKFILL_PAGE_WAIT,
+                        limit=None if limit is None else limit - fetched):
+                    stop_id = session.live_first_ids.get(peer_id)
+                    if stop_id is not None and message.id >= stop_id:
+                        # Da qui in poi i messaggi arrivano già dall'handler
+                        break
+                    grouped_id = getattr(message, 'grouped_id', None)
+                    if album and grouped_id != album[0].grouped_id:
+                        fetched += await self._enqueue_backfilled(session, album)
+                        album = []
+                    if grouped_id:
+                        album.append(message)
+                    else:
+                        fetched += await self._enqueue_backfilled(session, [message])
+                    last_id = message.id
+                if album:
+                    fetched += await self._enqueue_backfilled(session, album)
+                return
+            except Exception as e:
+                seconds = getattr(e, 'seconds', None)
+                print(f"Errore nel recupero dei messaggi della chat {chat_id}: {e}")
+                if not seconds:
+                    return
+                # FloodWait: riprende dall'ultimo messaggio accodato dopo l'attesa richiesta da Telegram
+                await asyncio.sleep(seconds)
+
+    async def _enqueue_backfilled(self, session, parts):
+        """Accoda un messaggio recuperato (o un album); restituisce quanti messaggi ha accodato"""
+        message = self._album_cover(parts)
+        if self.rules.check(message, live=False) is not None or not self._claim(session, message):
+            return 0
+        # received_at è l'istante in cui arriva qui (la data Telegram resta in date): così i
+        # messaggi recuperati rientrano nella sessione della GUI e nei contatori come quelli dal vivo
+        await self.resolve_queue.put((message, datetime.datetime.utcnow().isoformat(), session,
+                                      parts if len(parts) > 1 else None))
+        self.backfilled += 1
+        return 1
+
+    async def _entity_info(self, peer_id, fetch):
+        """Info su mittente/chat dalla cache; la rete viene usata solo alla prima occorrenza"""
+        info = self.entities.get(peer_id) if peer_id is not None else None
+        if info is None:
+            info = self.extract_sender_info(await fetch())
+            if peer_id is not None and info.get('id'):
+                self.entities.put(peer_id, info)
+        return info
+
+    async def _refresh_entities(self):
+        """Aggiorna in background le voci scadute della cache (e i contatti salvati)"""
+        while True:
+            await asyncio.sleep(ENTITY_REFRESH_INTERVAL)
+            for peer_id in self.entities.take_stale(ENTITY_REFRESH_BATCH):
+                try:
+                    info = self.extract_sender_info(await self._get_entity(peer_id))
+                except Exception as e:
+                    # Il peer resta in cache con i dati attuali e verrà ritentato alla scadenza
+                    seconds = getattr(e, 'seconds', None)
+                    print(f"Errore nell'aggiornamento del contatto {peer_id}: {e}")
+                    current = self.entities.get(peer_id)
+                    if current is not None:
+                        self.entities.put(peer_id, current)
+                    if seconds:
+                        # FloodWait: riprende dopo l'attesa richiesta da Telegram
+                        await asyncio.sleep(seconds)
+                        break
+                    continue
+                self.entities.put(peer_id, info)
+                self.entities.refreshes += 1
+                self.save_contact(info)
+
+    async def _get_entity(self, peer_id):
+        """Legge un contatto con il primo account collegato che lo conosce"""
+        error = RuntimeError('Nessun account collegato')
+        for session in self.sessions:
+            if session.state != self.CONNECTED:
+                continue
+            try:
+                return await session.client.get_entity(peer_id)
+            except Exception as e:
+                if getattr(e, 'seconds', None):
+                    raise
+                error = e
+        raise error
+
+    async def _persist(self, msg, photos, sender_info, chat_info, session):
+        """Fase 2: il testo va subito al thread di scrittura (e quindi ai callback)"""
+        chat_id = message_chat_id(msg)
+        if photos:
+            allowed = [photo for photo in photos if not self.media_scheduler.skip_reason(chat_id, photo_size(photo))]
+            # Foto escluse dalle impostazioni: il messaggio viene salvato senza
+            self.media_scheduler.skipped += len(photos) - len(allowed)
+            photos = allowed
+            if not photos:
+                msg.pop('media_pending')
+        self.save_message(msg)
+        if photos:
+            size = sum(photo_size(photo) for photo in photos)
+            await self.media_scheduler.submit(chat_id, size, (msg, photos, sender_info, chat_info, session))
+
+    async def _download(self, job):
+        """Fase 3 (avviata dallo scheduler): scarica le foto e restituisce i byte scaricati.
+
+        Le foto di un album vengono scaricate in parallelo e collegate al
+        messaggio tutte insieme.
+        """
+        msg, photos, sender_info, chat_info, session = job
+        media = []
+        try:
+            results = await asyncio.gather(*(self._download_photo(session, photo) for photo in photos),
+                                           return_exceptions=True)
+            errors = [result for result in results if isinstance(result, BaseException)]
+            media = [result for result in results if not isinstance(result, BaseException)]
+            if errors and not media:
+                raise errors[0]
+            for error in errors:
+                print(f"Errore nel download di una foto dell'album: {error}")
+        finally:
+            # Anche se il download fallisce il messaggio smette di attendere le foto
+            await self.attach_queue.put((msg, media, sender_info, chat_info))
+        return sum(size for sha256, size in media if sha256)
+
+    async def _download_photo(self, session, photo):
+        """Scarica una foto e restituisce (sha256, byte).
+
+        I pezzi scaricati vanno direttamente in un file temporaneo dell'archivio
+        media, con l'hash calcolato durante il download: la foto intera non passa
+        mai dalla memoria.
+        """
+        staged = self.writer.media.stage()
+        try:
+            # La foto va scaricata dall'account che ha ricevuto il messaggio
+            await session.client.download_media(photo, file=staged)
+            size = staged.size
+            return staged.commit(), size
+        except BaseException:
+            staged.discard()
+            raise
+
+    def apply_settings(self, settings):
+        """Applica le nuove impostazioni di regole e download (chiamabile da qualunque thread)"""
+        if self.loop is not None and self.media_scheduler is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._apply_settings, settings)
+
+    def _apply_settings(self, settings):
+        self.rules.configure(settings)
+        self.media_scheduler.configure(settings)
+        self.media_scheduler._dispatch()
+
+    async def _attach(self, msg, media, sender_info, chat_info):
+        """Fase 4: registra le foto e le collega al messaggio già salvato"""
+        self.save_images(msg, media, sender_info, chat_info)
+
+    def extract_sender_info(self, sender):
+        if sender is None:
+            return {'type': 'unknown'}
+        info = {'id': str(getattr(sender, 'id', ''))}
+        if isinstance(sender, User):
+            info['type'] = 'user'
+            info['first_name'] = getattr(sender, 'first_name', '')
+            info['last_name'] = getattr(sender, 'last_name', '')
+            info['username'] = getattr(sender, 'username', '')
+            info['phone'] = getattr(sender, 'phone', '')
+            info['is_self'] = getattr(sender, 'is_self', False)
+        elif isinstance(sender, Channel):
+            info['type'] = 'channel'
+            info['title'] = getattr(sender, 'title', '')
+            info['username'] = getattr(sender, 'username', '')
+            info['is_verified'] = getattr(sender, 'verified', False)
+            info['is_scam'] = getattr(sender, 'scam', False)
+            info['is_gigagroup'] = getattr(sender, 'gigagroup', False)
+        elif isinstance(sender, Chat):
+            info['type'] = 'group'
+            info['title'] = getattr(sender, 'title', '')
+            info['username'] = getattr(sender, 'username', '')
+            info['is_megagroup'] = getattr(sender, 'megagroup', False)
+        else:
+            info['type'] = 'unknown'
+        return info
+
+    def save_message(self, msg):
+        self.writer.add_message(msg)
+
+    def save_contact(self, sender):
+        # Scrive solo se i dati del contatto sono effettivamente cambiati
+        changed = get_contact_registry().update(sender)
+        if changed:
+            self.writer.add_contact(changed)
+
+    def save_images(self, msg, media, sender_info, chat_info):
+        """Collega al messaggio le foto scaricate, media = [(sha256, size)]"""
+        media = [(str(uuid.uuid4()) if sha256 else None, sha256, size) for sha256, size in media]
+        self.writer.attach_images(msg, media, {
+            'date': msg.received_at,
+            'sender': sender_info,
+            'chat': chat_info
+        })
@@ -0,0 +1,173 @@
+"""Acquisizione senza interfaccia: python AutomaticTelReader/daemon.py
+
+Esegue lo stesso nucleo della GUI (core.TelegramIngestor) su un normale loop
+asyncio, senza caricare Qt: acquisisce tutti gli account di config.json (vedi
+core.load_accounts) e scrive negli stessi archivi. La GUI avviata mentre il demone è attivo lo trova tramite
+DAEMON_LOCK_FILE e vi si collega invece di avviare un proprio client.
+"""
+import sys
+import os
+import asyncio
+import datetime
+import signal
+import uuid
+from core import (DAEMON_HOST, DAEMON_STATUS_INTERVAL, RetentionEngine, TelegramIngestor, decode_json,
+                  encode_json, get_archive, get_media_store, get_message_backend, get_store, load_accounts,
+                  load_settings, pillow_thumbnail, prepare_storage, read_daemon_lock, remove_daemon_lock,
+                  resolve_contact, write_daemon_lock)
+
+# Oltre questa quantità di dati non ancora letti un client lento viene scollegato
+DAEMON_CLIENT_MAX_BUFFER = 16 * 1024 * 1024
+
+class DaemonServer:
+    """Server locale a cui la GUI si collega (vedi DaemonConnection in main.py).
+
+    Protocollo: una riga JSON per evento. Il client invia per prima
+    {'type': 'hello', 'token': ...} con il token del file di lock; poi riceve
+    'status', 'messages' e 'updated' (con i contatti citati) e può inviare
+    {'type': 'settings'} dopo aver salvato settings.json.
+    """
+
+    def __init__(self, retention=None):
+        self.ingestor = None
+        self.retention = retention
+        self.token = uuid.uuid4().hex
+        self.loop = None
+        self._server = None
+        self._clients = set()
+        self._status_task = None
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_server(self._handle, DAEMON_HOST, 0)
+        port = self._server.sockets[0].getsockname()[1]
+        write_daemon_lock({'pid': os.getpid(), 'port': port, 'token': self.token,
+                           'started_at': datetime.datetime.utcnow().isoformat()})
+        self._status_task = asyncio.create_task(self._publish_status())
+        print(f"Demone in ascolto su {DAEMON_HOST}:{port}")
+
+    async def close(self):
+        remove_daemon_lock()
+        if self._status_task is not None:
+            self._status_task.cancel()
+        self._server.close()
+        for writer in list(self._clients):
+            writer.close()
+        await self._server.wait_closed()
+
+    def publish(self, kind, messages):
+        """Callback dell'acquisizione: inoltra un lotto di messaggi ai client collegati"""
+        try:
+            self.loop.call_soon_threadsafe(self._broadcast_messages, kind, list(messages))
+        except RuntimeError:
+            # Loop già chiuso (ultime scritture durante l'arresto)
+            pass
+
+    def publish_state(self, state):
+        self.publish_status()
+
+    def publish_status(self):
+        if self.ingestor is not None:
+            self._broadcast({'type': 'status', 'status': self.ingestor.status()})
+
+    async def _publish_status(self):
+        while True:
+            await asyncio.sleep(DAEMON_STATUS_INTERVAL)
+            self.publish_status()
+
+    def _broadcast_messages(self, kind, messages):
+        contacts = {}
+        for msg in messages:
+            for contact_id in (msg.sender_id, msg.chat_id):
+                if contact_id and contact_id not in contacts:
+                    contacts[contact_id] = resolve_contact(contact_id)
+        self._broadcast({'type': kind, 'messages': [msg.to_dict() for msg in messages],
+                         'contacts': list(contacts.values())})
+
+    def _broadcast(self, event):
+        if not self._clients:
+            return
+        line = (encode_json(event) + '\n').encode('utf-8')
+        for writer in list(self._clients):
+            if writer.transport.get_write_buffer_size() > DAEMON_CLIENT_MAX_BUFFER:
+                print("Client del demone troppo lento, scollegato")
+                self._clients.discard(writer)
+                writer.close()
+                continue
+            writer.write(line)
+
+    async def _handle(self, reader, writer):
+        try:
+            hello = decode_json(await asyncio.wait_for(reader.readline(), 5))
+        except Exception:
+            writer.close()
+            return
+        if not isinstance(hello, dict) or hello.get('token') != self.token:
+            writer.close()
+            return
+        self._clients.add(writer)
+        if self.ingestor is not None:
+            writer.write((encode_json({'type': 'status', 'status': self.ingestor.status()}) + '\n').encode('utf-8'))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = decode_json(line)
+                if request.get('type') == 'settings':
+                    # La GUI ha salvato settings.json: download e conservazione si adeguano subito
+                    self.ingestor.apply_settings(load_settings())
+                    if self.retention is not None:
+                        self.retention.trigger()
+        except (ConnectionError, ValueError) as e:
+            print(f"Errore nella connessione con la GUI: {e}")
+        finally:
+            self._clients.discard(writer)
+            writer.close()
+
+async def run_daemon(accounts, retention):
+    server = DaemonServer(retention)
+    ingestor = TelegramIngestor(accounts,
+                                on_messages=lambda messages: server.publish('messages', messages),
+                                on_updated=lambda messages: server.publish('updated', messages),
+                                on_state=server.publish_state, thumbnailer=pillow_thumbnail)
+    server.ingestor = ingestor
+    await server.start()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, ingestor.stop)
+        except (NotImplementedError, AttributeError, ValueError):
+            # Windows: Ctrl+C arriva come KeyboardInterrupt
+            pass
+    try:
+        await ingestor.run()
+    finally:
+        await server.close()
+
+def main():
+    accounts = load_accounts()
+    if not accounts:
+        print("Credenziali mancanti: accedere una volta dalla GUI oppure compilare api_id, api_hash e phone in config.json")
+        return 1
+    if read_daemon_lock() is not None:
+        print("Un demone è già in esecuzione")
+        return 1
+    prepare_storage()
+    retention = RetentionEngine(get_store(), get_media_store(), get_archive(), backend=get_message_backend())
+    retention.start()
+    try:
+        print(f"Account acquisiti: {', '.join(account['name'] for account in accounts)}")
+        asyncio.run(run_daemon(accounts, retention))
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        print(f"Errore nel demone: {e}")
+        return 1
+    finally:
+        retention.stop()
+        remove_daemon_lock()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,16 +3,15 @@ from PySide6.QtWidgets import (QApplication, QWidget, QVBoxLayout, QLabel, QPush
                                QLineEdit, QMessageBox, QHBoxLayout, QDialog, QTextEdit, QInputDialog, 
                                QDialogButtonBox, QListView, QAbstractItemView, QListWidgetItem, 
                                QProgressBar, QSplashScreen, QFrame, QScrollArea, QGroupBox, 
-                               QSpacerItem, QSizePolicy, QCheckBox, QComboBox, QSpinBox, QSlider)
-from PySide6.QtCore import QThread, Signal, Qt, QTimer, QPropertyAnimation, QEasingCurve, QRect, QSize
-from PySide6.QtGui import QIcon, QFont, QPixmap, QImage, QPalette, QColor, QPainter, QBrush, QWheelEvent
-from telethon import TelegramClient, events
+                               QSpacerItem, QSizePolicy, QCheckBox, QComboBox, QSpinBox, QSlider,
+                               QStyle, QStyledItemDelegate)
+from PySide6.QtCore import (QThread, QObject, Signal, Qt, QTimer, QPropertyAnimation, QEasingCurve, QRect, QSize,
+                            QBuffer, QByteArray, QIODevice, QAbstractListModel, QModelIndex)
+from PySide6.QtGui import QIcon, QFont, QPixmap, QImage, QPalette, QColor, QPainter, QBrush, QPen, QWheelEvent
 import os
 import json
 import datetime
-from telethon.tl.types import User, Channel, Chat
-import base64
-import uuid
+import html
 import yfinance as yf
 import requests
 from datetime import datetime as dt
@@ -21,15 +20,19 @@ from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
 import matplotlib.dates as mdates
 import numpy as np
-IMAGES_FILE = 'images.json'
-
-API_ID = ''
-API_HASH = ''
-SESSION_FILE = 'session.session'
-MESSAGES_FILE = 'messages.json'
-CONFIG_FILE = 'config.json'
-CONTACTS_FILE = 'contacts.json'
-
+import threading
+import queue
+import time
+import sqlite3
+import asyncio
+import socket
+# Archivi, scrittura e acquisizione stanno in core.py, senza Qt (li usa anche daemon.py)
+from core import (CONFIG_FILE, SETTINGS_FILE, DEFAULT_SETTINGS, IMAGE_CACHE_MAX_BYTES, THUMBNAIL_SIZE, SEARCH_MATCH_START, SEARCH_MATCH_END,
+                  ALBUM_PREVIEW_COUNT, ALBUM_PREVIEW_SIZE, SEARCH_PAGE_SIZE, DAEMON_HOST, DEFAULT_ACCOUNT,
+                  LRUCache, MessageRecord, RetentionEngine, TelegramIngestor,
+                  benchmark_storage_backends, print_storage_benchmark, read_image_bytes, decode_json, encode_json,
+                  get_store, get_message_backend, get_media_store, get_archive, get_contact_registry,
+                  load_accounts, load_settings, make_account, message_image_ids, prepare_storage, read_daemon_lock)
 class LoginWidget(QWidget):
     def __init__(self, on_login):
         super().__init__()
@@ -344,13 +347,22 @@ class LoginWidget(QWidget):
         # Salva le credenziali solo se richiesto
         if self.save_creds_checkbox.isChecked():
             try:
+                config = {
+                    'api_id': api_id, 
+                    'api_hash': api_hash, 
+                    'phone': phone,
+                    'save_credentials': True
+                }
+                # Gli account aggiuntivi (vedi core.load_accounts) restano in config.json
+                try:
+                    with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+                        previous = json.load(f)
+                except (FileNotFoundError, json.JSONDecodeError):
+                    previous = {}
+                if previous.get('accounts'):
+                    config['accounts'] = previous['accounts']
                 with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-                    json.dump({
-                        'api_id': api_id, 
-                        'api_hash': api_hash, 
-                        'phone': phone,
-                        'save_credentials': True
-                    }, f)
+                    json.dump(config, f)
             except Exception as e:
                 QMessageBox.warning(self, 'Avviso', f'Impossibile salvare le credenziali: {str(e)}')
         
@@ -361,143 +373,191 @@ class LoginWidget(QWidget):
         # Avvia il processo di login
         QTimer.singleShot(100, lambda: self.on_login(api_id, api_hash, phone))
 
+def make_thumbnail(source, size=THUMBNAIL_SIZE):
+    """Miniatura JPEG (lato massimo 'size' pixel) di un'immagine, None se non decodificabile.
+
+    source può essere il percorso del file (letto direttamente da Qt) o i suoi byte.
+    """
+    image = QImage(source) if isinstance(source, str) else QImage.fromData(source)
+    if image.isNull():
+        return None
+    thumbnail = image.scaled(size, size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+    data = QByteArray()
+    buffer = QBuffer(data)
+    buffer.open(QIODevice.WriteOnly)
+    thumbnail.save(buffer, 'JPEG', 85)
+    buffer.close()
+    return bytes(data)
+
+class ThumbnailWorker(QObject):
+    """Genera in un thread a parte le miniature mancanti (es. foto salvate dal demone senza Pillow).
+
+    Il thread della GUI non decodifica mai l'originale: finché la miniatura non
+    è pronta le righe mostrano un segnaposto, poi ready(image_id, dati JPEG)
+    arriva nel thread della GUI. Le immagini non decodificabili non vengono
+    ritentate.
+    """
+
+    ready = Signal(object, bytes)
+
+    def __init__(self):
+        super().__init__()
+        self._queue = queue.Queue()
+        self._requested = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def request(self, image_id, image):
+        """Accoda la generazione della miniatura (una sola volta per immagine)"""
+        with self._lock:
+            if image_id in self._requested:
+                return
+            self._requested.add(image_id)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='ThumbnailWorker', daemon=True)
+            self._thread.start()
+        self._queue.put((image_id, image))
+
+    def _run(self):
+        while True:
+            image_id, image = self._queue.get()
+            data = None
+            try:
+                img_bytes = read_image_bytes(image)
+                data = make_thumbnail(img_bytes) if img_bytes else None
+                if data is not None and image.get('sha256'):
+                    get_media_store().put_thumbnail(image['sha256'], data)
+            except Exception as e:
+                print(f"Errore nella miniatura dell'immagine {image_id}: {e}")
+            if data is not None:
+                with self._lock:
+                    self._requested.discard(image_id)
+                self.ready.emit(image_id, data)
+
 class MessageListener(QThread):
-    new_message = Signal(dict)
-    def __init__(self, api_id, api_hash, phone):
+    """Thread Qt che esegue l'acquisizione Telegram (TelegramIngestor, in core.py).
+
+    I lotti di messaggi salvati e i cambi di stato della connessione arrivano
+    alla GUI come segnali; il thread termina solo per un errore non
+    recuperabile o con shutdown(). accounts è la lista di core.load_accounts().
+    """
+
+    # Entrambi i segnali portano una lista di messaggi
+    new_messages = Signal(list)
+    messages_updated = Signal(list)
+    connection_changed = Signal(str)
+
+    def __init__(self, accounts):
         super().__init__()
-        self.api_id = api_id
-        self.api_hash = api_hash
-        self.phone = phone
-        self.client = None
-        self.start_time = datetime.datetime.utcnow().isoformat()
+        self.ingestor = TelegramIngestor(accounts, thumbnailer=make_thumbnail,
+                                         on_messages=self.new_messages.emit,
+                                         on_updated=self.messages_updated.emit,
+                                         on_state=self.connection_changed.emit)
+        self.start_time = self.ingestor.start_time
+
+    @property
+    def fatal_error(self):
+        return self.ingestor.fatal_error
 
     def run(self):
-        import asyncio
         try:
-            asyncio.run(self._main())
+            asyncio.run(self.ingestor.run())
         except Exception as e:
             print(f"Errore in MessageListener.run(): {e}")
             raise
 
-    async def _main(self):
-        try:
-            self.client = TelegramClient(SESSION_FILE, self.api_id, self.api_hash)
-            await self.client.start(phone=self.phone)
-            
-            @self.client.on(events.NewMessage)
-            async def handler(event):
-                sender = await event.get_sender()
-                now = datetime.datetime.utcnow().isoformat()
-                sender_info = self.extract_sender_info(sender)
-                # Salva info gruppo se presente
-                chat_info = None
-                if hasattr(event, 'chat') and event.chat:
-                    chat_info = self.extract_sender_info(event.chat)
-                image_id = None
-                if hasattr(event.message, 'photo') and event.message.photo:
-                    # Scarica la foto in memoria e codifica in base64
-                    img_bytes = await self.client.download_media(event.message.photo, file=bytes)
-                    if img_bytes:
-                        image_id = str(uuid.uuid4())
-                        self.save_image(image_id, img_bytes, now, sender_info, chat_info)
-                msg = {
-                    'from_id': str(event.sender_id),
-                    'text': event.raw_text,
-                    'date': str(event.date),
-                    'received_at': now,
-                    'sender': sender_info,
-                    'chat': chat_info if chat_info else None,
-                    'image_id': image_id
-                }
-                self.save_message(msg)
-                self.save_contact(sender_info)
-                if chat_info:
-                    self.save_contact(chat_info)
-                self.new_message.emit(msg)
-            
-            await self.client.run_until_disconnected()
-            
-        except Exception as e:
-            print(f"Errore in _main(): {e}")
-            raise
+    def shutdown(self):
+        """Disconnette il client (da qualunque thread) e scrive le modifiche in sospeso"""
+        self.ingestor.shutdown()
 
-    def extract_sender_info(self, sender):
-        if sender is None:
-            return {'type': 'unknown'}
-        info = {'id': str(getattr(sender, 'id', ''))}
-        if isinstance(sender, User):
-            info['type'] = 'user'
-            info['first_name'] = getattr(sender, 'first_name', '')
-            info['last_name'] = getattr(sender, 'last_name', '')
-            info['username'] = getattr(sender, 'username', '')
-            info['phone'] = getattr(sender, 'phone', '')
-            info['is_self'] = getattr(sender, 'is_self', False)
-        elif isinstance(sender, Channel):
-            info['type'] = 'channel'
-            info['title'] = getattr(sender, 'title', '')
-            info['username'] = getattr(sender, 'username', '')
-            info['is_verified'] = getattr(sender, 'verified', False)
-            info['is_scam'] = getattr(sender, 'scam', False)
-            info['is_gigagroup'] = getattr(sender, 'gigagroup', False)
-        elif isinstance(sender, Chat):
-            info['type'] = 'group'
-            info['title'] = getattr(sender, 'title', '')
-            info['username'] = getattr(sender, 'username', '')
-            info['is_megagroup'] = getattr(sender, 'megagroup', False)
-        else:
-            info['type'] = 'unknown'
-        return info
+    def status(self):
+        return self.ingestor.status()
 
-    def save_message(self, msg):
-        messages = []
-        if os.path.exists(MESSAGES_FILE):
-            try:
-                with open(MESSAGES_FILE, 'r', encoding='utf-8') as f:
-                    messages = json.load(f)
-            except Exception:
-                messages = []
-        messages.append(msg)
-        with open(MESSAGES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(messages, f, ensure_ascii=False, indent=2)
-
-    def save_contact(self, sender):
-        contacts = {}
-        if os.path.exists(CONTACTS_FILE):
-            try:
-                with open(CONTACTS_FILE, 'r', encoding='utf-8') as f:
-                    contacts = json.load(f)
-            except Exception:
-                contacts = {}
-        sid = str(sender.get('id', ''))
-        if sid and sid not in contacts:
-            contacts[sid] = sender
-        elif sid:
-            contacts[sid].update(sender)
-        with open(CONTACTS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(contacts, f, ensure_ascii=False, indent=2)
-
-    def save_image(self, image_id, img_bytes, date, sender_info, chat_info):
-        images = {}
-        if os.path.exists(IMAGES_FILE):
+    def apply_settings(self, settings):
+        self.ingestor.apply_settings(settings)
+
+class DaemonConnection(QThread):
+    """Collega la GUI a un demone già in esecuzione (daemon.py) invece di avviare un client Telegram.
+
+    Ha la stessa interfaccia di MessageListener: riceve dal server locale del
+    demone (una riga JSON per evento) i lotti di messaggi salvati e lo stato
+    della connessione. Chiudere la GUI non ferma il demone.
+    """
+
+    new_messages = Signal(list)
+    messages_updated = Signal(list)
+    connection_changed = Signal(str)
+
+    def __init__(self, daemon_info):
+        super().__init__()
+        self.daemon_info = daemon_info
+        self.start_time = datetime.datetime.utcnow().isoformat()
+        self.fatal_error = None
+        self._status = {}
+        self._socket = None
+        self._send_lock = threading.Lock()
+        self._closing = False
+
+    def run(self):
+        try:
+            self._socket = socket.create_connection((DAEMON_HOST, int(self.daemon_info['port'])), timeout=5)
+            self._socket.settimeout(None)
+            self._send({'type': 'hello', 'token': self.daemon_info.get('token')})
+            with self._socket.makefile('rb') as stream:
+                for line in stream:
+                    self._handle(decode_json(line))
+        except Exception as e:
+            if not self._closing:
+                self.fatal_error = f"Connessione al demone interrotta: {e}"
+        if not self._closing and self.fatal_error is None:
+            self.fatal_error = 'Il demone ha chiuso la connessione'
+
+    def _handle(self, event):
+        kind = event.get('type')
+        if kind == 'status':
+            state = event['status'].get('connection_state')
+            changed = state != self._status.get('connection_state')
+            self._status = event['status']
+            if changed:
+                self.connection_changed.emit(state)
+        elif kind in ('messages', 'updated'):
+            # I contatti sono già salvati dal demone: qui basta il registro in memoria
+            registry = get_contact_registry()
+            for contact in event.get('contacts') or ():
+                registry.update(contact)
+            messages = [MessageRecord.from_dict(data) for data in event.get('messages') or ()]
+            signal = self.new_messages if kind == 'messages' else self.messages_updated
+            signal.emit(messages)
+
+    def _send(self, request):
+        with self._send_lock:
+            self._socket.sendall((encode_json(request) + '\n').encode('utf-8'))
+
+    def status(self):
+        return dict(self._status, daemon=True)
+
+    def apply_settings(self, settings):
+        """Il demone rilegge settings.json appena salvato"""
+        try:
+            self._send({'type': 'settings'})
+        except (OSError, AttributeError) as e:
+            print(f"Errore nell'invio delle impostazioni al demone: {e}")
+
+    def shutdown(self):
+        """Si scollega dal demone, che continua l'acquisizione"""
+        self._closing = True
+        if self._socket is not None:
             try:
-                with open(IMAGES_FILE, 'r', encoding='utf-8') as f:
-                    images = json.load(f)
-            except Exception:
-                images = {}
-        images[image_id] = {
-            'base64': base64.b64encode(img_bytes).decode('utf-8'),
-            'date': date,
-            'sender': sender_info,
-            'chat': chat_info
-        }
-        with open(IMAGES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(images, f, ensure_ascii=False, indent=2)
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._socket.close()
 
 class SettingsDialog(QDialog):
     def __init__(self, parent=None):
         super().__init__(parent)
         self.setWindowTitle('Impostazioni AutomaticTelReader')
-        self.setFixedSize(500, 400)
+        self.setFixedSize(500, 520)
         self.setup_ui()
         self.load_settings()
 
@@ -569,7 +629,7 @@ class SettingsDialog(QDialog):
         messages_layout = QVBoxLayout()
         
         max_messages_layout = QHBoxLayout()
-        max_messages_label = QLabel("Numero massimo di messaggi da visualizzare:")
+        max_messages_label = QLabel("Numero massimo di messaggi da conservare:")
         max_messages_layout.addWidget(max_messages_label)
         self.max_messages = QSpinBox()
         self.max_messages.setRange(50, 10000)
@@ -580,6 +640,39 @@ class SettingsDialog(QDialog):
         max_messages_layout.addStretch()
         messages_layout.addLayout(max_messages_layout)
         
+        # Conservazione della cronologia salvata
+        max_age_layout = QHBoxLayout()
+        max_age_layout.addWidget(QLabel("Elimina i messaggi più vecchi di:"))
+        self.max_message_age_days = QSpinBox()
+        self.max_message_age_days.setRange(0, 3650)
+        self.max_message_age_days.setSuffix(" giorni")
+        self.max_message_age_days.setSpecialValueText("Mai")
+        self.max_message_age_days.setMinimumWidth(180)
+        max_age_layout.addWidget(self.max_message_age_days)
+        max_age_layout.addStretch()
+        messages_layout.addLayout(max_age_layout)
+        
+        archive_layout = QHBoxLayout()
+        archive_layout.addWidget(QLabel("Archivia (compressi) i messaggi più vecchi di:"))
+        self.archive_after_days = QSpinBox()
+        self.archive_after_days.setRange(0, 3650)
+        self.archive_after_days.setSuffix(" giorni")
+        self.archive_after_days.setSpecialValueText("Mai")
+        self.archive_after_days.setMinimumWidth(180)
+        archive_layout.addWidget(self.archive_after_days)
+        archive_layout.addStretch()
+        messages_layout.addLayout(archive_layout)
+        
+        scope_layout = QHBoxLayout()
+        scope_layout.addWidget(QLabel("Applica i limiti:"))
+        self.retention_scope = QComboBox()
+        self.retention_scope.addItem("a tutta la cronologia", 'global')
+        self.retention_scope.addItem("a ogni chat separatamente", 'per_chat')
+        self.retention_scope.setMinimumWidth(180)
+        scope_layout.addWidget(self.retention_scope)
+        scope_layout.addStretch()
+        messages_layout.addLayout(scope_layout)
+        
         self.auto_scroll = QCheckBox("Scorri automaticamente ai nuovi messaggi")
         self.auto_scroll.setChecked(True)
         messages_layout.addWidget(self.auto_scroll)
@@ -623,36 +716,38 @@ class SettingsDialog(QDialog):
 
     def load_settings(self):
         """Carica le impostazioni salvate"""
-        settings_file = 'settings.json'
-        if os.path.exists(settings_file):
-            try:
-                with open(settings_file, 'r', encoding='utf-8') as f:
-                    settings = json.load(f)
-                
-                self.sound_notifications.setChecked(settings.get('sound_notifications', False))
-                self.desktop_notifications.setChecked(settings.get('desktop_notifications', True))
-                self.minimize_to_tray.setChecked(settings.get('minimize_to_tray', False))
-                self.max_messages.setValue(settings.get('max_messages', 1000))
-                self.auto_scroll.setChecked(settings.get('auto_scroll', True))
-                self.auto_save_images.setChecked(settings.get('auto_save_images', True))
-                self.debug_mode.setChecked(settings.get('debug_mode', False))
-            except Exception:
-                pass
+        settings = load_settings()
+        self.sound_notifications.setChecked(settings['sound_notifications'])
+        self.desktop_notifications.setChecked(settings['desktop_notifications'])
+        self.minimize_to_tray.setChecked(settings['minimize_to_tray'])
+        self.max_messages.setValue(settings['max_messages'])
+        self.max_message_age_days.setValue(settings['max_message_age_days'])
+        self.archive_after_days.setValue(settings['archive_after_days'])
+        scope_index = self.retention_scope.findData(settings['retention_scope'])
+        self.retention_scope.setCurrentIndex(max(scope_index, 0))
+        self.auto_scroll.setChecked(settings['auto_scroll'])
+        self.auto_save_images.setChecked(settings['auto_save_images'])
+        self.debug_mode.setChecked(settings['debug_mode'])
 
     def save_settings(self):
         """Salva le impostazioni"""
-        settings = {
+        # Parte dalle impostazioni esistenti per non perdere le chiavi senza controllo nella finestra
+        settings = load_settings()
+        settings.update({
             'sound_notifications': self.sound_notifications.isChecked(),
             'desktop_notifications': self.desktop_notifications.isChecked(),
             'minimize_to_tray': self.minimize_to_tray.isChecked(),
             'max_messages': self.max_messages.value(),
+            'max_message_age_days': self.max_message_age_days.value(),
+            'archive_after_days': self.archive_after_days.value(),
+            'retention_scope': self.retention_scope.currentData(),
             'auto_scroll': self.auto_scroll.isChecked(),
             'auto_save_images': self.auto_save_images.isChecked(),
             'debug_mode': self.debug_mode.isChecked()
-        }
+        })
         
         try:
-            with open('settings.json', 'w', encoding='utf-8') as f:
+            with open(SETTINGS_FILE, 'w', encoding='utf-8') as f:
                 json.dump(settings, f, indent=2)
             
             QMessageBox.information(self, 'Impostazioni salvate', 
@@ -672,7 +767,10 @@ class SettingsDialog(QDialog):
             self.sound_notifications.setChecked(False)
             self.desktop_notifications.setChecked(True)
             self.minimize_to_tray.setChecked(False)
-            self.max_messages.setValue(1000)
+            self.max_messages.setValue(DEFAULT_SETTINGS['max_messages'])
+            self.max_message_age_days.setValue(DEFAULT_SETTINGS['max_message_age_days'])
+            self.archive_after_days.setValue(DEFAULT_SETTINGS['archive_after_days'])
+            self.retention_scope.setCurrentIndex(self.retention_scope.findData(DEFAULT_SETTINGS['retention_scope']))
             self.auto_scroll.setChecked(True)
             self.auto_save_images.setChecked(True)
             self.debug_mode.setChecked(False)
@@ -830,17 +928,15 @@ class ContactsDialog(QDialog):
         self.list_widget.clear()
         self.all_contacts = {}
         
-        if os.path.exists(CONTACTS_FILE):
-            try:
-                with open(CONTACTS_FILE, 'r', encoding='utf-8') as f:
-                    contacts = json.load(f)
-                self.all_contacts = contacts
+        try:
+            contacts = get_contact_registry().all()
+            self.all_contacts = contacts
+            
+            for cid, info in contacts.items():
+                self.add_contact_item(cid, info)
                 
-                for cid, info in contacts.items():
-                    self.add_contact_item(cid, info)
-                    
-            except Exception as e:
-                QMessageBox.warning(self, 'Errore', f'Errore nel caricamento contatti: {str(e)}')
+        except Exception as e:
+            QMessageBox.warning(self, 'Errore', f'Errore nel caricamento contatti: {str(e)}')
         
         self.update_count()
 
@@ -980,10 +1076,123 @@ class ContactsDialog(QDialog):
             QMessageBox.critical(self, 'Errore esportazione', 
                 f'❌ Errore durante l\'esportazione:\n{str(e)}')
 
+class ImageCache:
+    """Cache condivisa da tutti i visualizzatori: metadati, byte e QImage decodificate.
+
+    Le voci sono in un'unica LRU limitata in byte, quindi una lista con molte foto
+    non rilegge né ridecodifica la stessa immagine più volte.
+    """
+
+    def __init__(self, max_bytes=IMAGE_CACHE_MAX_BYTES):
+        self._cache = LRUCache(max_bytes)
+        self.thumbnails = ThumbnailWorker()
+
+    def metadata(self, image_id):
+        """Metadati di un'immagine (None se non esiste)"""
+        if not image_id:
+            return None
+        image = self._cache.get(('meta', image_id))
+        if image is None:
+            image = get_store().get_image(image_id)
+            if image is not None:
+                self._put_metadata(image_id, image)
+        return image
+
+    def prefetch_metadata(self, image_ids):
+        """Carica con un'unica query i metadati non ancora in cache"""
+        missing = [image_id for image_id in set(image_ids) if image_id and ('meta', image_id) not in self._cache]
+        if missing:
+            for image_id, image in get_store().get_images(missing).items():
+                self._put_metadata(image_id, image)
+
+    def _put_metadata(self, image_id, image):
+        self._cache.put(('meta', image_id), image, len(json.dumps(image, ensure_ascii=False)))
+
+    def image_bytes(self, image_id):
+        """Byte originali dell'immagine"""
+        image = self.metadata(image_id)
+        if image is None:
+            return None
+        key = ('bytes', image.get('sha256') or image_id)
+        img_bytes = self._cache.get(key)
+        if img_bytes is None:
+            img_bytes = read_image_bytes(image)
+            if img_bytes:
+                self._cache.put(key, img_bytes, len(img_bytes))
+        return img_bytes
+
+    def qimage(self, image_id):
+        """QImage decodificata (None se l'immagine non è leggibile)"""
+        image = self.metadata(image_id)
+        if image is None:
+            return None
+        key = ('qimage', image.get('sha256') or image_id)
+        qimage = self._cache.get(key)
+        if qimage is None:
+            img_bytes = self.image_bytes(image_id)
+            if not img_bytes:
+                return None
+            qimage = QImage.fromData(img_bytes)
+            if qimage.isNull():
+                return None
+            self._cache.put(key, qimage, qimage.sizeInBytes())
+        return qimage
+
+    def thumbnail(self, image_id):
+        """QImage della miniatura, senza mai decodificare l'originale nel thread della GUI.
+
+        Se la miniatura non esiste ancora (immagine salvata prima delle miniature
+        o dal demone senza Pillow) la chiede a self.thumbnails e restituisce None:
+        il chiamante mostra un segnaposto fino al segnale ready.
+        """
+        image = self.metadata(image_id)
+        if image is None:
+            return None
+        sha256 = image.get('sha256')
+        thumb = self._cache.get(('thumb', sha256 or image_id))
+        if thumb is None:
+            data = get_media_store().read_thumbnail(sha256) if sha256 else None
+            if data is None:
+                self.thumbnails.request(image_id, image)
+                return None
+            thumb = self.put_thumbnail(image_id, data)
+        return thumb
+
+    def put_thumbnail(self, image_id, data):
+        """Mette in cache la miniatura (dati JPEG) e ne restituisce la QImage"""
+        image = self.metadata(image_id)
+        key = ('thumb', (image or {}).get('sha256') or image_id)
+        thumb = self._cache.get(key)
+        if thumb is None:
+            thumb = QImage.fromData(data)
+            if thumb.isNull():
+                return None
+            self._cache.put(key, thumb, thumb.sizeInBytes())
+        return thumb
+
+    def invalidate(self, image_id=None):
+        """Rimuove un'immagine dalla cache (o svuota tutto se image_id è None)"""
+        if image_id is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(('meta', image_id))
+
+    def stats(self):
+        return self._cache.stats()
+
+_image_cache = None
+
+def get_image_cache():
+    """Cache immagini condivisa dall'intero processo"""
+    global _image_cache
+    if _image_cache is None:
+        _image_cache = ImageCache()
+    return _image_cache
+
 class ImageDialog(QDialog):
-    def __init__(self, image_base64, sender_info=None, date=None, parent=None):
+    def __init__(self, image_bytes, sender_info=None, date=None, parent=None):
         super().__init__(parent)
-        self.image_base64 = image_base64
+        self.image_bytes = image_bytes
         self.sender_info = sender_info or {}
         self.date = date
         self.setup_ui()
@@ -1054,8 +1263,7 @@ class ImageDialog(QDialog):
         
         # Carica e mostra l'immagine
         try:
-            img_bytes = base64.b64decode(self.image_base64)
-            image = QImage.fromData(img_bytes)
+            image = QImage.fromData(self.image_bytes)
             
             if not image.isNull():
                 self.pixmap = QPixmap.fromImage(image)
@@ -1182,9 +1390,8 @@ class ImageDialog(QDialog):
             )
             
             if filename:
-                img_bytes = base64.b64decode(self.image_base64)
                 with open(filename, 'wb') as f:
-                    f.write(img_bytes)
+                    f.write(self.image_bytes)
                 
                 QMessageBox.information(self, 'Salvataggio completato',
                     f'✅ Immagine salvata con successo:\n{filename}')
@@ -1216,49 +1423,207 @@ class MessagesOfChatDialog(QDialog):
 
     def load_messages(self, chat_id):
         self.list_widget.clear()
-        if os.path.exists(MESSAGES_FILE):
-            with open(MESSAGES_FILE, 'r', encoding='utf-8') as f:
-                messages = json.load(f)
-            for msg in messages:
-                chat = msg.get('chat') or msg.get('sender')
-                if not chat or chat.get('id') != chat_id:
-                    continue
-                text = msg.get('text', '')
-                date = msg.get('date', '')
-                image_id = msg.get('image_id')
-                # Visualizzazione stile WhatsApp
-                if image_id and not text.strip():
-                    text = "[Immagine]"
-                elif image_id and text.strip():
-                    text = f"[Immagine] {text}"
-                display = f"[{date}] {text}"
-                item = QListWidgetItem(display)
-                if image_id:
-                    item.setToolTip('Clicca per vedere l\'immagine')
-                    item.setData(Qt.UserRole, image_id)
-                else:
-                    item.setFlags(item.flags() & ~Qt.ItemIsEnabled)
-                self.list_widget.addItem(item)
+        # Prima la cronologia archiviata (solo i segmenti che contengono la chat), poi quella recente
+        messages = list(get_archive().iter_messages(chat_id=chat_id))
+        messages.extend(get_message_backend().range_by_chat(chat_id))
+        get_image_cache().prefetch_metadata(image_id for msg in messages for image_id in message_image_ids(msg))
+        for msg in messages:
+            text = msg.get('text', '')
+            date = msg.get('date', '')
+            image_id = msg.get('image_id')
+            # Visualizzazione stile WhatsApp
+            if image_id and not text.strip():
+                text = "[Immagine]"
+            elif image_id and text.strip():
+                text = f"[Immagine] {text}"
+            display = f"[{date}] {text}"
+            item = QListWidgetItem(display)
+            if image_id:
+                item.setToolTip('Clicca per vedere l\'immagine')
+                item.setData(Qt.UserRole, image_id)
+            else:
+                item.setFlags(item.flags() & ~Qt.ItemIsEnabled)
+            self.list_widget.addItem(item)
 
     def show_image_if_any(self, item):
         image_id = item.data(Qt.UserRole)
         if image_id:
             image_data = self.load_image_data(image_id)
             if image_data:
-                image_b64 = image_data.get('base64')
+                img_bytes = get_image_cache().image_bytes(image_id)
                 sender_info = image_data.get('sender')
                 date = image_data.get('date')
-                if image_b64:
-                    self.image_dialog = ImageDialog(image_b64, sender_info, date, self)
+                if img_bytes:
+                    self.image_dialog = ImageDialog(img_bytes, sender_info, date, self)
                     self.image_dialog.exec()
                     self.image_dialog = None
 
     def load_image_data(self, image_id):
-        if os.path.exists(IMAGES_FILE):
-            with open(IMAGES_FILE, 'r', encoding='utf-8') as f:
-                images = json.load(f)
-            return images.get(image_id)
-        return None
+        return get_image_cache().metadata(image_id)
+
+class SearchDialog(QDialog):
+    """Ricerca full-text nella cronologia salvata, con risultati paginati"""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle('🔍 Cerca nei messaggi')
+        self.setMinimumSize(650, 500)
+        self.page = 0
+        self.total = 0
+        self.image_dialog = None
+        # Attende una breve pausa nella digitazione prima di interrogare il database
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(250)
+        self.search_timer.timeout.connect(self.run_search)
+        self.setup_ui()
+
+    def setup_ui(self):
+        self.setStyleSheet("""
+            QDialog {
+                background-color: #2b2b2b;
+                color: #ffffff;
+            }
+            QListWidget {
+                background: #333333;
+                border: 1px solid #555555;
+                border-radius: 8px;
+                padding: 5px;
+                color: #ffffff;
+            }
+            QListWidget::item {
+                border-bottom: 1px solid #444444;
+            }
+            QListWidget::item:selected {
+                background-color: #0078d4;
+            }
+            QPushButton {
+                background-color: #0078d4;
+                color: white;
+                border: none;
+                border-radius: 6px;
+                padding: 8px 16px;
+                font-weight: bold;
+            }
+            QPushButton:hover {
+                background-color: #106ebe;
+            }
+            QPushButton:disabled {
+                background-color: #555555;
+                color: #999999;
+            }
+            QLabel {
+                color: #ffffff;
+            }
+            QLineEdit {
+                background-color: #3c3c3c;
+                color: #ffffff;
+                border: 1px solid #555555;
+                border-radius: 6px;
+                padding: 8px;
+                font-size: 12px;
+            }
+        """)
+        layout = QVBoxLayout()
+
+        self.search_input = QLineEdit()
+        self.search_input.setPlaceholderText('Cerca nel testo dei messaggi...')
+        self.search_input.textChanged.connect(self.on_text_changed)
+        layout.addWidget(self.search_input)
+
+        self.list_widget = QListWidget()
+        self.list_widget.itemClicked.connect(self.show_image_if_any)
+        layout.addWidget(self.list_widget)
+
+        nav_layout = QHBoxLayout()
+        self.prev_btn = QPushButton('◀ Precedente')
+        self.prev_btn.clicked.connect(self.prev_page)
+        nav_layout.addWidget(self.prev_btn)
+
+        self.info_label = QLabel()
+        self.info_label.setStyleSheet("font-size: 10px; color: #aaaaaa;")
+        self.info_label.setAlignment(Qt.AlignCenter)
+        nav_layout.addWidget(self.info_label, 1)
+
+        self.next_btn = QPushButton('Successiva ▶')
+        self.next_btn.clicked.connect(self.next_page)
+        nav_layout.addWidget(self.next_btn)
+        layout.addLayout(nav_layout)
+
+        self.setLayout(layout)
+        self.update_navigation(0.0)
+
+    def on_text_changed(self, _text):
+        self.page = 0
+        self.search_timer.start()
+
+    def run_search(self):
+        query = self.search_input.text().strip()
+        self.list_widget.clear()
+        if not query:
+            self.total = 0
+            self.update_navigation(0.0)
+            return
+        start = time.perf_counter()
+        try:
+            self.total, results = get_message_backend().search(query, SEARCH_PAGE_SIZE, self.page * SEARCH_PAGE_SIZE)
+        except sqlite3.Error as e:
+            self.total, results = 0, []
+            self.info_label.setText(f'Ricerca non valida: {e}')
+            return
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        get_image_cache().prefetch_metadata(image_id for msg, _ in results for image_id in message_image_ids(msg))
+        for msg, fragment in results:
+            self.add_result_item(msg, fragment)
+        self.update_navigation(elapsed_ms)
+
+    def add_result_item(self, msg, fragment):
+        """Aggiunge un risultato con i termini trovati evidenziati"""
+        fragment = html.escape(fragment)
+        fragment = fragment.replace(SEARCH_MATCH_START, '<b style="color:#ffd54f;">').replace(SEARCH_MATCH_END, '</b>')
+        name = html.escape(str(MessagesWidget.get_display_name(msg)))
+        date = html.escape(msg.get('date', ''))
+        image_mark = '📷 ' if msg.get('image_id') else ''
+        label = QLabel(f'<span style="color:#aaaaaa; font-size:10px;">{date} · {name}</span><br>{image_mark}{fragment}')
+        label.setTextFormat(Qt.RichText)
+        label.setWordWrap(True)
+        label.setStyleSheet("padding: 6px; font-size: 11px;")
+        item = QListWidgetItem()
+        item.setData(Qt.UserRole, msg)
+        if msg.get('image_id'):
+            item.setToolTip('Clicca per vedere l\'immagine')
+        item.setSizeHint(label.sizeHint())
+        self.list_widget.addItem(item)
+        self.list_widget.setItemWidget(item, label)
+
+    def update_navigation(self, elapsed_ms):
+        pages = max(1, (self.total + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE)
+        self.prev_btn.setEnabled(self.page > 0)
+        self.next_btn.setEnabled(self.page + 1 < pages)
+        if self.search_input.text().strip():
+            self.info_label.setText(f'Pagina {self.page + 1}/{pages} · {self.total} risultati · {elapsed_ms:.0f} ms')
+        else:
+            self.info_label.setText('')
+
+    def prev_page(self):
+        if self.page > 0:
+            self.page -= 1
+            self.run_search()
+
+    def next_page(self):
+        if (self.page + 1) * SEARCH_PAGE_SIZE < self.total:
+            self.page += 1
+            self.run_search()
+
+    def show_image_if_any(self, item):
+        msg = item.data(Qt.UserRole)
+        image_id = msg.get('image_id') if msg else None
+        if image_id:
+            img_bytes = get_image_cache().image_bytes(image_id)
+            if img_bytes:
+                self.image_dialog = ImageDialog(img_bytes, msg.get('sender', {}), msg.get('date'), self)
+                self.image_dialog.exec()
+                self.image_dialog = None
 
 class TradingDialog(QDialog):
     def __init__(self, parent=None):
@@ -1988,22 +2353,17 @@ class ChatsDialog(QDialog):
 
     def load_chats(self):
         self.list_widget.clear()
-        if os.path.exists(MESSAGES_FILE):
-            with open(MESSAGES_FILE, 'r', encoding='utf-8') as f:
-                messages = json.load(f)
-            chats = {}
-            for msg in messages:
-                chat = msg.get('chat') or msg.get('sender')
-                if not chat:
-                    continue
-                chat_id = chat.get('id')
-                chat_title = chat.get('title') or chat.get('first_name') or chat.get('username') or chat_id
-                if chat_id not in chats:
-                    chats[chat_id] = {'title': chat_title}
-            for cid, info in chats.items():
-                item = QListWidgetItem(f"{info['title']}")
-                item.setData(Qt.UserRole, cid)
-                self.list_widget.addItem(item)
+        chats = get_message_backend().chats()
+        # Chat presenti solo nei segmenti archiviati: i dati vengono dal registro contatti
+        known = {chat_id for chat_id, _ in chats}
+        registry = get_contact_registry()
+        for chat_id in sorted(get_archive().chat_ids() - known):
+            chats.append((chat_id, registry.get(chat_id) or {}))
+        for chat_id, chat in chats:
+            chat_title = chat.get('title') or chat.get('first_name') or chat.get('username') or chat_id
+            item = QListWidgetItem(f"{chat_title}")
+            item.setData(Qt.UserRole, chat_id)
+            self.list_widget.addItem(item)
 
     def show_messages_of_chat(self, item):
         chat_id = item.data(Qt.UserRole)
@@ -2011,154 +2371,196 @@ class ChatsDialog(QDialog):
         dialog = MessagesOfChatDialog(chat_id, chat_title, self)
         dialog.exec()
 
-class MessageItemWidget(QWidget):
-    """Widget personalizzato per visualizzare un messaggio con eventuale anteprima immagine"""
-    
-    def __init__(self, msg_data, parent=None):
+class MessageListModel(QAbstractListModel):
+    """Messaggi della sessione come modello di una QListView.
+
+    Un lotto di messaggi diventa un solo beginInsertRows/endInsertRows e le
+    righe vengono disegnate da MessageItemDelegate: nessun widget per riga.
+    Qt.UserRole restituisce il MessageRecord.
+    """
+
+    def __init__(self, parent=None):
         super().__init__(parent)
-        self.msg_data = msg_data
-        self.setup_ui()
-    
-    def setup_ui(self):
-        layout = QHBoxLayout()
-        layout.setContentsMargins(8, 8, 8, 8)
-        layout.setSpacing(10)
-        
-        # Layout principale per testo
-        text_layout = QVBoxLayout()
-        text_layout.setSpacing(4)
-        
-        # Header con ora e mittente
-        display_name = self.get_display_name()
+        self._messages = []
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._messages)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        msg = self._messages[index.row()]
+        if role == Qt.UserRole:
+            return msg
+        if role == Qt.DisplayRole:
+            return msg.get('text', '')
+        if role == Qt.ToolTipRole:
+            if msg.get('deleted_at'):
+                return "Messaggio eliminato su Telegram"
+            if msg.get('image_id'):
+                return "🖼️ Clicca per ingrandire"
+        return None
+
+    def set_messages(self, messages):
+        self.beginResetModel()
+        self._messages = list(messages)
+        self.endResetModel()
+
+    def append(self, messages):
+        """Aggiunge in fondo un lotto di messaggi con un solo inserimento"""
+        if not messages:
+            return
+        start = len(self._messages)
+        self.beginInsertRows(QModelIndex(), start, start + len(messages) - 1)
+        self._messages.extend(messages)
+        self.endInsertRows()
+
+    def remove_first(self, count):
+        """Rimuove le prime count righe (le più vecchie) con una sola rimozione"""
+        count = min(count, len(self._messages))
+        if count <= 0:
+            return
+        self.beginRemoveRows(QModelIndex(), 0, count - 1)
+        del self._messages[:count]
+        self.endRemoveRows()
+
+    def update_messages(self, messages):
+        """Sostituisce le righe dei messaggi indicati (stesso oggetto o stesso id)"""
+        by_identity = {id(msg): msg for msg in messages}
+        by_id = {msg.get('id'): msg for msg in messages if msg.get('id') is not None}
+        remaining = len(messages)
+        # I messaggi aggiornati sono quasi sempre tra gli ultimi arrivati
+        for row in range(len(self._messages) - 1, -1, -1):
+            if not remaining:
+                break
+            shown = self._messages[row]
+            msg = by_identity.get(id(shown)) or by_id.get(shown.get('id'))
+            if msg is not None:
+                self._messages[row] = msg
+                index = self.index(row)
+                self.dataChanged.emit(index, index)
+                remaining -= 1
+
+class MessageItemDelegate(QStyledItemDelegate):
+    """Disegna una riga di messaggio: ora e mittente, testo e anteprima immagine.
+
+    Le miniature vengono da get_image_cache().thumbnail(), quindi l'originale
+    non viene mai decodificato; finché manca si disegna un'icona generica.
+    """
+
+    ROW_HEIGHT = 70
+    MARGIN = 8
+
+    def sizeHint(self, option, index):
+        return QSize(400, self.ROW_HEIGHT)
+
+    def paint(self, painter, option, index):
+        msg = index.data(Qt.UserRole)
+        if msg is None:
+            return
+        self.initStyleOption(option, index)
+        painter.save()
+        # Sfondo con hover e selezione secondo il foglio di stile della lista
+        style = option.widget.style() if option.widget else QApplication.style()
+        style.drawPrimitive(QStyle.PE_PanelItemViewItem, option, painter, option.widget)
+
+        rect = option.rect.adjusted(self.MARGIN, self.MARGIN, -self.MARGIN, -self.MARGIN)
+        image_ids = message_image_ids(msg)
+        # Anteprima immagine se presente; per un album le prime foto affiancate, più piccole
+        if len(image_ids) > 1:
+            previews = image_ids[:ALBUM_PREVIEW_COUNT]
+            more = len(image_ids) - ALBUM_PREVIEW_COUNT
+            width = len(previews) * (ALBUM_PREVIEW_SIZE + 2) + (24 if more > 0 else 0)
+            x = rect.right() - width + 1
+            top = rect.top() + (rect.height() - ALBUM_PREVIEW_SIZE) // 2
+            for album_image_id in previews:
+                self.paint_thumbnail(painter, QRect(x, top, ALBUM_PREVIEW_SIZE, ALBUM_PREVIEW_SIZE), album_image_id)
+                x += ALBUM_PREVIEW_SIZE + 2
+            if more > 0:
+                font = QFont(option.font)
+                font.setPixelSize(11)
+                font.setBold(True)
+                painter.setFont(font)
+                painter.setPen(QColor('#cccccc'))
+                painter.drawText(QRect(x, rect.top(), 24, rect.height()), Qt.AlignCenter, f"+{more}")
+            rect.setRight(rect.right() - width - 10)
+        elif image_ids:
+            size = 54
+            self.paint_thumbnail(painter, QRect(rect.right() - size + 1, rect.top() + (rect.height() - size) // 2,
+                                                size, size), image_ids[0])
+            rect.setRight(rect.right() - size - 10)
+
+        header, text, deleted = self.row_texts(msg, image_ids)
+        font = QFont(option.font)
+        font.setPixelSize(11)
+        font.setBold(True)
+        painter.setFont(font)
+        painter.setPen(QColor('#cccccc'))
+        painter.drawText(QRect(rect.left(), rect.top(), rect.width(), 16),
+                         Qt.AlignLeft | Qt.AlignVCenter, header)
+        # Modifiche ed eliminazioni arrivano con messages_updated e ridisegnano la riga
+        font = QFont(option.font)
+        font.setPixelSize(12)
+        font.setStrikeOut(deleted)
+        painter.setFont(font)
+        painter.setPen(QColor('#888888' if deleted else '#ffffff'))
+        painter.drawText(QRect(rect.left(), rect.top() + 20, rect.width(), rect.height() - 20),
+                         Qt.AlignLeft | Qt.AlignTop | Qt.TextWordWrap, text)
+        painter.restore()
+
+    @staticmethod
+    def row_texts(msg, image_ids):
+        """Intestazione (icona, ora, nome), testo da mostrare e se il messaggio è eliminato"""
         try:
-            date_obj = datetime.datetime.fromisoformat(self.msg_data.get('date', '').replace('Z', '+00:00'))
+            date_obj = datetime.datetime.fromisoformat(msg.get('date', '').replace('Z', '+00:00'))
             formatted_date = date_obj.strftime('%H:%M:%S')
-        except:
+        except (TypeError, ValueError):
             formatted_date = "N/A"
-        
-        icon = "👤" if self.msg_data.get('sender', {}).get('type') == 'user' else "📢"
-        
-        header_label = QLabel(f"{icon} {formatted_date} | {display_name}")
-        header_label.setStyleSheet("font-size: 11px; color: #cccccc; font-weight: bold;")
-        text_layout.addWidget(header_label)
-        
-        # Testo del messaggio
-        text = self.msg_data.get('text', '')
-        image_id = self.msg_data.get('image_id')
+        icon = "👤" if msg.get('sender', {}).get('type') == 'user' else "📢"
+        header = f"{icon} {formatted_date} | {MessagesWidget.get_display_name(msg)}"
 
         # Visualizzazione stile WhatsApp
-        if image_id and not text.strip():
-            text = "[Immagine]"
-        elif image_id and text.strip():
-            text = f"[Immagine] {text}"
-
+        text = msg.get('text', '')
+        media_label = f"[Album: {len(image_ids)} immagini]" if len(image_ids) > 1 else "[Immagine]"
+        if image_ids and not text.strip():
+            text = media_label
+        elif image_ids and text.strip():
+            text = f"{media_label} {text}"
+        elif msg.get('media_pending'):
+            # La foto è ancora in download: arriverà con messages_updated
+            text = f"[Immagine in arrivo...] {text}".strip()
         if len(text) > 100:
             text = text[:100] + "..."
 
-        text_label = QLabel(text)
-        text_label.setStyleSheet("font-size: 12px; color: #ffffff;")
-        text_label.setWordWrap(True)
-        text_layout.addWidget(text_label)
-        
-        layout.addLayout(text_layout)
-        
-        # Anteprima immagine se presente
-        if image_id:
-            image_data = self.load_image_data(image_id)
-            if image_data and image_data.get('base64'):
-                try:
-                    # Crea thumbnail dell'immagine
-                    img_bytes = base64.b64decode(image_data['base64'])
-                    image = QImage.fromData(img_bytes)
-                    if not image.isNull():
-                        # Ridimensiona l'immagine per la thumbnail mantenendo l'aspect ratio
-                        thumbnail = image.scaled(50, 50, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-                        pixmap = QPixmap.fromImage(thumbnail)
-                        
-                        # Crea label per l'immagine con contenimento corretto
-                        image_label = QLabel()
-                        image_label.setPixmap(pixmap)
-                        image_label.setStyleSheet("""
-                            border: 2px solid #0078d4;
-                            border-radius: 4px;
-                            background-color: #404040;
-                        """)
-                        image_label.setFixedSize(54, 54)
-                        image_label.setAlignment(Qt.AlignCenter)
-                        image_label.setScaledContents(False)  # Evita lo sfondamento
-                        image_label.setToolTip("🖼️ Clicca per ingrandire")
-                        
-                        layout.addWidget(image_label)
-                except Exception as e:
-                    # Se c'è un errore nel caricamento, mostra icona generica
-                    icon_label = QLabel("🖼️")
-                    icon_label.setStyleSheet("""
-                        font-size: 24px;
-                        border: 2px solid #666666;
-                        border-radius: 4px;
-                        background-color: #404040;
-                        color: #cccccc;
-                    """)
-                    icon_label.setFixedSize(54, 54)
-                    icon_label.setAlignment(Qt.AlignCenter)
-                    icon_label.setToolTip("🖼️ Immagine (clicca per visualizzare)")
-                    layout.addWidget(icon_label)
-            else:
-                # Se non si riesce a caricare l'immagine, mostra icona generica
-                icon_label = QLabel("🖼️")
-                icon_label.setStyleSheet("""
-                    font-size: 24px;
-                    border: 2px solid #666666;
-                    border-radius: 4px;
-                    background-color: #404040;
-                    color: #cccccc;
-                """)
-                icon_label.setFixedSize(54, 54)
-                icon_label.setAlignment(Qt.AlignCenter)
-                icon_label.setToolTip("🖼️ Immagine (clicca per visualizzare)")
-                layout.addWidget(icon_label)
-        
-        self.setLayout(layout)
-        
-        # Imposta dimensione fissa per evitare problemi di layout
-        self.setFixedHeight(70)
-        
-        # Stile del widget
-        self.setStyleSheet("""
-            MessageItemWidget {
-                background-color: transparent;
-                border-radius: 4px;
-            }
-        """)
-    
-    def get_display_name(self):
-        """Ottiene il nome da visualizzare per il mittente"""
-        sender = self.msg_data.get('sender', {})
-        chat = self.msg_data.get('chat', {})
-        
-        # Preferisci il nome del gruppo/canale se presente
-        if chat and chat.get('title'):
-            return chat.get('title')
-        # Altrimenti, se utente
-        if sender.get('first_name') or sender.get('last_name'):
-            return f"{sender.get('first_name', '')} {sender.get('last_name', '')}".strip()
-        if sender.get('username'):
-            return sender.get('username')
-        if sender.get('title'):
-            return sender.get('title')
-        # Fallback: ID
-        return sender.get('id', self.msg_data.get('from_id', ''))
-    
-    def load_image_data(self, image_id):
-        """Carica i dati di un'immagine dal file JSON"""
-        if os.path.exists(IMAGES_FILE):
-            try:
-                with open(IMAGES_FILE, 'r', encoding='utf-8') as f:
-                    images = json.load(f)
-                return images.get(image_id)
-            except Exception:
-                pass
-        return None
+        deleted = bool(msg.get('deleted_at'))
+        if deleted:
+            text = f"🗑️ {text}"
+        elif msg.get('edit_date'):
+            text = f"{text} ✏️"
+        return header, text, deleted
+
+    @staticmethod
+    def paint_thumbnail(painter, rect, image_id):
+        """Miniatura dentro rect, oppure un'icona generica finché non è disponibile"""
+        thumbnail = get_image_cache().thumbnail(image_id)
+        available = thumbnail is not None and not thumbnail.isNull()
+        painter.setPen(QPen(QColor('#0078d4' if available else '#666666'), 2))
+        painter.setBrush(QColor('#404040'))
+        painter.drawRoundedRect(rect.adjusted(1, 1, -1, -1), 4, 4)
+        if available:
+            pixmap = QPixmap.fromImage(thumbnail)
+            if rect.width() < THUMBNAIL_SIZE:
+                pixmap = pixmap.scaled(rect.width() - 4, rect.height() - 4,
+                                       Qt.KeepAspectRatio, Qt.SmoothTransformation)
+            painter.drawPixmap(rect.x() + (rect.width() - pixmap.width()) // 2,
+                               rect.y() + (rect.height() - pixmap.height()) // 2, pixmap)
+        else:
+            # Miniatura in preparazione nel ThumbnailWorker: la riga viene ridisegnata quando è pronta
+            font = painter.font()
+            font.setPixelSize(rect.width() * 24 // 54)
+            painter.setFont(font)
+            painter.setPen(QColor('#cccccc'))
+            painter.drawText(rect, Qt.AlignCenter, "🖼️")
 
 class MessagesWidget(QWidget):
     def __init__(self):
@@ -2167,6 +2569,11 @@ class MessagesWidget(QWidget):
         self.session_start_time = None
         self.contacts_dialog = None
         self.message_count = 0
+        self.listener = None
+        self.retention_engine = None
+        self.display_limit = load_settings()['max_messages']
+        # Nome dell'account mostrato, None per tutti
+        self.account_filter = None
 
     def setup_ui(self):
         self.setWindowTitle('AutomaticTelReader - Monitor Messaggi')
@@ -2193,7 +2600,7 @@ class MessagesWidget(QWidget):
             QPushButton:pressed {
                 background-color: #005a9e;
             }
-            QListWidget {
+            QListView {
                 background: #333333;
                 border: 1px solid #555555;
                 border-radius: 8px;
@@ -2202,17 +2609,17 @@ class MessagesWidget(QWidget):
                 color: #ffffff;
                 alternate-background-color: #3a3a3a;
             }
-            QListWidget::item {
+            QListView::item {
                 padding: 8px;
                 border-bottom: 1px solid #444444;
                 border-radius: 4px;
                 margin-bottom: 2px;
                 color: #ffffff;
             }
-            QListWidget::item:hover {
+            QListView::item:hover {
                 background-color: #404040;
             }
-            QListWidget::item:selected {
+            QListView::item:selected {
                 background-color: #0078d4;
                 color: #ffffff;
             }
@@ -2274,6 +2681,10 @@ class MessagesWidget(QWidget):
         self.chats_btn = QPushButton('💬 Chat')
         self.chats_btn.clicked.connect(self.open_chats)
         left_layout.addWidget(self.chats_btn)
+
+        self.search_btn = QPushButton('🔍 Cerca')
+        self.search_btn.clicked.connect(self.open_search)
+        left_layout.addWidget(self.search_btn)
         
         
         # Pulsanti di utilità
@@ -2325,6 +2736,13 @@ class MessagesWidget(QWidget):
         
         header_layout.addStretch()
         
+        # Filtro per account, visibile solo con più account
+        self.account_combo = QComboBox()
+        self.account_combo.setFixedHeight(30)
+        self.account_combo.currentIndexChanged.connect(self.on_account_changed)
+        self.account_combo.hide()
+        header_layout.addWidget(self.account_combo)
+        
         # Pulsante di refresh
         self.refresh_btn = QPushButton('🔄 Aggiorna')
         self.refresh_btn.setFixedSize(100, 30)
@@ -2333,23 +2751,30 @@ class MessagesWidget(QWidget):
         
         right_layout.addLayout(header_layout)
         
-        # Lista messaggi con scroll personalizzato
-        self.list_widget = QListWidget()
-        self.list_widget.setAlternatingRowColors(True)
-        self.list_widget.setStyleSheet(self.list_widget.styleSheet() + """
-            QListWidget::item {
+        # Lista messaggi: modello e delegate, nessun widget per riga
+        self.message_model = MessageListModel(self)
+        self.list_view = QListView()
+        self.list_view.setModel(self.message_model)
+        self.list_view.setItemDelegate(MessageItemDelegate(self.list_view))
+        self.list_view.setUniformItemSizes(True)
+        self.list_view.setMouseTracking(True)
+        self.list_view.setAlternatingRowColors(True)
+        self.list_view.setStyleSheet(self.list_view.styleSheet() + """
+            QListView::item {
                 min-height: 60px;
                 padding: 8px;
             }
-            QListWidget::item:hover {
+            QListView::item:hover {
                 background-color: #404040;
                 border: 1px solid #0078d4;
                 border-radius: 4px;
             }
         """)
         # Connetti il segnale di click per visualizzare le immagini
-        self.list_widget.itemClicked.connect(self.on_message_clicked)
-        right_layout.addWidget(self.list_widget)
+        self.list_view.clicked.connect(self.on_message_clicked)
+        right_layout.addWidget(self.list_view)
+        # Le miniature generate in background vengono disegnate appena pronte
+        get_image_cache().thumbnails.ready.connect(self.on_thumbnail_ready)
         
         # Placeholder per quando non ci sono messaggi
         self.placeholder = QLabel('🔍 Nessun messaggio ricevuto in questa sessione.\n\nI nuovi messaggi appariranno qui automaticamente.')
@@ -2388,27 +2813,59 @@ class MessagesWidget(QWidget):
             hours = int(uptime.total_seconds() // 3600)
             minutes = int((uptime.total_seconds() % 3600) // 60)
             
-            status_text = f"✅ Connesso\n📊 {self.message_count} messaggi\n⏱️ {hours:02d}:{minutes:02d}"
+            status = self.listener.status() if self.listener is not None else {}
+            if status.get('connection_state') == TelegramIngestor.RECONNECTING:
+                connection = f"🔄 Riconnessione (tentativo {status.get('reconnect_attempts')})..."
+            else:
+                connection = "✅ Connesso"
+            if status.get('daemon'):
+                connection += " (demone)"
+            status_text = f"{connection}\n📊 {self.message_count} messaggi\n⏱️ {hours:02d}:{minutes:02d}"
+            if status.get('downtime', 0) >= 60:
+                down_minutes = int(status['downtime'] // 60)
+                status_text += f"\n⏸️ {down_minutes // 60:02d}:{down_minutes % 60:02d} senza connessione"
+            accounts = status.get('accounts') or {}
+            if len(accounts) > 1:
+                icons = {TelegramIngestor.CONNECTED: '✅', TelegramIngestor.RECONNECTING: '🔄',
+                         TelegramIngestor.CONNECTING: '⏳'}
+                for name, account in accounts.items():
+                    status_text += f"\n👤 {name}: {icons.get(account.get('connection_state'), '⛔')}"
+            if any(self.account_combo.findData(name) < 0 for name in accounts):
+                self.update_account_filter()
+            if status.get('writer_queue'):
+                status_text += f"\n💾 {status['writer_queue']} in scrittura"
+            filtered = status.get('filtered')
+            if filtered and filtered['dropped']:
+                status_text += f"\n🚫 {filtered['dropped']} scartati dalle regole"
+            media = status.get('media')
+            if media:
+                if media['pending'] or media['running']:
+                    status_text += (f"\n📷 {media['running'] + media['pending']} foto in download"
+                                    f" ({media['bytes_per_sec'] / 1024:.0f} KB/s)")
             self.status_label.setText(status_text)
         else:
             self.status_label.setText("🔄 Connessione in corso...")
 
-    def on_message_clicked(self, item):
+    def on_thumbnail_ready(self, image_id, data):
+        get_image_cache().put_thumbnail(image_id, data)
+        self.list_view.viewport().update()
+
+    def on_message_clicked(self, index):
         """Gestisce il click su un messaggio per visualizzare eventuali immagini"""
         try:
-            msg_data = item.data(Qt.UserRole)
+            msg_data = index.data(Qt.UserRole)
             if msg_data and msg_data.get('image_id'):
                 image_id = msg_data['image_id']
                 image_data = self.load_image_data(image_id)
                 
                 if image_data:
-                    image_b64 = image_data.get('base64')
+                    img_bytes = get_image_cache().image_bytes(image_id)
                     sender_info = msg_data.get('sender', {})
                     date = msg_data.get('date')
                     
-                    if image_b64:
+                    if img_bytes:
                         # Crea e mostra il dialog dell'immagine
-                        image_dialog = ImageDialog(image_b64, sender_info, date, self)
+                        image_dialog = ImageDialog(img_bytes, sender_info, date, self)
                         image_dialog.exec()
                 else:
                     QMessageBox.warning(self, 'Immagine non trovata', 
@@ -2418,20 +2875,28 @@ class MessagesWidget(QWidget):
                 f'Errore durante il caricamento dell\'immagine: {str(e)}')
 
     def load_image_data(self, image_id):
-        """Carica i dati di un'immagine dal file JSON"""
-        if os.path.exists(IMAGES_FILE):
-            try:
-                with open(IMAGES_FILE, 'r', encoding='utf-8') as f:
-                    images = json.load(f)
-                return images.get(image_id)
-            except Exception:
-                pass
-        return None
+        """Carica i dati di un'immagine dalla cache condivisa"""
+        try:
+            return get_image_cache().metadata(image_id)
+        except Exception:
+            return None
 
     def open_settings(self):
         """Apre una finestra delle impostazioni"""
         settings_dialog = SettingsDialog(self)
-        settings_dialog.exec()
+        if settings_dialog.exec():
+            # Applica subito i nuovi limiti alla lista e alla cronologia salvata
+            settings = load_settings()
+            self.display_limit = settings['max_messages']
+            self.apply_display_limit()
+            if self.listener is not None:
+                self.listener.apply_settings(settings)
+            if self.retention_engine is not None:
+                self.retention_engine.trigger()
+
+    def apply_display_limit(self):
+        """Rimuove dalla lista i messaggi più vecchi oltre il limite impostato"""
+        self.message_model.remove_first(self.message_model.rowCount() - self.display_limit)
 
     def open_trading(self):
         """Apre la finestra del trading forex"""
@@ -2440,10 +2905,34 @@ class MessagesWidget(QWidget):
 
     def set_session_start_time(self, start_time):
         self.session_start_time = start_time
+        self.update_account_filter()
         self.load_messages()
         self.update_status()
 
-    def get_display_name(self, msg):
+    def update_account_filter(self):
+        """Elenca nel filtro gli account acquisiti e quelli già presenti nell'archivio"""
+        accounts = set(get_message_backend().accounts())
+        if self.listener is not None:
+            accounts.update(self.listener.status().get('accounts') or ())
+        self.account_combo.blockSignals(True)
+        self.account_combo.clear()
+        self.account_combo.addItem('👥 Tutti gli account', None)
+        for account in sorted(accounts):
+            self.account_combo.addItem(f'👤 {account}', account)
+        index = self.account_combo.findData(self.account_filter) if self.account_filter else 0
+        self.account_combo.setCurrentIndex(max(index, 0))
+        self.account_combo.blockSignals(False)
+        self.account_combo.setVisible(len(accounts) > 1)
+
+    def on_account_changed(self, index):
+        self.account_filter = self.account_combo.itemData(index)
+        self.load_messages()
+
+    def is_shown_account(self, msg):
+        return self.account_filter is None or (msg.get('account') or DEFAULT_ACCOUNT) == self.account_filter
+
+    @staticmethod
+    def get_display_name(msg):
         sender = msg.get('sender', {})
         chat = msg.get('chat', {})
         # Preferisci il nome del gruppo/canale se presente
@@ -2457,64 +2946,54 @@ class MessagesWidget(QWidget):
         if sender.get('title'):
             return sender.get('title')
         # Fallback: ID
-        return sender.get('id', msg.get('from_id', ''))
+        return sender.get('id', msg.get('sender_id', ''))
 
     def load_messages(self):
-        self.list_widget.clear()
-        count = 0
-        if os.path.exists(MESSAGES_FILE):
-            with open(MESSAGES_FILE, 'r', encoding='utf-8') as f:
-                messages = json.load(f)
-            for msg in messages:
-                if self.session_start_time and msg.get('received_at') and msg['received_at'] >= self.session_start_time:
-                    # Crea il widget personalizzato per il messaggio
-                    message_widget = MessageItemWidget(msg)
-                    
-                    # Crea un item per la lista
-                    item = QListWidgetItem()
-                    item.setSizeHint(QSize(400, 70))  # Dimensione fissa
-                    
-                    # Salva i dati del messaggio nell'item per il click
-                    item.setData(Qt.UserRole, msg)
-                    
-                    # Aggiungi l'item alla lista
-                    self.list_widget.addItem(item)
-                    self.list_widget.setItemWidget(item, message_widget)
-                    
-                    count += 1
-        
-        self.message_count = count
-        self.update_placeholder(count)
+        backend = get_message_backend()
+        if not self.session_start_time:
+            messages = []
+        elif self.account_filter is not None:
+            messages = list(backend.range_by_account(self.account_filter, self.session_start_time))
+        else:
+            messages = list(backend.range_by_time(self.session_start_time))
+        messages = messages[-self.display_limit:]
+        # Una sola query per i metadati di tutte le immagini della lista
+        get_image_cache().prefetch_metadata(image_id for msg in messages for image_id in message_image_ids(msg))
+        self.message_model.set_messages(messages)
+        self.list_view.scrollToBottom()
+        self.message_count = len(messages)
+        self.update_placeholder()
         self.update_status()
 
-    def add_message(self, msg):
-        if self.session_start_time and msg.get('received_at') and msg['received_at'] >= self.session_start_time:
-            # Crea il widget personalizzato per il messaggio
-            message_widget = MessageItemWidget(msg)
-            
-            # Crea un item per la lista
-            item = QListWidgetItem()
-            item.setSizeHint(QSize(400, 70))  # Dimensione fissa
-            
-            # Salva i dati del messaggio nell'item per il click
-            item.setData(Qt.UserRole, msg)
-            
-            # Aggiungi l'item alla lista
-            self.list_widget.addItem(item)
-            self.list_widget.setItemWidget(item, message_widget)
-            
-            self.message_count += 1
+    def add_messages(self, messages):
+        """Aggiunge un lotto di messaggi con un solo ridisegno e un solo scorrimento"""
+        if self.session_start_time:
+            messages = [msg for msg in messages
+                        if msg.get('received_at') and msg['received_at'] >= self.session_start_time
+                        and self.is_shown_account(msg)]
+        else:
+            messages = []
+        if messages:
+            self.message_count += len(messages)
+            # Oltre il limite di visualizzazione sarebbero rimossi subito: non entrano nel modello
+            visible = messages[-self.display_limit:] if self.display_limit > 0 else []
+            get_image_cache().prefetch_metadata(image_id for msg in visible for image_id in message_image_ids(msg))
+            # Un solo inserimento per l'intero lotto, poi i più vecchi oltre il limite
+            self.message_model.append(visible)
+            self.apply_display_limit()
             
             # Scorri automaticamente verso il basso
-            self.list_widget.scrollToBottom()
+            self.list_view.scrollToBottom()
         
         self.update_placeholder()
         self.update_status()
 
-    def update_placeholder(self, count=None):
-        if count is None:
-            count = self.list_widget.count()
-        self.placeholder.setVisible(count == 0)
+    def update_messages(self, messages):
+        """Aggiorna le righe di messaggi già mostrati (es. quando arriva la loro foto)"""
+        self.message_model.update_messages(messages)
+
+    def update_placeholder(self):
+        self.placeholder.setVisible(self.message_model.rowCount() == 0)
 
     def open_contacts(self):
         if self.contacts_dialog is None:
@@ -2528,15 +3007,22 @@ class MessagesWidget(QWidget):
         dialog = ChatsDialog(self)
         dialog.exec()
 
+    def open_search(self):
+        dialog = SearchDialog(self)
+        dialog.exec()
+
     def clear_history(self):
         reply = QMessageBox.question(self, 'Conferma eliminazione',
             'Sei sicuro di voler eliminare tutta la cronologia dei messaggi e delle immagini?\n\nL\'operazione è irreversibile.',
             QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
         if reply == QMessageBox.Yes:
             try:
-                for f in [MESSAGES_FILE, IMAGES_FILE]:
-                    with open(f, 'w', encoding='utf-8') as file:
-                        json.dump([] if f == MESSAGES_FILE else {}, file)
+                backend = get_message_backend()
+                if backend is not get_store():
+                    backend.clear()
+                get_store().clear_history()
+                get_archive().clear()
+                get_image_cache().invalidate()
                 self.message_count = 0
                 self.load_messages()
                 QMessageBox.information(self, 'Operazione completata', 
@@ -2548,8 +3034,16 @@ class MainApp(QApplication):
     def __init__(self, argv):
         super().__init__(argv)
         self.setStyle('Fusion')  # Usa stile moderno
+        # Con un demone in esecuzione (daemon.py) la GUI si collega a lui: migrazioni,
+        # acquisizione e conservazione sono già compito del demone
+        self.daemon_info = read_daemon_lock()
+        self.retention_engine = None
+        if self.daemon_info is None:
+            self.start_local_storage()
+        
         self.login_widget = LoginWidget(self.on_login)
         self.messages_widget = MessagesWidget()
+        self.messages_widget.retention_engine = self.retention_engine
         self.listener_thread = None
         self._should_quit = False
         
@@ -2582,8 +3076,23 @@ class MainApp(QApplication):
             }
         """)
         
-        # Prova auto-login se le credenziali sono salvate
-        self.try_auto_login()
+        if self.daemon_info is not None:
+            self.attach_listener(DaemonConnection(self.daemon_info))
+        else:
+            # Prova auto-login se le credenziali sono salvate
+            self.try_auto_login()
+
+    def start_local_storage(self):
+        """Migrazioni all'avvio e conservazione, quando la GUI non è collegata a un demone"""
+        errors = prepare_storage()
+        if errors:
+            QMessageBox.warning(None, 'Errore importazione dati',
+                                '\n'.join(errors) + '\n\nI file indicati non sono stati modificati: '
+                                'correggerli e riavviare per completare l\'importazione.')
+        # Pulizia periodica della cronologia secondo le impostazioni di conservazione
+        self.retention_engine = RetentionEngine(get_store(), get_media_store(), get_archive(),
+                                               backend=get_message_backend())
+        self.retention_engine.start()
 
     def try_auto_login(self):
         """Tenta il login automatico se le credenziali sono disponibili"""
@@ -2645,22 +3154,9 @@ class MainApp(QApplication):
         try:
             self.login_widget.hide()
             
-            # Mostra finestra principale
-            self.messages_widget.show()
-            
-            # Crea e avvia il thread di ascolto
-            self.listener_thread = MessageListener(api_id, api_hash, phone)
-            self.messages_widget.set_session_start_time(self.listener_thread.start_time)
-            self.listener_thread.new_message.connect(self.messages_widget.add_message)
-            
-            # Gestisci la chiusura della finestra
-            self.messages_widget.closeEvent = self.on_main_window_close
-            
-            # Connetti segnali per gestione errori
-            self.listener_thread.finished.connect(self.on_listener_finished)
-            
-            # Avvia il thread
-            self.listener_thread.start()
+            # Crea e avvia il thread di ascolto: l'account inserito più gli altri di config.json
+            accounts = load_accounts(make_account(api_id, api_hash, phone))
+            self.attach_listener(MessageListener(accounts))
             
         except Exception as e:
             error_msg = f"Errore durante il login: {str(e)}"
@@ -2677,37 +3173,73 @@ class MainApp(QApplication):
                 self.login_widget.login_btn.setText('🚀 Avvia AutomaticTelReader')
                 self.login_widget.show()
 
+    def attach_listener(self, listener):
+        """Mostra la finestra principale e la collega a un MessageListener o a un DaemonConnection"""
+        # Mostra finestra principale
+        self.messages_widget.show()
+        
+        self.listener_thread = listener
+        self.messages_widget.listener = listener
+        self.messages_widget.set_session_start_time(listener.start_time)
+        listener.new_messages.connect(self.messages_widget.add_messages)
+        listener.messages_updated.connect(self.messages_widget.update_messages)
+        listener.connection_changed.connect(lambda state: self.messages_widget.update_status())
+        
+        # Gestisci la chiusura della finestra
+        self.messages_widget.closeEvent = self.on_main_window_close
+        
+        # Connetti segnali per gestione errori
+        listener.finished.connect(self.on_listener_finished)
+        
+        # Avvia il thread
+        listener.start()
+
     def on_listener_finished(self):
-        """Chiamato quando il thread di ascolto termina"""
+        """Chiamato quando il thread di ascolto termina.
+
+        Le disconnessioni vengono gestite dal listener stesso (riconnessione
+        automatica): il thread termina solo per un errore non recuperabile,
+        ad esempio una sessione non più autorizzata (o la chiusura del demone).
+        """
         if not self._should_quit:
-            # Se il thread termina inaspettatamente, mostra un messaggio
+            error = self.listener_thread.fatal_error if self.listener_thread else None
             reply = QMessageBox.question(
                 self.messages_widget,
-                'Connessione persa',
-                'La connessione a Telegram è stata persa.\n\nVuoi riavviare l\'applicazione?',
+                'Ascolto interrotto',
+                f'L\'ascolto dei messaggi si è interrotto per un errore non recuperabile:\n'
+                f'{error or "errore sconosciuto"}\n\nVuoi tornare alla schermata di accesso?',
                 QMessageBox.Yes | QMessageBox.No,
                 QMessageBox.Yes
             )
             
             if reply == QMessageBox.Yes:
-                # Riavvia l'applicazione
+                # Riavvia l'applicazione (senza demone: ci si collega direttamente)
                 self.messages_widget.hide()
+                if self.retention_engine is None:
+                    self.start_local_storage()
+                    self.messages_widget.retention_engine = self.retention_engine
                 self.login_widget.show()
             else:
                 self.quit()
 
     def on_main_window_close(self, event):
         """Gestisce la chiusura della finestra principale"""
+        if isinstance(self.listener_thread, DaemonConnection):
+            detail = 'Il demone continuerà ad ascoltare i messaggi.'
+        else:
+            detail = 'L\'ascolto dei messaggi verrà interrotto.'
         reply = QMessageBox.question(
             self.messages_widget,
             'Conferma chiusura',
-            'Sei sicuro di voler chiudere AutomaticTelReader?\n\nL\'ascolto dei messaggi verrà interrotto.',
+            f'Sei sicuro di voler chiudere AutomaticTelReader?\n\n{detail}',
             QMessageBox.Yes | QMessageBox.No,
             QMessageBox.No
         )
         
         if reply == QMessageBox.Yes:
             self._should_quit = True
+            if self.retention_engine is not None:
+                self.retention_engine.stop()
             
             if self.listener_thread and self.listener_thread.isRunning():
                 # Mostra dialogo di chiusura
@@ -2718,8 +3250,9 @@ class MainApp(QApplication):
                 progress.setWindowFlag(Qt.WindowCloseButtonHint, False)
                 progress.show()
                 
-                # Ferma il thread
+                # Ferma il thread (disconnette il client e scrive i dati in sospeso)
                 self.listener_thread.requestInterruption()
+                self.listener_thread.shutdown()
                 self.listener_thread.quit()
                 
                 # Aspetta massimo 5 secondi per la chiusura
@@ -2735,5 +3268,11 @@ class MainApp(QApplication):
             event.ignore()
 
 if __name__ == '__main__':
+    if '--benchmark-storage' in sys.argv:
+        # python main.py --benchmark-storage [numero di messaggi]
+        position = sys.argv.index('--benchmark-storage')
+        count = int(sys.argv[position + 1]) if len(sys.argv) > position + 1 else 20000
+        print_storage_benchmark(benchmark_storage_backends(count))
+        sys.exit(0)
     app = MainApp(sys.argv)
     sys.exit(app.exec()) 
\ No newline at end of file
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# I moduli dell'app si importano come fa main.py (from core import ...)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'AutomaticTelReader'))
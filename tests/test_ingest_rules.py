@@ -0,0 +1,61 @@
+from types import SimpleNamespace
+
+import pytest
+
+from core import IngestRules, MediaScheduler, peer_chat_id, rule_chat_id
+
+# Canale/supergruppo con id salvato 1234567890: Telethon lo indica come -1001234567890
+CHANNEL_ID = '1234567890'
+CHANNEL_PEER_ID = -1001234567890
+# Gruppo base con id salvato 4242: peer id -4242
+GROUP_ID = '4242'
+GROUP_PEER_ID = -4242
+
+
+def message(chat_id, message_id=1, text='ciao'):
+    return SimpleNamespace(chat_id=chat_id, id=message_id, raw_text=text)
+
+
+def test_peer_chat_id_strips_the_telethon_markers():
+    assert peer_chat_id(CHANNEL_PEER_ID) == CHANNEL_ID
+    assert peer_chat_id(GROUP_PEER_ID) == GROUP_ID
+    assert peer_chat_id(777) == '777'
+    assert peer_chat_id(None) is None
+
+
+def test_rule_chat_id_accepts_saved_and_peer_ids():
+    assert rule_chat_id(CHANNEL_PEER_ID) == CHANNEL_ID
+    assert rule_chat_id(str(CHANNEL_PEER_ID)) == CHANNEL_ID
+    assert rule_chat_id(CHANNEL_ID) == CHANNEL_ID
+    assert rule_chat_id(GROUP_PEER_ID) == GROUP_ID
+    assert rule_chat_id('*') == '*'
+
+
+@pytest.mark.parametrize('key', [CHANNEL_ID, str(CHANNEL_PEER_ID), CHANNEL_PEER_ID])
+def test_deny_chats_matches_channel_in_any_form(key):
+    rules = IngestRules({'filter_deny_chats': [key]})
+    assert rules.check(message(CHANNEL_PEER_ID)) == 'chat'
+    assert rules.check(message(GROUP_PEER_ID)) is None
+
+
+@pytest.mark.parametrize('key', [CHANNEL_ID, str(CHANNEL_PEER_ID)])
+def test_allow_chats_matches_channel_in_any_form(key):
+    rules = IngestRules({'filter_allow_chats': [key]})
+    assert rules.check(message(CHANNEL_PEER_ID)) is None
+    assert rules.check(message(GROUP_PEER_ID)) == 'chat'
+
+
+def test_chat_sample_keyed_by_peer_id_applies_to_channel():
+    rules = IngestRules({'filter_chat_sample': {str(CHANNEL_PEER_ID): 0, '*': 1}})
+    assert rules.check(message(CHANNEL_PEER_ID)) == 'campionamento'
+    assert rules.check(message(GROUP_PEER_ID)) is None
+
+
+@pytest.mark.parametrize('key', [CHANNEL_ID, str(CHANNEL_PEER_ID), CHANNEL_PEER_ID])
+def test_media_skip_chats_uses_the_same_keys_as_the_rules(key):
+    settings = {'media_skip_chats': [key], 'filter_deny_chats': [key]}
+    scheduler = MediaScheduler(None, settings)
+    # Lo scheduler riceve l'id salvato del messaggio (message_chat_id)
+    assert scheduler.skip_reason(CHANNEL_ID, 100) == 'chat esclusa'
+    assert scheduler.skip_reason(GROUP_ID, 100) is None
+    assert IngestRules(settings).check(message(CHANNEL_PEER_ID)) == 'chat'
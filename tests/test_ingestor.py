@@ -0,0 +1,98 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import core
+from core import MessageIndex, TelegramIngestor, make_account
+
+CHAT_PEER_ID = 777
+
+
+@pytest.fixture
+def ingestor(tmp_path, monkeypatch):
+    # Archivi e impostazioni nella cartella temporanea, mai quelli del progetto
+    monkeypatch.chdir(tmp_path)
+    for name in ('_store', '_message_backend', '_media_store', '_contact_registry', '_archive'):
+        monkeypatch.setattr(core, name, None)
+    ingestor = TelegramIngestor([make_account(1, 'hash', '+390000000000')])
+    yield ingestor
+    ingestor.writer.store.close()
+
+
+def message(message_id=1, get_sender=None, sender_id=42):
+    async def no_entity():
+        return None
+
+    return SimpleNamespace(id=message_id, chat_id=CHAT_PEER_ID, sender_id=sender_id, raw_text='ciao',
+                           date='2024-01-01 00:00:00', photo=None,
+                           get_sender=get_sender or no_entity, get_chat=no_entity)
+
+
+def test_release_only_drops_pending_keys(tmp_path):
+    index = MessageIndex(core.JsonlMessageBackend(str(tmp_path / 'messages')))
+    pending, saved = ('acc', '7', 1), ('acc', '7', 2)
+    index.reserve(pending, mailbox=True)
+    index.reserve(saved, mailbox=True)
+    index.bind(saved, core.MessageRecord(sender_id='1', chat_id='7', text='', date='', received_at=''))
+    index.release(pending)
+    index.release(saved)
+    assert index.get(pending) is None
+    assert index.find_mailbox('acc', 1) == []
+    assert isinstance(index.get(saved), core.MessageRecord)
+
+
+def test_failed_resolve_releases_the_message_for_replays(ingestor):
+    session = ingestor.sessions[0]
+
+    async def flaky_sender():
+        raise ConnectionError('rete assente')
+
+    async def scenario():
+        ingestor.persist_queue = asyncio.Queue()
+        first = message(get_sender=flaky_sender)
+        assert ingestor._claim(session, first)
+        # Una modifica arrivata mentre il messaggio era in risoluzione
+        assert ingestor._apply_change(ingestor._message_key(session, first), {'text': 'modificato'})
+        with pytest.raises(ConnectionError):
+            await ingestor._resolve(first, '2024-01-01T00:00:00', session)
+        assert ingestor._early_changes == {}
+        # La ripetizione (o il recupero) acquisisce di nuovo lo stesso messaggio
+        replay = message()
+        assert ingestor._claim(session, replay)
+        await ingestor._resolve(replay, '2024-01-01T00:00:01', session)
+        msg = (await ingestor.persist_queue.get())[0]
+        assert (msg.message_id, msg.text) == (1, 'ciao')
+
+    asyncio.run(scenario())
+
+
+def test_pipeline_is_drained_before_the_writer_stops(ingestor):
+    session = ingestor.sessions[0]
+
+    async def scenario():
+        ingestor.writer.start()
+        workers = ingestor._start_pipeline()
+        for message_id in (1, 2, 3):
+            assert ingestor._claim(session, message(message_id))
+            await ingestor.resolve_queue.put((message(message_id), '2024-01-01T00:00:00', session))
+        # Come in _main all'arresto: code svuotate, worker fermati, poi il thread di scrittura
+        await ingestor._drain_pipeline()
+        for task in workers:
+            task.cancel()
+
+    asyncio.run(scenario())
+    assert ingestor.writer.stop() is True
+    assert [msg.message_id for msg in ingestor.writer.store] == [1, 2, 3]
+
+
+@pytest.mark.parametrize('sender_id, saved_id', [(None, None), (42, '42'), (-1001234567890, '1234567890')])
+def test_unresolved_sender_keeps_the_saved_peer_id(ingestor, sender_id, saved_id):
+    session = ingestor.sessions[0]
+
+    async def scenario():
+        ingestor.persist_queue = asyncio.Queue()
+        await ingestor._resolve(message(sender_id=sender_id), '2024-01-01T00:00:00', session)
+        return (await ingestor.persist_queue.get())[0]
+
+    assert asyncio.run(scenario()).sender_id == saved_id
@@ -0,0 +1,167 @@
+import datetime
+import os
+
+import pytest
+
+import core
+from core import (JsonlMessageBackend, JsonMessageBackend, MediaStore, MessageArchive, MessageRecord, MessageStore,
+                  StorageWriter)
+
+
+def record(text, received_at='2024-01-01T00:00:00', **fields):
+    return MessageRecord(sender_id='1', chat_id='10', text=text, date='2024-01-01 00:00:00',
+                         received_at=received_at, **fields)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return MessageStore(str(tmp_path / 'telreader.db'))
+
+
+@pytest.fixture
+def media(tmp_path):
+    return MediaStore(str(tmp_path / 'media'))
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(core, 'WRITER_RETRY_DELAYS', (0.01,))
+
+
+@pytest.mark.parametrize('backend_class', [JsonlMessageBackend, JsonMessageBackend])
+def test_file_backends_never_reuse_a_deleted_id(tmp_path, backend_class):
+    path = str(tmp_path / 'messages')
+    backend = backend_class(path)
+    ids = backend.append_many([record('a'), record('b'), record('c')])
+    backend.delete_messages([ids[-1]])
+    getattr(backend, 'close', lambda: None)()
+
+    backend = backend_class(path)
+    new_id, = backend.append_many([record('d')])
+    assert new_id == ids[-1] + 1
+    msg = backend.get(new_id)
+    msg.text = 'd2'
+    backend.update_messages([msg])
+    getattr(backend, 'close', lambda: None)()
+
+    # Dopo un nuovo caricamento l'aggiornamento resta sul messaggio giusto
+    backend = backend_class(path)
+    assert [(msg.id, msg.text) for msg in backend] == [(ids[0], 'a'), (ids[1], 'b'), (new_id, 'd2')]
+    getattr(backend, 'close', lambda: None)()
+
+
+def test_writer_retries_a_failed_commit_and_reports_it(store, media):
+    failures = {'left': 3}
+    apply_batch = store.apply_batch
+
+    def flaky_apply_batch(**kwargs):
+        if failures['left']:
+            failures['left'] -= 1
+            raise RuntimeError('database is locked')
+        return apply_batch(**kwargs)
+
+    store.apply_batch = flaky_apply_batch
+    committed = []
+    writer = StorageWriter(store, media, on_commit=committed.extend)
+    writer.start()
+    writer.add_message(record('a'))
+    # Due tentativi falliti: il gruppo resta in attesa e flush() lo segnala
+    assert writer.flush(5) is False
+    assert writer.last_error == 'database is locked'
+    writer.add_message(record('b'))
+    # Al commit successivo viene scritto prima il gruppo rimasto indietro
+    assert writer.flush(5) is True
+    assert writer.stop() is True
+    assert [msg.text for msg in committed] == ['a', 'b']
+    assert [msg.text for msg in store] == ['a', 'b']
+
+
+def test_writer_stop_reports_unwritten_changes(store, media):
+    def failing_apply_batch(**kwargs):
+        raise RuntimeError('disk full')
+
+    store.apply_batch = failing_apply_batch
+    writer = StorageWriter(store, media)
+    writer.start()
+    writer.add_contact({'id': '1', 'type': 'user'})
+    assert writer.stop() is False
+
+
+def test_writer_writes_what_is_queued_after_stop(store, media):
+    writer = StorageWriter(store, media)
+    writer.add_message(record('a'))
+    # Un messaggio accodato da un altro thread subito dopo la richiesta di stop
+    writer._queue.put(writer._STOP)
+    writer.add_message(record('b'))
+    writer.start()
+    writer.join(5)
+    assert writer.stop() is True
+    assert [msg.text for msg in store] == ['a', 'b']
+    # Dopo la fine del thread nulla viene più scritto, e stop() lo segnala
+    writer.add_message(record('c'))
+    assert writer.stop() is False
+
+
+@pytest.mark.parametrize('backend_class', [MessageStore, JsonlMessageBackend])
+def test_clear_media_pending_after_an_interrupted_download(tmp_path, backend_class):
+    path = str(tmp_path / 'messages')
+    backend = backend_class(path)
+    waiting, done = record('foto in arrivo'), record('testo')
+    waiting['media_pending'] = True
+    backend.append_many([waiting, done])
+    backend.close()
+
+    # All'avvio successivo la foto non arriverà più
+    backend = backend_class(path)
+    assert backend.clear_media_pending() == 1
+    assert backend.clear_media_pending() == 0
+    backend.close()
+    backend = backend_class(path)
+    assert [(msg.text, msg.get('media_pending')) for msg in backend] == [('foto in arrivo', None), ('testo', None)]
+    backend.close()
+
+
+def test_chat_cursors_advance_only_after_the_file_backend_write(store, media, tmp_path):
+    backend = JsonlMessageBackend(str(tmp_path / 'messages'))
+    append_many = backend.append_many
+
+    def failing_append_many(messages):
+        raise OSError('disk full')
+
+    backend.append_many = failing_append_many
+    writer = StorageWriter(store, media, backend=backend)
+    writer.start()
+    writer.add_message(record('a', message_id=5, account=core.DEFAULT_ACCOUNT))
+    assert writer.flush(5) is False
+    # Il messaggio non è nell'archivio: il recupero deve ancora poterlo rileggere
+    assert store.chat_cursors() == {}
+    backend.append_many = append_many
+    assert writer.flush(5) is True
+    assert writer.stop() is True
+    assert store.chat_cursors() == {'10': 5}
+    assert [msg.text for msg in backend] == ['a']
+
+
+def test_archive_completes_a_segment_interrupted_after_the_database_move(store, tmp_path, monkeypatch):
+    root = str(tmp_path / 'archive')
+    store.append_many([record('vecchio 1', received_at='2024-01-01T10:00:00'),
+                       record('vecchio 2', received_at='2024-01-02T10:00:00')])
+    replace = os.replace
+
+    def crash_on_segment(src, dst):
+        if dst.endswith('.jsonl.gz'):
+            raise OSError('interrotto')
+        replace(src, dst)
+
+    # Chiusura tra l'uscita dei messaggi dal database e il file definitivo del segmento
+    monkeypatch.setattr(core.os, 'replace', crash_on_segment)
+    with pytest.raises(OSError):
+        MessageArchive(root).archive_from(store, datetime.datetime(2024, 1, 15))
+    monkeypatch.setattr(core.os, 'replace', replace)
+    assert list(store) == []
+
+    # Al giro successivo il segmento viene completato e i messaggi restano leggibili
+    archive = MessageArchive(root)
+    assert archive.archive_from(store, datetime.datetime(2024, 1, 15)) == 0
+    assert [msg.text for msg in archive.iter_messages()] == ['vecchio 1', 'vecchio 2']
+    assert archive.manifest()['messages-2024-W01']['count'] == 2